@@ -0,0 +1,366 @@
+"""
+A local stand-in for the OpenAI chat completions API, for benchmarking parallel-parrot.
+
+It serves POST /v1/chat/completions with:
+- a configurable latency distribution
+- requests-per-minute and tokens-per-minute ratelimits, which are tracked per API key as continuously
+  refilling buckets, and reported in x-ratelimit-* headers.  Exceeding them returns a 429
+  with the same error body, reset headers and retry-after header as OpenAI.
+- randomly injected 5xx errors and context_length_exceeded errors
+- text completions, or function calls whose arguments follow the requested JSON schema
+
+    async with MockOpenAIServer(MockOpenAIServerConfig(latency_mean_seconds=0.05)) as server:
+        config = pp.OpenAIChatCompletionConfig(
+            openai_api_key="benchmark", openai_base_url=server.base_url
+        )
+"""
+
+import asyncio
+from dataclasses import asdict, dataclass, field
+import json
+import math
+import random
+import time
+from typing import Dict, List, Optional
+
+from aiohttp import web
+
+
+CHAT_COMPLETIONS_PATH = "/v1/chat/completions"
+SECONDS_PER_MINUTE = 60.0
+# like OpenAI's own estimate for ratelimits
+CHARS_PER_TOKEN_ESTIMATE = 4
+LATENCY_DISTRIBUTIONS = ("constant", "exponential", "lognormal")
+
+
+@dataclass
+class MockOpenAIServerConfig:
+    latency_mean_seconds: float = 0.05
+    # one of LATENCY_DISTRIBUTIONS
+    latency_distribution: str = "lognormal"
+    # the standard deviation of the log of the latency, for the lognormal distribution
+    latency_lognormal_sigma: float = 0.5
+    limit_requests: int = 1_000_000
+    limit_tokens: int = 1_000_000_000
+    # the probability that a request fails with one of server_error_statuses
+    server_error_rate: float = 0.0
+    server_error_statuses: List[int] = field(default_factory=lambda: [500, 502, 503])
+    # the probability that a request fails with context_length_exceeded, regardless of its length
+    context_length_error_rate: float = 0.0
+    context_window_tokens: int = 4097
+    completion_text: str = "POSITIVE"
+    completion_tokens: int = 2
+    # the number of objects in each function call's list
+    num_function_items: int = 3
+    seed: Optional[int] = 0
+
+
+@dataclass
+class MockOpenAIServerStats:
+    num_requests: int = 0
+    num_completions: int = 0
+    num_ratelimited: int = 0
+    num_server_errors: int = 0
+    num_context_length_errors: int = 0
+    prompt_tokens: int = 0
+    completion_tokens: int = 0
+    # the time from receiving each successful request to responding, in seconds
+    latencies_seconds: List[float] = field(default_factory=list)
+    first_request_time: Optional[float] = None
+    last_response_time: Optional[float] = None
+
+    def to_dict(self) -> dict:
+        return asdict(self)
+
+
+class _RateLimitBucket:
+    """
+    refills continuously, at the full limit per minute
+    """
+
+    def __init__(self, limit: int, now: float):
+        self.limit = limit
+        self.remaining = float(limit)
+        self.updated_time = now
+
+    def refill(self, now: float) -> None:
+        elapsed_seconds = max(now - self.updated_time, 0.0)
+        self.remaining = min(
+            float(self.limit),
+            self.remaining + (elapsed_seconds * self.limit / SECONDS_PER_MINUTE),
+        )
+        self.updated_time = now
+
+    def seconds_until_reset(self) -> float:
+        return (self.limit - self.remaining) * SECONDS_PER_MINUTE / self.limit
+
+
+class MockOpenAIServer:
+    def __init__(
+        self,
+        config: Optional[MockOpenAIServerConfig] = None,
+        host: str = "127.0.0.1",
+        port: int = 0,
+    ):
+        self.config = config if config is not None else MockOpenAIServerConfig()
+        if self.config.latency_distribution not in LATENCY_DISTRIBUTIONS:
+            raise ValueError(
+                f"Unknown {self.config.latency_distribution=} {LATENCY_DISTRIBUTIONS=}"
+            )
+        self.host = host
+        self.port = port
+        self.stats = MockOpenAIServerStats()
+        self._random = random.Random(self.config.seed)
+        # per API key
+        self._request_buckets: Dict[str, _RateLimitBucket] = {}
+        self._token_buckets: Dict[str, _RateLimitBucket] = {}
+        self._runner: Optional[web.AppRunner] = None
+
+    async def __aenter__(self):
+        await self.start()
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.stop()
+
+    async def start(self) -> None:
+        app = web.Application()
+        app.router.add_post(CHAT_COMPLETIONS_PATH, self.handle_chat_completion)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, self.host, self.port)
+        await site.start()
+        self.port = self._runner.addresses[0][1]
+
+    async def stop(self) -> None:
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
+
+    @property
+    def base_url(self) -> str:
+        return f"http://{self.host}:{self.port}/v1"
+
+    async def handle_chat_completion(self, request: web.Request) -> web.Response:
+        start_time = time.monotonic()
+        stats = self.stats
+        stats.num_requests += 1
+        if stats.first_request_time is None:
+            stats.first_request_time = start_time
+        payload = await request.json()
+        api_key = request.headers.get("Authorization", "")
+        prompt_tokens = _estimate_prompt_tokens(payload)
+        max_tokens = payload.get("max_tokens") or self.config.completion_tokens
+        # OpenAI counts max_tokens against the tokens-per-minute ratelimit up front
+        ratelimit_tokens = prompt_tokens + (max_tokens * (payload.get("n") or 1))
+        (ratelimit_type, ratelimit_headers) = self._consume_ratelimits(
+            api_key, ratelimit_tokens, start_time
+        )
+        if ratelimit_type is not None:
+            stats.num_ratelimited += 1
+            return _error_response(
+                429,
+                f"Rate limit reached for {ratelimit_type} per min.",
+                error_type=ratelimit_type,
+                code="rate_limit_exceeded",
+                headers=ratelimit_headers,
+            )
+        await asyncio.sleep(self._sample_latency_seconds())
+        if self._random.random() < self.config.server_error_rate:
+            stats.num_server_errors += 1
+            return _error_response(
+                self._random.choice(self.config.server_error_statuses),
+                "The server had an error while processing your request.",
+                error_type="server_error",
+                headers=ratelimit_headers,
+            )
+        context_window_tokens = self.config.context_window_tokens
+        if (
+            prompt_tokens + max_tokens > context_window_tokens
+            or self._random.random() < self.config.context_length_error_rate
+        ):
+            stats.num_context_length_errors += 1
+            resulted_tokens = max(prompt_tokens + max_tokens, context_window_tokens + 1)
+            return _error_response(
+                400,
+                f"This model's maximum context length is {context_window_tokens} tokens. "
+                f"However, your messages resulted in {resulted_tokens} tokens. "
+                "Please reduce the length of the messages.",
+                error_type="invalid_request_error",
+                code="context_length_exceeded",
+                param="messages",
+                headers=ratelimit_headers,
+            )
+        response_body = self._create_completion(payload, prompt_tokens)
+        stats.num_completions += 1
+        stats.prompt_tokens += prompt_tokens
+        stats.completion_tokens += self.config.completion_tokens
+        end_time = time.monotonic()
+        stats.latencies_seconds.append(end_time - start_time)
+        stats.last_response_time = end_time
+        return web.json_response(response_body, headers=ratelimit_headers)
+
+    def _consume_ratelimits(self, api_key: str, num_tokens: int, now: float):
+        """
+        returns the type of the exceeded ratelimit (or None), and the x-ratelimit-* headers
+        """
+        request_bucket = self._request_buckets.get(api_key)
+        if request_bucket is None:
+            request_bucket = _RateLimitBucket(self.config.limit_requests, now)
+            self._request_buckets[api_key] = request_bucket
+        token_bucket = self._token_buckets.get(api_key)
+        if token_bucket is None:
+            token_bucket = _RateLimitBucket(self.config.limit_tokens, now)
+            self._token_buckets[api_key] = token_bucket
+        request_bucket.refill(now)
+        token_bucket.refill(now)
+        if request_bucket.remaining < 1:
+            ratelimit_type: Optional[str] = "requests"
+        elif token_bucket.remaining < num_tokens:
+            ratelimit_type = "tokens"
+        else:
+            ratelimit_type = None
+            request_bucket.remaining -= 1
+            token_bucket.remaining -= num_tokens
+        headers = {
+            "x-ratelimit-limit-requests": str(request_bucket.limit),
+            "x-ratelimit-limit-tokens": str(token_bucket.limit),
+            "x-ratelimit-remaining-requests": str(int(request_bucket.remaining)),
+            "x-ratelimit-remaining-tokens": str(int(token_bucket.remaining)),
+            "x-ratelimit-reset-requests": format_reset_seconds(
+                request_bucket.seconds_until_reset()
+            ),
+            "x-ratelimit-reset-tokens": format_reset_seconds(
+                token_bucket.seconds_until_reset()
+            ),
+        }
+        if ratelimit_type == "requests":
+            retry_after_seconds = (1 - request_bucket.remaining) / (
+                request_bucket.limit / SECONDS_PER_MINUTE
+            )
+            headers["retry-after"] = str(math.ceil(retry_after_seconds))
+        elif ratelimit_type == "tokens":
+            retry_after_seconds = (num_tokens - token_bucket.remaining) / (
+                token_bucket.limit / SECONDS_PER_MINUTE
+            )
+            headers["retry-after"] = str(math.ceil(retry_after_seconds))
+        return (ratelimit_type, headers)
+
+    def _sample_latency_seconds(self) -> float:
+        mean = self.config.latency_mean_seconds
+        if mean <= 0:
+            return 0.0
+        if self.config.latency_distribution == "constant":
+            return mean
+        elif self.config.latency_distribution == "exponential":
+            return self._random.expovariate(1.0 / mean)
+        else:
+            sigma = self.config.latency_lognormal_sigma
+            # so that the mean of the distribution is latency_mean_seconds
+            mu = math.log(mean) - (sigma**2 / 2.0)
+            return self._random.lognormvariate(mu, sigma)
+
+    def _create_completion(self, payload: dict, prompt_tokens: int) -> dict:
+        functions = payload.get("functions")
+        if functions:
+            function = functions[0]
+            function_call = payload.get("function_call")
+            if isinstance(function_call, dict) and "name" in function_call:
+                function = next(
+                    (f for f in functions if f["name"] == function_call["name"]),
+                    function,
+                )
+            arguments = _mock_json_schema_value(
+                function.get("parameters", {}), self.config.num_function_items
+            )
+            message = {
+                "role": "assistant",
+                "content": None,
+                "function_call": {
+                    "name": function["name"],
+                    "arguments": json.dumps(arguments),
+                },
+            }
+            finish_reason = "function_call"
+        else:
+            message = {"role": "assistant", "content": self.config.completion_text}
+            finish_reason = "stop"
+        completion_tokens = self.config.completion_tokens
+        return {
+            "id": f"chatcmpl-mock{self.stats.num_completions}",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": payload.get("model"),
+            "choices": [
+                {"index": 0, "message": message, "finish_reason": finish_reason}
+            ],
+            "usage": {
+                "prompt_tokens": prompt_tokens,
+                "completion_tokens": completion_tokens,
+                "total_tokens": prompt_tokens + completion_tokens,
+            },
+        }
+
+
+def format_reset_seconds(seconds: float) -> str:
+    """
+    in the format of OpenAI's x-ratelimit-reset-* headers, e.g. "1m20s", "6.5s" or "20ms"
+    """
+    if seconds < 1.0:
+        return f"{max(round(seconds * 1000), 0)}ms"
+    minutes = int(seconds // SECONDS_PER_MINUTE)
+    remaining_seconds = round(seconds - (minutes * SECONDS_PER_MINUTE), 3)
+    if minutes > 0:
+        return f"{minutes}m{remaining_seconds:g}s"
+    return f"{remaining_seconds:g}s"
+
+
+def _estimate_prompt_tokens(payload: dict) -> int:
+    num_chars = 0
+    for message in payload.get("messages", []):
+        content = message.get("content")
+        if isinstance(content, str):
+            num_chars += len(content)
+    functions = payload.get("functions")
+    if functions is not None:
+        num_chars += len(json.dumps(functions, separators=(",", ":")))
+    return math.ceil(num_chars / CHARS_PER_TOKEN_ESTIMATE)
+
+
+def _mock_json_schema_value(schema: dict, num_items: int, name: str = "value"):
+    schema_type = schema.get("type")
+    if schema_type == "object":
+        return {
+            key: _mock_json_schema_value(property_schema, num_items, key)
+            for key, property_schema in schema.get("properties", {}).items()
+        }
+    elif schema_type == "array":
+        item_schema = schema.get("items", {})
+        return [
+            _mock_json_schema_value(item_schema, num_items, f"{name} {i}")
+            for i in range(num_items)
+        ]
+    elif schema_type in ("integer", "number"):
+        return 1
+    elif schema_type == "boolean":
+        return True
+    return name
+
+
+def _error_response(
+    status: int,
+    message: str,
+    error_type: str,
+    code: Optional[str] = None,
+    param: Optional[str] = None,
+    headers: Optional[dict] = None,
+) -> web.Response:
+    body = {
+        "error": {
+            "message": message,
+            "type": error_type,
+            "param": param,
+            "code": code,
+        }
+    }
+    return web.json_response(body, status=status, headers=headers)
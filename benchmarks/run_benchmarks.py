@@ -0,0 +1,344 @@
+"""
+Scripted benchmark scenarios, which run parallel-parrot against the local mock OpenAI server.
+
+    python -m benchmarks.run_benchmarks --list
+    python -m benchmarks.run_benchmarks dictlist_text_10k pandas_function_10k
+    python -m benchmarks.run_benchmarks --json bench_output.json
+
+Each scenario runs in a fresh process, with the mock server in another process,
+so that the peak RSS and the CPU time belong to parallel-parrot alone.
+It reports rows/sec, the p50/p99 latency of the successful requests (as seen by the server,
+including the simulated latency), the peak RSS of the client,
+and how much of the requests-per-minute and tokens-per-minute ratelimits were used.
+"""
+
+import argparse
+import asyncio
+from dataclasses import asdict, dataclass, field, replace
+import json
+import multiprocessing
+import sys
+import time
+from typing import Dict, List, Optional
+
+import parallel_parrot as pp
+
+from .mock_openai_server import (
+    SECONDS_PER_MINUTE,
+    MockOpenAIServer,
+    MockOpenAIServerConfig,
+)
+
+
+INPUT_TYPES = ("dictlist", "pandas")
+MODES = ("text", "function")
+ROW_COUNTS = {"10k": 10_000, "100k": 100_000, "1m": 1_000_000}
+TEXT_PROMPT_TEMPLATE = """
+What is the sentiment of this product review?
+POSITIVE, NEUTRAL or NEGATIVE?
+review #${review_id}: ${input}
+sentiment:"""
+FUNCTION_PROMPT_TEMPLATE = """
+List the products mentioned in this review, with their category.
+review #${review_id}: ${input}"""
+FUNCTION_OUTPUT_KEY_NAMES = ["product", "category"]
+REVIEWS = [
+    "this is a super duper product that will change the world",
+    "do not buy this",
+    "the blender arrived broken, but the toaster works fine",
+]
+
+
+@dataclass
+class BenchmarkScenario:
+    name: str
+    num_rows: int
+    # one of INPUT_TYPES
+    input_type: str = "dictlist"
+    # one of MODES
+    mode: str = "text"
+    token_limit_mode: pp.TokenLimitMode = pp.TokenLimitMode.RAISE_ERROR
+    server_config: MockOpenAIServerConfig = field(
+        default_factory=MockOpenAIServerConfig
+    )
+
+
+def make_scenarios() -> Dict[str, BenchmarkScenario]:
+    scenarios = {}
+    for row_count_name, num_rows in ROW_COUNTS.items():
+        for input_type in INPUT_TYPES:
+            for mode in MODES:
+                name = f"{input_type}_{mode}_{row_count_name}"
+                scenarios[name] = BenchmarkScenario(
+                    name=name, num_rows=num_rows, input_type=input_type, mode=mode
+                )
+    # the ratelimits of a typical account, so the run is paced by the x-ratelimit-* headers
+    scenarios["ratelimited_text_5k"] = BenchmarkScenario(
+        name="ratelimited_text_5k",
+        num_rows=5_000,
+        server_config=MockOpenAIServerConfig(limit_requests=3_500, limit_tokens=90_000),
+    )
+    scenarios["faulty_text_10k"] = BenchmarkScenario(
+        name="faulty_text_10k",
+        num_rows=10_000,
+        token_limit_mode=pp.TokenLimitMode.TRUNCATE,
+        server_config=MockOpenAIServerConfig(
+            latency_distribution="exponential",
+            server_error_rate=0.01,
+            context_length_error_rate=0.001,
+        ),
+    )
+    return scenarios
+
+
+SCENARIOS = make_scenarios()
+
+
+def make_input_rows(num_rows: int) -> List[dict]:
+    return [
+        {"review_id": i, "input": REVIEWS[i % len(REVIEWS)]} for i in range(num_rows)
+    ]
+
+
+async def run_client(scenario: BenchmarkScenario, base_url: str) -> dict:
+    input_data = make_input_rows(scenario.num_rows)
+    if scenario.input_type == "pandas":
+        import pandas as pd  # type: ignore
+
+        input_data = pd.DataFrame(input_data)
+    config = pp.OpenAIChatCompletionConfig(
+        openai_api_key="*benchmark*",
+        model="gpt-3.5-turbo-0613",
+        openai_base_url=base_url,
+        token_limit_mode=scenario.token_limit_mode,
+    )
+    start_time = time.perf_counter()
+    async with pp.OpenAIClient() as client:
+        if scenario.mode == "function":
+            (output_data, usage_stats_sum) = await pp.parallel_data_generation(
+                config=config,
+                input_data=input_data,
+                prompt_template=FUNCTION_PROMPT_TEMPLATE,
+                output_key_names=FUNCTION_OUTPUT_KEY_NAMES,
+                client=client,
+            )
+        else:
+            (output_data, usage_stats_sum) = await pp.parallel_text_generation(
+                config=config,
+                input_data=input_data,
+                prompt_template=TEXT_PROMPT_TEMPLATE,
+                output_key="sentiment",
+                client=client,
+            )
+    elapsed_seconds = time.perf_counter() - start_time
+    return {
+        "elapsed_seconds": elapsed_seconds,
+        "num_output_rows": len(output_data),
+        "usage_stats_sum": usage_stats_sum,
+        "peak_rss_mb": get_peak_rss_mb(),
+    }
+
+
+def run_scenario(scenario: BenchmarkScenario) -> dict:
+    """
+    run the scenario in this process, against a mock server in a child process
+    """
+    context = multiprocessing.get_context("spawn")
+    (parent_connection, child_connection) = context.Pipe()
+    server_process = context.Process(
+        target=_serve_mock_openai_server,
+        args=(scenario.server_config, child_connection),
+        daemon=True,
+    )
+    server_process.start()
+    # so that recv() raises EOFError if the server process dies
+    child_connection.close()
+    try:
+        base_url = parent_connection.recv()
+        client_result = asyncio.run(run_client(scenario, base_url))
+        parent_connection.send("stop")
+        server_stats = parent_connection.recv()
+    finally:
+        server_process.join(timeout=10)
+        if server_process.is_alive():
+            server_process.terminate()
+    return summarize(scenario, client_result, server_stats)
+
+
+def summarize(
+    scenario: BenchmarkScenario, client_result: dict, server_stats: dict
+) -> dict:
+    elapsed_seconds = client_result["elapsed_seconds"]
+    latencies_seconds = sorted(server_stats.pop("latencies_seconds"))
+    first_request_time = server_stats.pop("first_request_time")
+    last_response_time = server_stats.pop("last_response_time")
+    if first_request_time is not None and last_response_time is not None:
+        served_minutes = max(last_response_time - first_request_time, 1e-9) / (
+            SECONDS_PER_MINUTE
+        )
+    else:
+        served_minutes = None
+    server_config = scenario.server_config
+    if served_minutes is not None:
+        # the budget is a full bucket at the start, plus the refill while serving
+        requests_utilization = server_stats["num_completions"] / (
+            server_config.limit_requests * (1.0 + served_minutes)
+        )
+        tokens_utilization = (
+            server_stats["prompt_tokens"] + server_stats["completion_tokens"]
+        ) / (server_config.limit_tokens * (1.0 + served_minutes))
+    else:
+        requests_utilization = None
+        tokens_utilization = None
+    return {
+        "scenario": scenario.name,
+        "num_rows": scenario.num_rows,
+        "input_type": scenario.input_type,
+        "mode": scenario.mode,
+        "elapsed_seconds": elapsed_seconds,
+        "rows_per_second": scenario.num_rows / elapsed_seconds,
+        "latency_p50_seconds": percentile(latencies_seconds, 0.50),
+        "latency_p99_seconds": percentile(latencies_seconds, 0.99),
+        "peak_rss_mb": client_result["peak_rss_mb"],
+        "requests_ratelimit_utilization": requests_utilization,
+        "tokens_ratelimit_utilization": tokens_utilization,
+        "num_output_rows": client_result["num_output_rows"],
+        "usage_stats_sum": client_result["usage_stats_sum"],
+        "server_stats": server_stats,
+    }
+
+
+def percentile(sorted_values: List[float], fraction: float) -> Optional[float]:
+    """
+    nearest-rank percentile of already sorted values
+    """
+    if len(sorted_values) == 0:
+        return None
+    index = min(int(fraction * len(sorted_values)), len(sorted_values) - 1)
+    return sorted_values[index]
+
+
+def get_peak_rss_mb() -> Optional[float]:
+    try:
+        import resource
+    except ImportError:
+        # e.g. on Windows
+        return None
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == "darwin":
+        # bytes on macOS, kilobytes elsewhere
+        return max_rss / (1024 * 1024)
+    return max_rss / 1024
+
+
+def _serve_mock_openai_server(server_config: MockOpenAIServerConfig, connection):
+    async def serve():
+        async with MockOpenAIServer(server_config) as server:
+            connection.send(server.base_url)
+            loop = asyncio.get_running_loop()
+            # wait for the client to finish, without blocking the event loop
+            await loop.run_in_executor(None, connection.recv)
+            connection.send(server.stats.to_dict())
+
+    asyncio.run(serve())
+
+
+def _run_scenario_in_process(scenario: BenchmarkScenario, connection) -> None:
+    connection.send(run_scenario(scenario))
+
+
+def run_scenario_in_process(scenario: BenchmarkScenario) -> dict:
+    """
+    a fresh process per scenario, so that peak RSS is not carried over from earlier scenarios
+    """
+    context = multiprocessing.get_context("spawn")
+    (parent_connection, child_connection) = context.Pipe()
+    process = context.Process(
+        target=_run_scenario_in_process, args=(scenario, child_connection)
+    )
+    process.start()
+    # so that recv() raises EOFError if the scenario process dies
+    child_connection.close()
+    try:
+        return parent_connection.recv()
+    except EOFError:
+        process.join()
+        raise RuntimeError(
+            f"Benchmark scenario {scenario.name} failed with {process.exitcode=}"
+        )
+    finally:
+        process.join()
+
+
+def format_result(result: dict) -> str:
+    def fmt(value, spec):
+        return "n/a" if value is None else format(value, spec)
+
+    return (
+        f"{result['scenario']:<24} "
+        f"{fmt(result['rows_per_second'], '>10.1f')} rows/s  "
+        f"p50 {fmt(result['latency_p50_seconds'], '.3f')}s  "
+        f"p99 {fmt(result['latency_p99_seconds'], '.3f')}s  "
+        f"peak RSS {fmt(result['peak_rss_mb'], '.0f')}MB  "
+        f"RPM used {fmt(result['requests_ratelimit_utilization'], '.1%')}  "
+        f"TPM used {fmt(result['tokens_ratelimit_utilization'], '.1%')}  "
+        f"429s {result['server_stats']['num_ratelimited']}  "
+        f"5xx {result['server_stats']['num_server_errors']}"
+    )
+
+
+def main(argv: Optional[List[str]] = None) -> List[dict]:
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument(
+        "scenarios",
+        nargs="*",
+        help="names of the scenarios to run (default: the 10k scenarios)",
+    )
+    parser.add_argument("--list", action="store_true", help="list the scenarios")
+    parser.add_argument("--rows", type=int, help="override the number of rows")
+    parser.add_argument(
+        "--latency", type=float, help="override the mean latency, in seconds"
+    )
+    parser.add_argument("--json", help="also write the results to this JSON file")
+    args = parser.parse_args(argv)
+    if args.list:
+        for name, scenario in SCENARIOS.items():
+            print(f"{name:<24} {scenario.num_rows:>9} rows")
+        return []
+    names = args.scenarios or [name for name in SCENARIOS if name.endswith("_10k")]
+    unknown_names = [name for name in names if name not in SCENARIOS]
+    if unknown_names:
+        parser.error(f"unknown scenarios {unknown_names}, see --list")
+    results = []
+    scenarios_run = {}
+    for name in names:
+        scenario = SCENARIOS[name]
+        if args.rows is not None:
+            scenario = replace(scenario, num_rows=args.rows)
+        if args.latency is not None:
+            scenario = replace(
+                scenario,
+                server_config=replace(
+                    scenario.server_config, latency_mean_seconds=args.latency
+                ),
+            )
+        scenarios_run[name] = asdict(scenario)
+        result = run_scenario_in_process(scenario)
+        print(format_result(result), flush=True)
+        results.append(result)
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(
+                {
+                    "scenarios": scenarios_run,
+                    "results": results,
+                },
+                f,
+                indent=2,
+                default=str,
+            )
+    return results
+
+
+if __name__ == "__main__":
+    main()
@@ -1,9 +1,23 @@
 from asyncio_anywhere import asyncio_run as run_async
 
-from .types import TokenLimitMode, OpenAIChatCompletionConfig
+from .types import (
+    TokenLimitMode,
+    ExecutionMode,
+    OpenAIChatCompletionConfig,
+    OpenAICredential,
+    OpenAIEndpoint,
+)
+from .openai_client import OpenAIClient
+from .instrumentation import (
+    Instrumentation,
+    PrometheusInstrumentation,
+    OpenTelemetryInstrumentation,
+)
 from .core import (
     parallel_text_generation,
     parallel_data_generation,
+    parallel_text_generation_stream,
+    parallel_data_generation_stream,
 )
 from .format_openai_fine_tuning import write_openai_fine_tuning_jsonl
 from .util_dictlist import auto_explode_json_dictlist
@@ -13,9 +27,18 @@ __all__ = [
     "register_uvloop",
     "run_async",
     "TokenLimitMode",
+    "ExecutionMode",
     "OpenAIChatCompletionConfig",
+    "OpenAICredential",
+    "OpenAIEndpoint",
+    "OpenAIClient",
+    "Instrumentation",
+    "PrometheusInstrumentation",
+    "OpenTelemetryInstrumentation",
     "parallel_text_generation",
     "parallel_data_generation",
+    "parallel_text_generation_stream",
+    "parallel_data_generation_stream",
     "write_openai_fine_tuning_jsonl",
     "auto_explode_json_dictlist",
 ]
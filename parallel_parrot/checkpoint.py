@@ -0,0 +1,121 @@
+import json
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple, Union
+
+from .types import ParallelParrotError
+from .util import LogPreview, logger
+
+
+class CheckpointJournal:
+    """
+    An append-only JSONL journal of completed rows, so that a failed job can be resumed
+    without re-sending (and re-paying for) the rows which already completed.
+    - the first line describes the job, and is used to refuse resuming a different job
+    - every following line is a completed {"row_index", "output", "usage"} record,
+      or a {"batch_id", "row_indexes"} record of a submitted batch (in ExecutionMode.BATCH),
+      or a {"batch_id", "finished"} record once all of the results of that batch are journaled
+    After load(), pending_batches has the batches which were submitted but not finished,
+    so that they are polled again rather than submitted (and billed) again.
+    """
+
+    def __init__(self, path: Union[str, Path], job_description: dict):
+        self.path = Path(path).resolve()
+        self.job_description = job_description
+        self.filehandle = None
+        # batch_id -> row indexes
+        self.pending_batches: Dict[str, List[int]] = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def load(self) -> Dict[int, Tuple[Union[None, str, list], dict]]:
+        """
+        read the completed rows, and open the journal for appending
+        """
+        completed_rows: Dict[int, Tuple[Union[None, str, list], dict]] = {}
+        if self.path.exists() and self.path.stat().st_size > 0:
+            with self.path.open("r") as f:
+                header = _parse_journal_line(f.readline())
+                if header is None or header.get("job") != self.job_description:
+                    raise ParallelParrotError(
+                        f"checkpoint journal {str(self.path)} was written by a different job {header=}"
+                    )
+                for line in f:
+                    record = _parse_journal_line(line)
+                    if record is not None and "batch_id" in record:
+                        self._load_batch_record(record)
+                        continue
+                    if record is None or "row_index" not in record:
+                        # the last line may be incomplete if the process was killed
+                        logger.warning(
+                            "skipping incomplete checkpoint record line=%s",
+                            LogPreview(line),
+                        )
+                        continue
+                    completed_rows[record["row_index"]] = (
+                        record["output"],
+                        record["usage"],
+                    )
+            logger.info(
+                f"resuming from {str(self.path)} with {len(completed_rows)} completed rows"
+            )
+            self.filehandle = self.path.open("a")
+            if not _ends_with_newline(self.path):
+                self.filehandle.write("\n")
+        else:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            self.filehandle = self.path.open("w")
+            self._write_record({"job": self.job_description})
+        return completed_rows
+
+    def append(
+        self, row_index: int, output: Union[None, str, list], usage: dict
+    ) -> None:
+        self._write_record({"row_index": row_index, "output": output, "usage": usage})
+
+    def append_batch(self, batch_id: str, row_indexes: List[int]) -> None:
+        self.pending_batches[batch_id] = row_indexes
+        self._write_record({"batch_id": batch_id, "row_indexes": row_indexes})
+
+    def finish_batch(self, batch_id: str) -> None:
+        self.pending_batches.pop(batch_id, None)
+        self._write_record({"batch_id": batch_id, "finished": True})
+
+    def _load_batch_record(self, record: dict) -> None:
+        batch_id = record["batch_id"]
+        if record.get("finished"):
+            self.pending_batches.pop(batch_id, None)
+        elif "row_indexes" in record:
+            self.pending_batches[batch_id] = record["row_indexes"]
+
+    def close(self) -> None:
+        if self.filehandle is not None:
+            self.filehandle.close()
+            self.filehandle = None
+
+    def _write_record(self, record: dict) -> None:
+        if self.filehandle is None:
+            raise ParallelParrotError(
+                f"checkpoint journal {str(self.path)} is not open"
+            )
+        self.filehandle.write(json.dumps(record, separators=(",", ":")) + "\n")
+        self.filehandle.flush()
+
+
+def _parse_journal_line(line: str) -> Optional[dict]:
+    try:
+        record = json.loads(line)
+    except ValueError:
+        return None
+    if not isinstance(record, dict):
+        return None
+    return record
+
+
+def _ends_with_newline(path: Path) -> bool:
+    with path.open("rb") as f:
+        f.seek(-1, 2)
+        return f.read(1) == b"\n"
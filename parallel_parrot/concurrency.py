@@ -0,0 +1,153 @@
+from collections import deque
+from dataclasses import dataclass
+import math
+import time
+from typing import Callable, Deque, Optional
+
+from .util import logger
+
+
+# the number of recent request latencies used for the percentiles
+LATENCY_WINDOW_SIZE = 1000
+# latency above this multiple of the best observed p50 latency stops the limit from increasing
+LATENCY_TOLERANCE = 2.0
+MULTIPLICATIVE_DECREASE_FACTOR = 0.5
+# the additive increase per window of successful requests (a window is `limit` requests, like a TCP round trip)
+ADDITIVE_INCREASE_STEP = 1
+
+
+class ConcurrencyLimit:
+    """
+    The number of rows which may be in flight at once, which can change while a job is running.
+    The worker pool starts more workers as the limit rises, and retires workers as it falls.
+    """
+
+    def __init__(self, limit: int):
+        self.limit = max(int(limit), 1)
+
+    def set_limit(self, limit: int) -> None:
+        limit = max(int(limit), 1)
+        if limit != self.limit:
+            logger.debug("changing concurrency limit from %s to %s", self.limit, limit)
+        self.limit = limit
+
+
+@dataclass
+class ConcurrencyStats:
+    num_in_flight: int
+    limit: int
+    max_limit: int
+    p50_latency_seconds: Optional[float]
+    p99_latency_seconds: Optional[float]
+
+
+class AdaptiveConcurrencyLimit(ConcurrencyLimit):
+    """
+    An AIMD (additive increase, multiplicative decrease) concurrency limit.
+    - after every window of `limit` successful requests, the limit is raised by ADDITIVE_INCREASE_STEP,
+      as long as the p50 latency stays within LATENCY_TOLERANCE of the best p50 latency seen so far
+    - on a 429, a 5xx, or a timeout, the limit is cut by MULTIPLICATIVE_DECREASE_FACTOR.
+      Requests which were already in flight when the limit was cut do not cut it again.
+    on_update is called with ConcurrencyStats each time the limit is re-evaluated.
+    """
+
+    def __init__(
+        self,
+        limit: int,
+        max_limit: int,
+        min_limit: int = 1,
+        on_update: Optional[Callable[[ConcurrencyStats], None]] = None,
+    ):
+        super().__init__(limit)
+        self.min_limit = max(int(min_limit), 1)
+        self.max_limit = max(int(max_limit), self.min_limit)
+        self.on_update = on_update
+        self.num_in_flight = 0
+        self.latencies: Deque[float] = deque(maxlen=LATENCY_WINDOW_SIZE)
+        self.best_p50_latency_seconds: Optional[float] = None
+        self.num_successes_in_window = 0
+        self.last_decrease_time = 0.0
+
+    def set_max_limit(self, max_limit: int) -> None:
+        self.max_limit = max(int(max_limit), self.min_limit)
+        if self.limit > self.max_limit:
+            self.set_limit(self.max_limit)
+
+    def on_request_start(self) -> float:
+        """
+        returns the start time, to be passed to on_request_end()
+        """
+        self.num_in_flight += 1
+        return time.monotonic()
+
+    def on_request_end(self, start_time: float, is_overloaded: bool) -> None:
+        self.num_in_flight -= 1
+        if is_overloaded:
+            self.on_overload(start_time)
+            return
+        self.latencies.append(time.monotonic() - start_time)
+        self.num_successes_in_window += 1
+        if self.num_successes_in_window >= self.limit:
+            self.num_successes_in_window = 0
+            self._additive_increase()
+
+    def on_overload(self, start_time: float) -> None:
+        """
+        called for every 429, 5xx or timeout - including the ones which are retried
+        """
+        if start_time < self.last_decrease_time:
+            # the limit was already cut after this request started
+            return
+        self.last_decrease_time = time.monotonic()
+        self.num_successes_in_window = 0
+        self.set_limit(
+            max(
+                math.floor(self.limit * MULTIPLICATIVE_DECREASE_FACTOR),
+                self.min_limit,
+            )
+        )
+        self._notify(self.get_stats())
+
+    def get_stats(self) -> ConcurrencyStats:
+        sorted_latencies = sorted(self.latencies)
+        return ConcurrencyStats(
+            num_in_flight=self.num_in_flight,
+            limit=self.limit,
+            max_limit=self.max_limit,
+            p50_latency_seconds=_percentile(sorted_latencies, 0.5),
+            p99_latency_seconds=_percentile(sorted_latencies, 0.99),
+        )
+
+    def _additive_increase(self) -> None:
+        stats = self.get_stats()
+        p50_latency_seconds = stats.p50_latency_seconds
+        if p50_latency_seconds is not None:
+            if (
+                self.best_p50_latency_seconds is None
+                or p50_latency_seconds < self.best_p50_latency_seconds
+            ):
+                self.best_p50_latency_seconds = p50_latency_seconds
+            is_latency_healthy = (
+                p50_latency_seconds <= self.best_p50_latency_seconds * LATENCY_TOLERANCE
+            )
+        else:
+            is_latency_healthy = True
+        if is_latency_healthy and self.limit < self.max_limit:
+            self.set_limit(min(self.limit + ADDITIVE_INCREASE_STEP, self.max_limit))
+            stats.limit = self.limit
+        self._notify(stats)
+
+    def _notify(self, stats: ConcurrencyStats) -> None:
+        if self.on_update is None:
+            return
+        try:
+            self.on_update(stats)
+        except Exception as e:
+            logger.warning(f"Error in concurrency on_update callback: {e=}")
+
+
+def _percentile(sorted_values: list, fraction: float) -> Optional[float]:
+    if len(sorted_values) == 0:
+        return None
+    index = min(math.ceil(fraction * len(sorted_values)) - 1, len(sorted_values) - 1)
+    return sorted_values[max(index, 0)]
@@ -4,36 +4,52 @@ except ImportError:
     pass
 
 
-from typing import List, Union
+from typing import AsyncIterable, AsyncIterator, Iterable, List, Optional, Tuple, Union
 
 from .openai_data_interface import (
+    parallel_openai_chat_completion_stream,
     parallel_openai_chat_completion_dictlist,
     parallel_openai_chat_completion_pandas,
+    parallel_openai_chat_completion_arrow,
     parallel_openai_chat_completion_exploding_function_dictlist,
     parallel_openai_chat_completion_exploding_function_pandas,
+    parallel_openai_chat_completion_exploding_function_arrow,
 )
+from .openai_client import OpenAIClient
 from .types import LLMConfig, OpenAIChatCompletionConfig
+from .util_arrow import ArrowLike, is_arrow_like
 from .util_pandas import is_pandas_dataframe
 
 
 async def parallel_text_generation(
     config: LLMConfig,
-    input_data: Union[List[dict], "pd.DataFrame"],
+    input_data: Union[List[dict], "pd.DataFrame", ArrowLike],
     prompt_template: str,
     output_key: str,
+    checkpoint_path: Optional[str] = None,
+    client: Optional[OpenAIClient] = None,
+    new_columns_only: bool = False,
 ):
     """
     This function executes text generation/completion using a LLM.
 
     It does so by:
-    - taking in a dataframe or list of dictionaries
+    - taking in a dataframe (pandas, polars, or a pyarrow Table or RecordBatch) or list of dictionaries
     - applying the python prompt template to each row.  Column names are used as the variable names in the template.
     - calling the LLM API with the prompt for each row
-    - appending the output to the input dataframe or list of dictionaries using the output_key
+    - appending the output to the input dataframe or list of dictionaries using the output_key.
+      The output is of the same type as the input.
 
     Note:
     - If the LLM generates multiple outputs (n > 1 for OpenAI), the output may have more rows than the input.
     - If no output is generated, then None or math.nan is returned.
+    - If checkpoint_path is given, completed rows are appended to that journal file as they finish.
+      Calling again with the same checkpoint_path (and inputs) only sends the rows which did not complete.
+    - If client (a pp.OpenAIClient) is given, its connection pool is reused instead of opening a new one.
+    - If new_columns_only is True and input_data is a dataframe, only the generated columns are returned,
+      indexed by the index of the input row of each output row - so the input is not copied.
+      Use input_data.join(output) to combine them.
+      For Arrow and polars inputs, the position of the input row is in an "input_row_index" column instead.
     """
     if not isinstance(config, OpenAIChatCompletionConfig):
         raise Exception("Only OpenAIChatCompletionConfig is supported for now")
@@ -43,6 +59,8 @@ async def parallel_text_generation(
             input_list=input_data,
             prompt_template=prompt_template,
             output_key=output_key,
+            checkpoint_path=checkpoint_path,
+            client=client,
         )
     elif is_pandas_dataframe(input_data):
         return await parallel_openai_chat_completion_pandas(
@@ -50,24 +68,40 @@ async def parallel_text_generation(
             input_df=input_data,
             prompt_template=prompt_template,
             output_key=output_key,
+            checkpoint_path=checkpoint_path,
+            client=client,
+            new_columns_only=new_columns_only,
+        )
+    elif is_arrow_like(input_data):
+        return await parallel_openai_chat_completion_arrow(
+            config=config,
+            input_data=input_data,
+            prompt_template=prompt_template,
+            output_key=output_key,
+            checkpoint_path=checkpoint_path,
+            client=client,
+            new_columns_only=new_columns_only,
         )
     else:
         raise Exception(
-            "Only lists of dictionaries and pd.DataFrame are supported for now"
+            "Only lists of dictionaries, dataframes and Arrow tables are supported for now"
         )
 
 
 async def parallel_data_generation(
     config: LLMConfig,
-    input_data: Union[List[dict], "pd.DataFrame"],
+    input_data: Union[List[dict], "pd.DataFrame", ArrowLike],
     prompt_template: str,
     output_key_names: List[str],
+    checkpoint_path: Optional[str] = None,
+    client: Optional[OpenAIClient] = None,
+    new_columns_only: bool = False,
 ):
     """
     This function uses an LLM to generate structured data.
 
     It does so by:
-    - taking in a dataframe or list of dictionaries
+    - taking in a dataframe (pandas, polars, or a pyarrow Table or RecordBatch) or list of dictionaries
     - applying the python prompt template to each row.  Column names are used as the variable names in the template.
     - generating a modified prompt / API call to specify that we want a list of objects,
       with each object containing values for each of the output_key_names.
@@ -77,6 +111,13 @@ async def parallel_data_generation(
 
     Note:
     - If no output is generated, then None or math.nan is returned.
+    - If checkpoint_path is given, completed rows are appended to that journal file as they finish.
+      Calling again with the same checkpoint_path (and inputs) only sends the rows which did not complete.
+    - If client (a pp.OpenAIClient) is given, its connection pool is reused instead of opening a new one.
+    - If new_columns_only is True and input_data is a dataframe, only the generated columns are returned,
+      indexed by the index of the input row of each output row - so the input is not copied.
+      Use input_data.join(output) to combine them.
+      For Arrow and polars inputs, the position of the input row is in an "input_row_index" column instead.
     """
     if not isinstance(config, OpenAIChatCompletionConfig):
         raise Exception("Only OpenAIChatCompletionConfig is supported for now")
@@ -86,6 +127,8 @@ async def parallel_data_generation(
             input_list=input_data,
             prompt_template=prompt_template,
             output_key_names=output_key_names,
+            checkpoint_path=checkpoint_path,
+            client=client,
         )
     elif is_pandas_dataframe(input_data):
         return await parallel_openai_chat_completion_exploding_function_pandas(
@@ -93,8 +136,74 @@ async def parallel_data_generation(
             input_df=input_data,
             prompt_template=prompt_template,
             output_key_names=output_key_names,
+            checkpoint_path=checkpoint_path,
+            client=client,
+            new_columns_only=new_columns_only,
+        )
+    elif is_arrow_like(input_data):
+        return await parallel_openai_chat_completion_exploding_function_arrow(
+            config=config,
+            input_data=input_data,
+            prompt_template=prompt_template,
+            output_key_names=output_key_names,
+            checkpoint_path=checkpoint_path,
+            client=client,
+            new_columns_only=new_columns_only,
         )
     else:
         raise Exception(
-            "Only lists of dictionaries and pd.DataFrame are supported for now"
+            "Only lists of dictionaries, dataframes and Arrow tables are supported for now"
         )
+
+
+async def parallel_text_generation_stream(
+    config: LLMConfig,
+    input_data: Union[Iterable[dict], AsyncIterable[dict], "pd.DataFrame", ArrowLike],
+    prompt_template: str,
+    client: Optional[OpenAIClient] = None,
+) -> AsyncIterator[Tuple[int, Union[None, str, list], dict]]:
+    """
+    A streaming variant of parallel_text_generation() for inputs which are too large to hold in memory.
+
+    - input_data may be a dataframe (pandas, polars, or a pyarrow Table or RecordBatch),
+      or any iterable or async iterable of dictionaries.  Rows are read lazily.
+    - yields (row_index, output, usage_stats) tuples as each row completes.  These are not in input order.
+    - row_index is the position of the row in input_data.
+    """
+    if not isinstance(config, OpenAIChatCompletionConfig):
+        raise Exception("Only OpenAIChatCompletionConfig is supported for now")
+    async for result in parallel_openai_chat_completion_stream(
+        config=config,
+        input_rows=input_data,
+        prompt_template=prompt_template,
+        function_output_key_names=None,
+        client=client,
+    ):
+        yield result
+
+
+async def parallel_data_generation_stream(
+    config: LLMConfig,
+    input_data: Union[Iterable[dict], AsyncIterable[dict], "pd.DataFrame", ArrowLike],
+    prompt_template: str,
+    output_key_names: List[str],
+    client: Optional[OpenAIClient] = None,
+) -> AsyncIterator[Tuple[int, Union[None, list], dict]]:
+    """
+    A streaming variant of parallel_data_generation() for inputs which are too large to hold in memory.
+
+    - input_data may be a dataframe (pandas, polars, or a pyarrow Table or RecordBatch),
+      or any iterable or async iterable of dictionaries.  Rows are read lazily.
+    - yields (row_index, output, usage_stats) tuples as each row completes.  These are not in input order.
+    - output is the list of generated dictionaries (with output_key_names as keys) for that row, or None.
+    """
+    if not isinstance(config, OpenAIChatCompletionConfig):
+        raise Exception("Only OpenAIChatCompletionConfig is supported for now")
+    async for result in parallel_openai_chat_completion_stream(
+        config=config,
+        input_rows=input_data,
+        prompt_template=prompt_template,
+        function_output_key_names=output_key_names,
+        client=client,
+    ):
+        yield result
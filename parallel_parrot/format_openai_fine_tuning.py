@@ -5,17 +5,42 @@ except ImportError:
 else:
     pandas_installed = True
 
+from collections import deque
+from concurrent.futures import Executor, Future, ProcessPoolExecutor
+from functools import partial
 import json
+import os
 from pathlib import Path
-import tiktoken
-from typing import List, Optional, Union
+from typing import (
+    IO,
+    Any,
+    Callable,
+    Deque,
+    Iterable,
+    Iterator,
+    List,
+    Optional,
+    Tuple,
+    Union,
+)
 
+from .openai_util import (
+    TOKENS_PER_MESSAGE,
+    TOKENS_PER_REPLY,
+    encode_tokens_batch,
+    get_encoding_for_model,
+)
 from .util import logger
 from .util_pandas import is_pandas_dataframe, pandas_row_reader
 
 
 # https://platform.openai.com/docs/guides/fine-tuning/token-limits
 FINE_TUNING_MAX_TOKENS = 4096
+# https://platform.openai.com/docs/api-reference/files/create
+FINE_TUNING_MAX_FILE_BYTES = 512 * 1024 * 1024
+# the number of rows which are tokenized and serialized together, by one process
+TOKEN_COUNT_BATCH_SIZE = 1000
+OUTPUT_FILE_BUFFER_BYTES = 1024 * 1024
 
 
 def write_openai_fine_tuning_jsonl(
@@ -25,6 +50,11 @@ def write_openai_fine_tuning_jsonl(
     system_message: Optional[str],
     model: str,
     output_file_prefix: Union[str, Path],
+    max_tokens_per_example: int = FINE_TUNING_MAX_TOKENS,
+    max_bytes_per_file: Optional[int] = FINE_TUNING_MAX_FILE_BYTES,
+    max_examples_per_file: Optional[int] = None,
+    max_tokens_per_file: Optional[int] = None,
+    num_processes: Optional[int] = 1,
 ) -> List[str]:
     """
     Take a list of dictionaries or a pandas dataframe and generate JSONL data which
@@ -35,52 +65,39 @@ def write_openai_fine_tuning_jsonl(
     - system_message: an optional message to be sent to the assistant before the prompt
     - model: the model to use for token counting
     - output_file_prefix: the prefix for the output file(s) to write to, e.g. "/tmp/fine_tuning"
+    - max_tokens_per_example: longer examples are truncated - first the end of the prompt, then the end of the completion
+    - max_bytes_per_file, max_examples_per_file, max_tokens_per_file: a new file is started before any of these is exceeded
+    - num_processes: the number of processes which tokenize and serialize the examples (default: 1, in this process).
+      None uses one process per CPU.
     """
-    jsonl_generator = openai_fine_tuning_jsonl_generator(
+    jsonl_chunks = iter_openai_fine_tuning_jsonl_chunks(
         input_data=input_data,
         prompt_key=prompt_key,
         completion_key=completion_key,
         system_message=system_message,
         model=model,
+        max_tokens_per_example=max_tokens_per_example,
+        num_processes=num_processes,
     )
     output_file_prefix_path = Path(output_file_prefix).resolve()
     output_file_prefix_path.parent.mkdir(parents=True, exist_ok=True)
-    current_num_tokens = 0
-    total_billable_num_tokens = 0
-    file_index = 1
-    current_output_file_path = _make_jsonl_path(output_file_prefix_path, file_index)
-    current_open_filehandle = current_output_file_path.open("w")
-    output_file_paths = []
+    shard_writer = _JsonlShardWriter(
+        output_file_prefix_path,
+        max_bytes_per_file=max_bytes_per_file,
+        max_examples_per_file=max_examples_per_file,
+        max_tokens_per_file=max_tokens_per_file,
+    )
     try:
-        for line, num_tokens in jsonl_generator:
-            if num_tokens > FINE_TUNING_MAX_TOKENS:
-                logger.warn(
-                    f"example line too long, will be truncated {num_tokens=} {line=}"
-                )
-                num_tokens = FINE_TUNING_MAX_TOKENS
-            if current_num_tokens + num_tokens > FINE_TUNING_MAX_TOKENS:
-                current_open_filehandle.close()
-                output_file_paths.append(current_output_file_path)
-                logger.info(
-                    f"wrote {current_num_tokens} tokens to {str(current_output_file_path)}"
-                )
-                file_index += 1
-                current_output_file_path = _make_jsonl_path(
-                    output_file_prefix_path, file_index
-                )
-                current_open_filehandle = current_output_file_path.open("w")
-                current_num_tokens = 0
-            current_open_filehandle.write(line)
-            current_num_tokens += num_tokens
-            total_billable_num_tokens += num_tokens
+        for lines in jsonl_chunks:
+            shard_writer.write_lines(lines)
     finally:
-        current_open_filehandle.close()
-        output_file_paths.append(current_output_file_path)
-    logger.info(f"wrote {current_num_tokens} tokens to {str(current_output_file_path)}")
+        shard_writer.close()
     logger.info(
-        f"openai will charge for {total_billable_num_tokens=} * <number of epochs>"
+        f"openai will charge for {shard_writer.total_billable_num_tokens=} * <number of epochs>"
     )
-    return [str(output_file_path) for output_file_path in output_file_paths]
+    return [
+        str(output_file_path) for output_file_path in shard_writer.output_file_paths
+    ]
 
 
 def openai_fine_tuning_jsonl_generator(
@@ -89,22 +106,106 @@ def openai_fine_tuning_jsonl_generator(
     completion_key: str,
     system_message: Optional[str],
     model: str,
-):
+    max_tokens_per_example: int = FINE_TUNING_MAX_TOKENS,
+    num_processes: Optional[int] = 1,
+) -> Iterator[Tuple[str, int]]:
+    """
+    yields (line, num_tokens) for each row of the input_data, in order
+    """
+    for lines in iter_openai_fine_tuning_jsonl_chunks(
+        input_data=input_data,
+        prompt_key=prompt_key,
+        completion_key=completion_key,
+        system_message=system_message,
+        model=model,
+        max_tokens_per_example=max_tokens_per_example,
+        num_processes=num_processes,
+    ):
+        yield from lines
+
+
+def iter_openai_fine_tuning_jsonl_chunks(
+    input_data: Union[List[dict], "pd.DataFrame"],
+    prompt_key: str,
+    completion_key: str,
+    system_message: Optional[str],
+    model: str,
+    max_tokens_per_example: int = FINE_TUNING_MAX_TOKENS,
+    num_processes: Optional[int] = 1,
+) -> Iterator[List[Tuple[str, int]]]:
+    """
+    yields lists of (line, num_tokens), for chunks of TOKEN_COUNT_BATCH_SIZE rows, in order.
+    The chunks are tokenized and serialized by a pool of num_processes processes.
+    """
     if is_pandas_dataframe(input_data):
-        reader = pandas_row_reader(input_data)
+        reader = pandas_row_reader(input_data, columns=[prompt_key, completion_key])
     elif isinstance(input_data, list):
         reader = _dictlist_reader(input_data)
     else:
         raise Exception(f"Invalid {type(input_data)=}")
+    # only the prompt and completion are sent to the other processes
+    rows = (
+        (input_dict[prompt_key], input_dict[completion_key]) for input_dict in reader
+    )
+    chunks = _iter_chunks(rows, TOKEN_COUNT_BATCH_SIZE)
+    format_chunk = partial(
+        format_openai_fine_tuning_chunk,
+        system_message=system_message,
+        model=model,
+        max_tokens_per_example=max_tokens_per_example,
+    )
+    if num_processes is None:
+        num_processes = os.cpu_count() or 1
+    if num_processes <= 1 or len(input_data) <= TOKEN_COUNT_BATCH_SIZE:
+        # not worth starting the processes
+        for chunk in chunks:
+            yield format_chunk(chunk)
+        return
+    with ProcessPoolExecutor(max_workers=num_processes) as executor:
+        yield from _iter_map_bounded(
+            executor,
+            format_chunk,
+            chunks,
+            # keep every process busy, without reading all of the input into memory
+            max_pending=2 * num_processes,
+        )
+
+
+def format_openai_fine_tuning_chunk(
+    chunk: List[Tuple[Any, Any]],
+    system_message: Optional[str],
+    model: str,
+    max_tokens_per_example: int,
+) -> List[Tuple[str, int]]:
+    """
+    returns (line, num_tokens) for each (prompt, completion) in the chunk,
+    truncating the examples which are longer than max_tokens_per_example
+    """
     # use the token configuration for models that can be fine-tuned
     # https://github.com/openai/openai-cookbook/blob/main/examples/How_to_count_tokens_with_tiktoken.ipynb
-    tokens_per_message = 3
-    encoding = tiktoken.encoding_for_model(model)
-    for input_dict in reader:
-        prompt = input_dict[prompt_key]
-        completion = input_dict[completion_key]
-        num_tokens = tokens_per_message
-        num_tokens += 3  # every reply is primed with <|start|>assistant<|message|>
+    num_overhead_tokens = TOKENS_PER_MESSAGE + TOKENS_PER_REPLY
+    if system_message:
+        num_overhead_tokens += len(encode_tokens_batch([system_message], model)[0])
+    # one batch of prompts and completions per chunk, so that they are encoded in parallel
+    texts = []
+    for prompt, completion in chunk:
+        texts.append(prompt)
+        texts.append(completion)
+    text_tokens = encode_tokens_batch(texts, model)
+    lines = []
+    for row_index, (prompt, completion) in enumerate(chunk):
+        prompt_tokens = text_tokens[2 * row_index]
+        completion_tokens = text_tokens[2 * row_index + 1]
+        num_tokens = num_overhead_tokens + len(prompt_tokens) + len(completion_tokens)
+        if num_tokens > max_tokens_per_example:
+            logger.warning(f"truncating example which is too long {num_tokens=}")
+            (prompt, completion, num_tokens) = _truncate_example(
+                prompt_tokens,
+                completion_tokens,
+                num_tokens - max_tokens_per_example,
+                model,
+            )
+            num_tokens += num_overhead_tokens
         messages = []
         if system_message:
             messages.append(
@@ -113,26 +214,145 @@ def openai_fine_tuning_jsonl_generator(
                     "content": system_message,
                 }
             )
-            num_tokens += len(encoding.encode(system_message))
         messages.append(
             {
                 "role": "user",
                 "content": prompt,
             }
         )
-        num_tokens += len(encoding.encode(prompt))
         messages.append(
             {
                 "role": "assistant",
                 "content": completion,
             }
         )
-        num_tokens += len(encoding.encode(completion))
         data = {
             "messages": messages,
         }
         line = json.dumps(data, separators=(",", ":")) + "\n"
-        yield (line, num_tokens)
+        lines.append((line, num_tokens))
+    return lines
+
+
+def _truncate_example(
+    prompt_tokens: List[int],
+    completion_tokens: List[int],
+    tokens_to_remove: int,
+    model: str,
+) -> Tuple[str, str, int]:
+    """
+    returns the truncated (prompt, completion, num_tokens)
+    """
+    num_prompt_tokens = max(len(prompt_tokens) - tokens_to_remove, 0)
+    tokens_to_remove -= len(prompt_tokens) - num_prompt_tokens
+    num_completion_tokens = max(len(completion_tokens) - tokens_to_remove, 0)
+    encoding = get_encoding_for_model(model)
+    return (
+        encoding.decode(prompt_tokens[:num_prompt_tokens]),
+        encoding.decode(completion_tokens[:num_completion_tokens]),
+        num_prompt_tokens + num_completion_tokens,
+    )
+
+
+class _JsonlShardWriter:
+    """
+    writes lines to numbered files, starting a new file before any of the limits is exceeded
+    """
+
+    def __init__(
+        self,
+        output_file_prefix_path: Path,
+        max_bytes_per_file: Optional[int],
+        max_examples_per_file: Optional[int],
+        max_tokens_per_file: Optional[int],
+    ):
+        self.output_file_prefix_path = output_file_prefix_path
+        self.max_bytes_per_file = max_bytes_per_file
+        self.max_examples_per_file = max_examples_per_file
+        self.max_tokens_per_file = max_tokens_per_file
+        self.output_file_paths: List[Path] = []
+        self.total_billable_num_tokens = 0
+        self._open_next_file()
+
+    def write_lines(self, lines: List[Tuple[str, int]]) -> None:
+        pending_lines: List[str] = []
+        for line, num_tokens in lines:
+            # json.dumps escapes non-ASCII characters, so the length is the number of bytes
+            num_bytes = len(line)
+            if self.current_num_examples > 0 and self._would_exceed_limits(
+                num_bytes, num_tokens
+            ):
+                self.current_filehandle.writelines(pending_lines)
+                pending_lines = []
+                self._close_current_file()
+                self._open_next_file()
+            pending_lines.append(line)
+            self.current_num_bytes += num_bytes
+            self.current_num_examples += 1
+            self.current_num_tokens += num_tokens
+            self.total_billable_num_tokens += num_tokens
+        self.current_filehandle.writelines(pending_lines)
+
+    def close(self) -> None:
+        self._close_current_file()
+
+    def _would_exceed_limits(self, num_bytes: int, num_tokens: int) -> bool:
+        return (
+            _exceeds(self.current_num_bytes + num_bytes, self.max_bytes_per_file)
+            or _exceeds(self.current_num_examples + 1, self.max_examples_per_file)
+            or _exceeds(self.current_num_tokens + num_tokens, self.max_tokens_per_file)
+        )
+
+    def _open_next_file(self) -> None:
+        self.current_output_file_path = _make_jsonl_path(
+            self.output_file_prefix_path, len(self.output_file_paths) + 1
+        )
+        self.output_file_paths.append(self.current_output_file_path)
+        self.current_filehandle: IO = self.current_output_file_path.open(
+            "w", encoding="utf-8", buffering=OUTPUT_FILE_BUFFER_BYTES
+        )
+        self.current_num_bytes = 0
+        self.current_num_examples = 0
+        self.current_num_tokens = 0
+
+    def _close_current_file(self) -> None:
+        self.current_filehandle.close()
+        logger.info(
+            f"wrote {self.current_num_examples} examples with {self.current_num_tokens} tokens to {str(self.current_output_file_path)}"
+        )
+
+
+def _exceeds(value: int, limit: Optional[int]) -> bool:
+    return limit is not None and value > limit
+
+
+def _iter_map_bounded(
+    executor: Executor,
+    fn: Callable,
+    iterable: Iterable,
+    max_pending: int,
+) -> Iterator:
+    """
+    like executor.map(), but only reads ahead max_pending items of the iterable
+    """
+    pending: Deque[Future] = deque()
+    for item in iterable:
+        pending.append(executor.submit(fn, item))
+        if len(pending) >= max_pending:
+            yield pending.popleft().result()
+    while len(pending) > 0:
+        yield pending.popleft().result()
+
+
+def _iter_chunks(iterable: Iterable, chunk_size: int) -> Iterator[list]:
+    chunk = []
+    for item in iterable:
+        chunk.append(item)
+        if len(chunk) >= chunk_size:
+            yield chunk
+            chunk = []
+    if len(chunk) > 0:
+        yield chunk
 
 
 def _dictlist_reader(input_dictlist: List[dict]):
@@ -0,0 +1,286 @@
+try:
+    import prometheus_client  # type: ignore
+except ImportError:
+    prometheus_client = None
+try:
+    from opentelemetry import trace as otel_trace  # type: ignore
+except ImportError:
+    otel_trace = None
+
+from contextlib import contextmanager, nullcontext
+import time
+from typing import Any, ContextManager, Dict, Iterator, Optional
+
+from .types import ParallelParrotError
+
+
+class Instrumentation:
+    """
+    Hooks into the request pipeline, for metrics and tracing.
+
+        class MyInstrumentation(pp.Instrumentation):
+            def on_request(self, url, status, duration_seconds):
+                ...
+
+        async with pp.OpenAIClient(instrumentation=MyInstrumentation()) as client:
+            await pp.parallel_text_generation(..., client=client)
+
+    Every hook is called once the event is over, with its duration.
+    The hooks of a request (its ratelimit wait, attempts and bytes, and on_request()) are called within its request_context().
+    All hooks are no-ops, so a subclass only overrides the ones it needs.
+    Without an instrumentation (the default), nothing is timed or counted at all.
+    """
+
+    def request_context(self, url: str) -> ContextManager[Any]:
+        """
+        entered when a chat completion request starts waiting for the ratelimiter, and exited after on_request().
+        e.g. for the span of the request, which is the parent of the spans of its hooks
+        """
+        return nullcontext()
+
+    def on_queue_wait(self, wait_seconds: float) -> None:
+        """
+        a row waited wait_seconds for a free worker
+        """
+
+    def on_ratelimit_wait(self, wait_seconds: float) -> None:
+        """
+        a request waited wait_seconds for budget in the client-side ratelimiter, before being sent
+        """
+
+    def on_request(
+        self, url: str, status: Optional[int], duration_seconds: float
+    ) -> None:
+        """
+        a chat completion request finished, including its HTTP retries.
+        status is None if it failed without a response (e.g. a timeout).
+        """
+
+    def on_request_attempt(
+        self, url: str, status: Optional[int], attempt: int, duration_seconds: float
+    ) -> None:
+        """
+        a single HTTP attempt of a request received its response headers, or failed.
+        Attempts after the first (attempt > 1) are retries of 409 / 5xx errors and timeouts.
+        """
+
+    def on_bytes_sent(self, num_bytes: int) -> None:
+        """
+        a chunk of a request body was sent
+        """
+
+    def on_bytes_received(self, num_bytes: int) -> None:
+        """
+        a chunk of a response body was received
+        """
+
+    def on_ratelimit_sleep(
+        self, ratelimit_type: Optional[str], sleep_seconds: float
+    ) -> None:
+        """
+        a request slept for sleep_seconds after a 429, before retrying.
+        sleep_seconds is 0 when it was retried right away with another credential.
+        ratelimit_type is "requests", "tokens" or None (if unknown).
+        """
+
+    def on_request_redo(self, reason: str) -> None:
+        """
+        a request was sent again, because of its response.
+        reason is "truncation" (after a context length error) or "function_call" (after an invalid function call)
+        """
+
+
+class PrometheusInstrumentation(Instrumentation):
+    """
+    Prometheus counters and histograms, from the prometheus_client package (which is installed separately).
+    Metric names are prefixed with namespace (e.g. "parallel_parrot_requests_total").
+    The metrics are registered once, so create a single PrometheusInstrumentation per registry.
+    """
+
+    def __init__(
+        self,
+        registry: Optional["prometheus_client.CollectorRegistry"] = None,
+        namespace: str = "parallel_parrot",
+    ):
+        if prometheus_client is None:
+            raise ParallelParrotError(
+                "PrometheusInstrumentation requires the prometheus_client package"
+            )
+        if registry is None:
+            registry = prometheus_client.REGISTRY
+        metric_kwargs: Dict[str, Any] = {"namespace": namespace, "registry": registry}
+        self.queue_wait_seconds = prometheus_client.Histogram(
+            "queue_wait_seconds", "Time rows waited for a free worker", **metric_kwargs
+        )
+        self.ratelimit_wait_seconds = prometheus_client.Histogram(
+            "ratelimit_wait_seconds",
+            "Time requests waited for client-side ratelimit budget",
+            **metric_kwargs,
+        )
+        self.requests = prometheus_client.Counter(
+            "requests",
+            "Chat completion requests, including their HTTP retries",
+            ["status"],
+            **metric_kwargs,
+        )
+        self.request_duration_seconds = prometheus_client.Histogram(
+            "request_duration_seconds",
+            "Duration of chat completion requests, including their HTTP retries",
+            **metric_kwargs,
+        )
+        self.request_attempts = prometheus_client.Counter(
+            "request_attempts", "HTTP attempts", ["status"], **metric_kwargs
+        )
+        self.request_retries = prometheus_client.Counter(
+            "request_retries", "HTTP attempts after the first", **metric_kwargs
+        )
+        self.request_attempt_duration_seconds = prometheus_client.Histogram(
+            "request_attempt_duration_seconds",
+            "Time to the response headers of HTTP attempts",
+            **metric_kwargs,
+        )
+        self.sent_bytes = prometheus_client.Counter(
+            "sent_bytes", "Bytes of request bodies", **metric_kwargs
+        )
+        self.received_bytes = prometheus_client.Counter(
+            "received_bytes", "Bytes of response bodies", **metric_kwargs
+        )
+        self.ratelimit_sleeps = prometheus_client.Counter(
+            "ratelimit_sleeps",
+            "Requests retried after a 429",
+            ["ratelimit_type"],
+            **metric_kwargs,
+        )
+        self.ratelimit_sleep_seconds = prometheus_client.Counter(
+            "ratelimit_sleep_seconds",
+            "Time slept after 429s",
+            ["ratelimit_type"],
+            **metric_kwargs,
+        )
+        self.request_redos = prometheus_client.Counter(
+            "request_redos", "Requests sent again", ["reason"], **metric_kwargs
+        )
+
+    def on_queue_wait(self, wait_seconds: float) -> None:
+        self.queue_wait_seconds.observe(wait_seconds)
+
+    def on_ratelimit_wait(self, wait_seconds: float) -> None:
+        self.ratelimit_wait_seconds.observe(wait_seconds)
+
+    def on_request(
+        self, url: str, status: Optional[int], duration_seconds: float
+    ) -> None:
+        self.requests.labels(status=_status_label(status)).inc()
+        self.request_duration_seconds.observe(duration_seconds)
+
+    def on_request_attempt(
+        self, url: str, status: Optional[int], attempt: int, duration_seconds: float
+    ) -> None:
+        self.request_attempts.labels(status=_status_label(status)).inc()
+        if attempt > 1:
+            self.request_retries.inc()
+        self.request_attempt_duration_seconds.observe(duration_seconds)
+
+    def on_bytes_sent(self, num_bytes: int) -> None:
+        self.sent_bytes.inc(num_bytes)
+
+    def on_bytes_received(self, num_bytes: int) -> None:
+        self.received_bytes.inc(num_bytes)
+
+    def on_ratelimit_sleep(
+        self, ratelimit_type: Optional[str], sleep_seconds: float
+    ) -> None:
+        ratelimit_type_label = ratelimit_type or "unknown"
+        self.ratelimit_sleeps.labels(ratelimit_type=ratelimit_type_label).inc()
+        self.ratelimit_sleep_seconds.labels(ratelimit_type=ratelimit_type_label).inc(
+            sleep_seconds
+        )
+
+    def on_request_redo(self, reason: str) -> None:
+        self.request_redos.labels(reason=reason).inc()
+
+
+class OpenTelemetryInstrumentation(Instrumentation):
+    """
+    OpenTelemetry spans, from the opentelemetry-api package (which is installed separately).
+    The span of a request is the current span from its start until it is done,
+    so the spans of its ratelimit wait and attempts are its children.
+    Each wait, attempt and ratelimit sleep is a span, which is started and ended after the fact,
+    from its measured duration.  Redos are spans without a duration.
+    Bytes are not traced, since they are not tied to a single span.
+    """
+
+    def __init__(self, tracer: Optional["otel_trace.Tracer"] = None):
+        if otel_trace is None:
+            raise ParallelParrotError(
+                "OpenTelemetryInstrumentation requires the opentelemetry-api package"
+            )
+        if tracer is None:
+            tracer = otel_trace.get_tracer("parallel_parrot")
+        self.tracer = tracer
+
+    def on_queue_wait(self, wait_seconds: float) -> None:
+        self._record_span("parallel_parrot.queue_wait", wait_seconds, {})
+
+    def on_ratelimit_wait(self, wait_seconds: float) -> None:
+        self._record_span("parallel_parrot.ratelimit_wait", wait_seconds, {})
+
+    @contextmanager
+    def request_context(self, url: str) -> Iterator[None]:
+        with self.tracer.start_as_current_span(
+            "parallel_parrot.request", attributes=_http_attributes(url, None)
+        ):
+            yield
+
+    def on_request(
+        self, url: str, status: Optional[int], duration_seconds: float
+    ) -> None:
+        if status is not None:
+            otel_trace.get_current_span().set_attribute(
+                "http.response.status_code", status
+            )
+
+    def on_request_attempt(
+        self, url: str, status: Optional[int], attempt: int, duration_seconds: float
+    ) -> None:
+        attributes = _http_attributes(url, status)
+        attributes["http.resend_count"] = attempt - 1
+        self._record_span(
+            "parallel_parrot.request_attempt", duration_seconds, attributes
+        )
+
+    def on_ratelimit_sleep(
+        self, ratelimit_type: Optional[str], sleep_seconds: float
+    ) -> None:
+        self._record_span(
+            "parallel_parrot.ratelimit_sleep",
+            sleep_seconds,
+            {"parallel_parrot.ratelimit_type": ratelimit_type or "unknown"},
+        )
+
+    def on_request_redo(self, reason: str) -> None:
+        self._record_span(
+            "parallel_parrot.request_redo", 0.0, {"parallel_parrot.reason": reason}
+        )
+
+    def _record_span(
+        self, name: str, duration_seconds: float, attributes: Dict[str, Any]
+    ) -> None:
+        end_time_ns = time.time_ns()
+        start_time_ns = end_time_ns - int(duration_seconds * 1e9)
+        # the child of the current span (if any), e.g. the span of a request
+        span = self.tracer.start_span(
+            name, start_time=start_time_ns, attributes=attributes
+        )
+        span.end(end_time=end_time_ns)
+
+
+def _status_label(status: Optional[int]) -> str:
+    return "error" if status is None else str(status)
+
+
+def _http_attributes(url: str, status: Optional[int]) -> Dict[str, Any]:
+    attributes: Dict[str, Any] = {"http.request.method": "POST", "url.full": url}
+    if status is not None:
+        attributes["http.response.status_code"] = status
+    return attributes
@@ -4,14 +4,16 @@ except ImportError:
     pd = None
 
 import asyncio
+from collections import OrderedDict
 from collections.abc import Callable
+from contextlib import nullcontext
+import hashlib
 
 import logging
-import math
 import time
-from typing import List, Optional, Tuple, Union
+from typing import Any, AsyncIterator, Dict, List, Optional, Set, Tuple, Union
 
-from aiohttp import ClientError, ClientSession, ClientTimeout, TCPConnector
+from aiohttp import ClientError
 from aiohttp_retry import ExponentialRetry, RetryClient, JitterRetry
 
 from .types import (
@@ -20,34 +22,38 @@ from .types import (
     ClientSessionType,
     OpenAIChatCompletionConfig,
 )
-from .util import logger, sum_usage_stats
-from .openai_util import openai_token_truncate
+from .util import LogPreview, logger, sum_usage_stats
+from .openai_util import fit_payload_to_context_window, openai_token_truncate
 from .openai_api_lib import (
+    OPENAI_EMPTY_USAGE_STATS,
+    ChatPrompt,
     OpenAIResponseData,
     prep_openai_function_list_of_objects,
-    create_chat_completion_request_payload,
+    ChatCompletionPayloadBuilder,
     parse_chat_completion_message_and_usage,
     parse_content_length_exceeded_error,
     parse_seconds_from_header,
     parse_json_arguments_from_function_call,
+    estimate_payload_tokens,
+    json_dumps_bytes,
+)
+from .openai_ratelimit import OpenAIRateLimiter
+from .openai_credentials import PooledCredential, create_openai_http_headers
+from .openai_endpoints import OpenAIEndpointRouter
+from .concurrency import AdaptiveConcurrencyLimit, ConcurrencyLimit
+from .response_cache import SQLiteResponseCache, make_payload_cache_key
+from .instrumentation import Instrumentation
+from .request_dump import RequestDumpWriter
+from .openai_client import (
+    MAX_NUM_CONCURRENT_REQUESTS,
+    OpenAIClient,
+    is_overload_status,
+    use_openai_client,
 )
-
-try:
-    import resource
-
-    # maximize the number of concurrent connections for this process
-    rlimit_soft, rlimit_hard = resource.getrlimit(resource.RLIMIT_NOFILE)
-    try:
-        resource.setrlimit(resource.RLIMIT_NOFILE, (rlimit_hard, rlimit_hard))
-    except Exception as e:
-        logger.warning(f"Could not set rlimit: {e=}")
-    rlimit_soft, rlimit_hard = resource.getrlimit(resource.RLIMIT_NOFILE)
-    MAX_NUM_CONCURRENT_REQUESTS = max(120, rlimit_soft - 80)
-except ImportError:
-    MAX_NUM_CONCURRENT_REQUESTS = 120
 
 
-OPENAI_REQUEST_TIMEOUT_SECONDS = 120.0
+# the concurrency while waiting for the ratelimit headers of the first response
+INITIAL_NUM_CONCURRENT_REQUESTS = 8
 MAX_HTTP_RETRIES = 16
 OPENAI_TOTAL_TIMEOUT_SECONDS = 600.0
 RATELIMIT_RETRY_SLEEP_SECONDS = 5
@@ -55,67 +61,265 @@ MAX_NUM_RATELIMIT_RETRIES = 20
 OPENAI_CHAT_COMPLETIONS_URL = "https://api.openai.com/v1/chat/completions"
 OPENAI_FUNCTION_NAME = "f"
 OPENAI_FUNCTION_PARAMETER_NAME = "p"
+# the outputs of the most recently completed prompts, which later rows with the same prompt reuse
+MAX_NUM_RECENT_DEDUPLICATED_OUTPUTS = 10000
+# the unknown context window of a model is only warned about once per process, rather than once per row
+_models_with_unknown_context_window: Set[str] = set()
 
 
-throttle_until_time = 0.0
-
-
-async def single_setup_openai_chat_completion(
+async def iter_openai_chat_completion(
     config: OpenAIChatCompletionConfig,
-    input_row: Union[dict, "pd.Series"],
+    indexed_rows: AsyncIterator[Tuple[int, Union[dict, "pd.Series"]]],
     curried_prompt_template: Callable,
     function_output_key_names: Optional[List[str]],
-) -> Tuple[Union[None, str, list], dict, Optional[str]]:
-    if function_output_key_names is not None:
-        function_name = OPENAI_FUNCTION_NAME
-        parameter_name = OPENAI_FUNCTION_PARAMETER_NAME
-        (
-            functions,
-            function_call,
-            function_system_prompt,
-        ) = prep_openai_function_list_of_objects(
-            function_name=function_name,
-            parameter_name=parameter_name,
-            output_key_names=function_output_key_names,
+    endpoint_router: Optional[OpenAIEndpointRouter] = None,
+    response_cache: Optional[SQLiteResponseCache] = None,
+    openai_client: Optional[OpenAIClient] = None,
+    request_dump: Optional[RequestDumpWriter] = None,
+) -> AsyncIterator[Tuple[int, Union[None, str, list], dict]]:
+    """
+    yield (row_index, model_output, usage) tuples in the order in which the requests complete.
+    Rows are pulled from indexed_rows only as fast as they can be processed, so memory stays bounded.
+
+    The first row is a setup request, which validates the config and reads the ratelimit headers.
+    It is always sent, even if its response is cached.  The other rows start at a conservative concurrency without waiting for it,
+    and the concurrency is raised once the ratelimit headers arrive.
+    If the setup request fails, the whole job fails, and no other results are yielded.
+    """
+    try:
+        first_indexed_row = await indexed_rows.__anext__()
+    except StopAsyncIteration:
+        return
+    first_row_index = first_indexed_row[0]
+    (
+        function_name,
+        parameter_name,
+        functions,
+        function_call,
+        function_system_prompt,
+    ) = prep_function_call_arguments(function_output_key_names)
+    payload_builder = ChatCompletionPayloadBuilder(
+        config=config,
+        functions=functions,
+        function_call=function_call,
+        function_system_prompt=function_system_prompt,
+    )
+    # rows which render to the same prompt share a single request
+    deduplicate_prompts = should_deduplicate_prompts(config)
+    shared_results: Dict[bytes, asyncio.Future] = {}
+    recent_outputs: "OrderedDict[bytes, Any]" = OrderedDict()
+    async with use_openai_client(openai_client) as openai_client:
+        instrumentation = openai_client.instrumentation
+        # the limit cannot rise until the setup response has set the cap
+        concurrency_limit = AdaptiveConcurrencyLimit(
+            INITIAL_NUM_CONCURRENT_REQUESTS,
+            max_limit=INITIAL_NUM_CONCURRENT_REQUESTS,
+            on_update=openai_client.on_concurrency_update,
         )
-    else:
-        function_name = None
-        parameter_name = None
-        functions = None
-        function_call = None
-        function_system_prompt = None
-    async with create_chat_completion_client_session(
-        config, is_setup_request=True
-    ) as client_session:
-        response_data = await do_openai_chat_completion(
-            client_session=client_session,
-            config=config,
-            input_row=input_row,
-            curried_prompt_template=curried_prompt_template,
-            functions=functions,
-            function_call=function_call,
-            function_system_prompt=function_system_prompt,
+        if endpoint_router is None:
+            # the ratelimiters are shared with other jobs in the same ratelimit domain.
+            # Their buckets are created from the headers of the first response.
+            endpoint_router = OpenAIEndpointRouter(config, openai_client.rate_limiters)
+        setup_client_session = create_chat_completion_client_session(
+            openai_client, is_setup_request=True
+        )
+        client_session = create_chat_completion_client_session(
+            openai_client, is_setup_request=False
         )
-    if not response_data.complete:
-        raise ParallelParrotError(f"error in single_setup request: {response_data=}")
-    response_result = response_data.body_from_json
-    response_headers = response_data.headers
-    (model_output, usage) = parse_chat_completion_message_and_usage(
-        response_result,
-        function_name=function_name,
-        parameter_name=parameter_name,
-    )
-    ratelimit_limit_requests = response_headers.get("x-ratelimit-limit-requests")
-    return (model_output, usage, ratelimit_limit_requests)
 
+        async def _complete_prompt(
+            prompt: ChatPrompt, is_setup_request: bool = False
+        ) -> Tuple[Union[None, str, list], dict]:
+            response_data = await _chat_completion_with_ratelimit(
+                client_session=(
+                    setup_client_session if is_setup_request else client_session
+                ),
+                config=config,
+                prompt=prompt,
+                functions=functions,
+                function_call=function_call,
+                function_system_prompt=function_system_prompt,
+                endpoint_router=endpoint_router,
+                response_cache=response_cache,
+                concurrency_limit=concurrency_limit,
+                instrumentation=instrumentation,
+                request_dump=request_dump,
+                payload_builder=payload_builder,
+                # the setup request checks the credentials and reads the ratelimit headers
+                skip_cache_lookup=is_setup_request,
+            )
+            if is_setup_request:
+                if not response_data.complete:
+                    raise ParallelParrotError(
+                        f"error in setup request: {LogPreview(response_data)}"
+                    )
+                ratelimit_limit_requests = response_data.headers.get(
+                    "x-ratelimit-limit-requests"
+                )
+                concurrency_limit.set_max_limit(
+                    get_max_num_concurrent_requests(ratelimit_limit_requests)
+                )
+                concurrency_limit.set_limit(
+                    get_num_concurrent_requests(ratelimit_limit_requests)
+                )
+            return parse_chat_completion_message_and_usage(
+                response_data.body_from_json,
+                function_name=function_name,
+                parameter_name=parameter_name,
+            )
 
-async def parallel_openai_chat_completion(
-    config: OpenAIChatCompletionConfig,
-    input_table: Union[List[dict], "pd.DataFrame"],
-    curried_prompt_template: Callable,
-    function_output_key_names: Optional[List[str]],
-    ratelimit_limit_requests: Optional[str] = None,
-) -> Tuple[list, List[dict]]:
+        async def _process_row(
+            row_index: int, input_row: Union[dict, "pd.Series"]
+        ) -> Tuple[Union[None, str, list], dict]:
+            prompt = curried_prompt_template(input_row)
+            complete_prompt = (
+                _complete_setup_prompt
+                if row_index == first_row_index
+                else _complete_prompt
+            )
+            if deduplicate_prompts:
+                return await complete_prompt_deduplicated(
+                    prompt, shared_results, complete_prompt, recent_outputs
+                )
+            return await complete_prompt(prompt)
+
+        async def _complete_setup_prompt(
+            prompt: ChatPrompt,
+        ) -> Tuple[Union[None, str, list], dict]:
+            return await _complete_prompt(prompt, is_setup_request=True)
+
+        # results which complete before the setup request are held back until it succeeds
+        held_results: Optional[list] = []
+        async for (row_index, (model_output, usage)) in iter_worker_pool(
+            indexed_rows=_chain_indexed_rows(first_indexed_row, indexed_rows),
+            process_row=_process_row,
+            concurrency_limit=concurrency_limit,
+            on_queue_wait=(
+                instrumentation.on_queue_wait if instrumentation is not None else None
+            ),
+        ):
+            if held_results is None:
+                yield (row_index, model_output, usage)
+            elif row_index == first_row_index:
+                yield (row_index, model_output, usage)
+                for held_result in held_results:
+                    yield held_result
+                held_results = None
+            else:
+                held_results.append((row_index, model_output, usage))
+
+
+async def _chain_indexed_rows(
+    first_indexed_row: Tuple[int, Any],
+    indexed_rows: AsyncIterator[Tuple[int, Any]],
+) -> AsyncIterator[Tuple[int, Any]]:
+    yield first_indexed_row
+    async for indexed_row in indexed_rows:
+        yield indexed_row
+
+
+async def iter_worker_pool(
+    indexed_rows: AsyncIterator[Tuple[int, Any]],
+    process_row: Callable,
+    concurrency_limit: ConcurrencyLimit,
+    on_queue_wait: Optional[Callable[[float], None]] = None,
+) -> AsyncIterator[Tuple[int, Any]]:
+    """
+    yield (row_index, await process_row(row_index, row)) in the order in which rows complete.
+    Every worker pulls the next row as soon as its previous row finishes,
+    so a slow request or a ratelimit sleep only occupies a single slot.
+    The concurrency_limit may change while the pool is running.
+    on_queue_wait is called with the seconds each row waited for a free worker.
+    """
+    input_queue: asyncio.Queue = asyncio.Queue(maxsize=1)
+    output_queue: asyncio.Queue = asyncio.Queue(maxsize=concurrency_limit.limit)
+    num_live_workers = 0
+
+    async def _worker():
+        nonlocal num_live_workers
+        try:
+            while True:
+                queued_row = await input_queue.get()
+                if queued_row is None:
+                    # pass the end of input on to the next worker
+                    input_queue.put_nowait(None)
+                    return
+                (row_index, input_row) = _dequeue_row(queued_row, on_queue_wait)
+                result = await process_row(row_index, input_row)
+                await output_queue.put((row_index, result))
+                if num_live_workers > concurrency_limit.limit:
+                    # the limit was lowered, so retire this worker
+                    return
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            await output_queue.put(e)
+        finally:
+            num_live_workers -= 1
+
+    async def _run_pool():
+        nonlocal num_live_workers
+        workers: List[asyncio.Task] = []
+        try:
+            async for indexed_row in indexed_rows:
+                # only start as many workers as there are rows to process
+                if num_live_workers < concurrency_limit.limit:
+                    workers = [worker for worker in workers if not worker.done()]
+                    workers.append(asyncio.create_task(_worker()))
+                    num_live_workers += 1
+                await input_queue.put(_enqueue_row(indexed_row, on_queue_wait))
+            await input_queue.put(None)
+            await gather_workers(workers)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            await output_queue.put(e)
+        else:
+            await output_queue.put(None)
+        finally:
+            for worker in workers:
+                worker.cancel()
+            # let the cancelled workers finish unwinding, before the pool is done
+            await asyncio.gather(*workers, return_exceptions=True)
+
+    pool_task = asyncio.create_task(_run_pool())
+    try:
+        while True:
+            result = await output_queue.get()
+            if result is None:
+                break
+            elif isinstance(result, Exception):
+                raise result
+            yield result
+    finally:
+        if not pool_task.done():
+            pool_task.cancel()
+        await asyncio.gather(pool_task, return_exceptions=True)
+
+
+def _enqueue_row(
+    indexed_row: Tuple[int, Any], on_queue_wait: Optional[Callable[[float], None]]
+):
+    if on_queue_wait is None:
+        return indexed_row
+    return (indexed_row, time.monotonic())
+
+
+def _dequeue_row(
+    queued_row, on_queue_wait: Optional[Callable[[float], None]]
+) -> Tuple[int, Any]:
+    if on_queue_wait is None:
+        return queued_row
+    (indexed_row, queued_time) = queued_row
+    on_queue_wait(time.monotonic() - queued_time)
+    return indexed_row
+
+
+def get_num_concurrent_requests(ratelimit_limit_requests: Optional[str]) -> int:
+    """
+    the starting concurrency once the ratelimit is known.  The adaptive limit may then rise up to
+    get_max_num_concurrent_requests(), or fall in response to 429 / 5xx errors and timeouts.
+    """
     if ratelimit_limit_requests:
         # use half of the available capacity at a time, up until the fileshandle system limit
         # https://platform.openai.com/docs/guides/rate-limits/overview
@@ -123,8 +327,78 @@ async def parallel_openai_chat_completion(
             round(int(ratelimit_limit_requests) / 2), MAX_NUM_CONCURRENT_REQUESTS
         )
     else:
-        num_concurrent_requests = MAX_NUM_CONCURRENT_REQUESTS
-    logger.info(f"using {num_concurrent_requests=}")
+        # servers without ratelimit headers (e.g. vLLM) stay at the initial concurrency,
+        # which the adaptive limit then raises while their latency stays healthy
+        num_concurrent_requests = INITIAL_NUM_CONCURRENT_REQUESTS
+    return max(num_concurrent_requests, 1)
+
+
+def get_max_num_concurrent_requests(ratelimit_limit_requests: Optional[str]) -> int:
+    if ratelimit_limit_requests:
+        # more concurrent requests than the per-minute limit could never be useful
+        return max(
+            min(int(ratelimit_limit_requests), MAX_NUM_CONCURRENT_REQUESTS),
+            1,
+        )
+    return MAX_NUM_CONCURRENT_REQUESTS
+
+
+async def complete_prompt_deduplicated(
+    prompt: ChatPrompt,
+    shared_results: Dict[bytes, asyncio.Future],
+    complete_prompt: Callable,
+    recent_outputs: Optional["OrderedDict[bytes, Any]"] = None,
+) -> Tuple[Union[None, str, list], dict]:
+    """
+    the first row with a given prompt sends the request, and later rows with the same prompt share its result.
+    shared_results only holds the requests in flight, so memory does not grow with the number of unique prompts.
+    recent_outputs is an LRU of the outputs of completed requests,
+    of at most MAX_NUM_RECENT_DEDUPLICATED_OUTPUTS entries.
+    """
+    if isinstance(prompt, str):
+        encoded_prompt = prompt.encode("utf-8")
+    else:
+        encoded_prompt = json_dumps_bytes(prompt)
+    prompt_key = hashlib.blake2b(encoded_prompt, digest_size=16).digest()
+    # only the first row with this prompt is billed
+    deduplicated_usage = dict(OPENAI_EMPTY_USAGE_STATS, deduplicated_rows=1)
+    if recent_outputs is not None and prompt_key in recent_outputs:
+        recent_outputs.move_to_end(prompt_key)
+        return (recent_outputs[prompt_key], deduplicated_usage)
+    shared_result = shared_results.get(prompt_key)
+    if shared_result is not None:
+        (model_output, _) = await shared_result
+        return (model_output, deduplicated_usage)
+    shared_result = asyncio.get_running_loop().create_future()
+    shared_results[prompt_key] = shared_result
+    # the rows waiting on the future hold their own reference to it
+    shared_result.add_done_callback(lambda _: shared_results.pop(prompt_key, None))
+    try:
+        result = await complete_prompt(prompt)
+    except asyncio.CancelledError:
+        shared_result.cancel()
+        raise
+    except Exception as e:
+        shared_result.set_exception(e)
+        # the exception is raised below, so it does not need to be retrieved from the future
+        shared_result.exception()
+        raise
+    shared_result.set_result(result)
+    if recent_outputs is not None:
+        recent_outputs[prompt_key] = result[0]
+        if len(recent_outputs) > MAX_NUM_RECENT_DEDUPLICATED_OUTPUTS:
+            recent_outputs.popitem(last=False)
+    return result
+
+
+def should_deduplicate_prompts(config: OpenAIChatCompletionConfig) -> bool:
+    if config.deduplicate_prompts is not None:
+        return config.deduplicate_prompts
+    # by default, only share outputs between rows when the output is (nearly) deterministic
+    return config.temperature == 0 and (config.n is None or config.n == 1)
+
+
+def prep_function_call_arguments(function_output_key_names: Optional[List[str]]):
     if function_output_key_names is not None:
         function_name = OPENAI_FUNCTION_NAME
         parameter_name = OPENAI_FUNCTION_PARAMETER_NAME
@@ -143,63 +417,59 @@ async def parallel_openai_chat_completion(
         functions = None
         function_call = None
         function_system_prompt = None
-    async with create_chat_completion_client_session(
-        config, is_setup_request=False
-    ) as client_session:
-        num_chunks = math.ceil(len(input_table) / num_concurrent_requests)
-        response_data_list = []
-        for chunk in range(num_chunks):
-            start_index = chunk * num_concurrent_requests
-            end_index = min(start_index + num_concurrent_requests, len(input_table))
-            logger.info(f"processing chunk of data {start_index=} {end_index=}")
-            if isinstance(input_table, list):
-                input_rows = input_table[start_index:end_index]
-            elif isinstance(input_table, pd.DataFrame):
-                input_rows = [
-                    input_table.iloc[i] for i in range(start_index, end_index)
-                ]
-            else:
-                raise ParallelParrotError(f"Unexpected type {type(input_table)=}")
-            tasks = [
-                asyncio.create_task(
-                    _chat_completion_with_ratelimit(
-                        client_session=client_session,
-                        config=config,
-                        input_row=input_row,
-                        curried_prompt_template=curried_prompt_template,
-                        functions=functions,
-                        function_call=function_call,
-                        function_system_prompt=function_system_prompt,
-                    )
-                )
-                for input_row in input_rows
-            ]
-            response_data_list += await asyncio.gather(*tasks)
-    result_tuples = [
-        parse_chat_completion_message_and_usage(
-            response_data.body_from_json,
-            function_name=function_name,
-            parameter_name=parameter_name,
-        )
-        for response_data in response_data_list
-    ]
-    unzipped_results = list(zip(*result_tuples))
-    model_outputs = list(unzipped_results[0])
-    usage_stats_list = list(unzipped_results[1])
-    return (model_outputs, usage_stats_list)
+    return (
+        function_name,
+        parameter_name,
+        functions,
+        function_call,
+        function_system_prompt,
+    )
 
 
-def create_chat_completion_client_session(
+async def gather_workers(workers: List[asyncio.Task]) -> None:
+    """
+    wait for all workers to finish, cancelling the remaining workers if any of them fails
+    """
+    try:
+        await asyncio.gather(*workers)
+    except BaseException:
+        for worker in workers:
+            worker.cancel()
+        await asyncio.gather(*workers, return_exceptions=True)
+        raise
+
+
+def open_request_dump(
     config: OpenAIChatCompletionConfig,
+) -> Optional[RequestDumpWriter]:
+    if config.request_dump_path is None:
+        return None
+    return RequestDumpWriter(
+        path=config.request_dump_path,
+        sample_rate=config.request_dump_sample_rate,
+    )
+
+
+def open_response_cache(
+    config: OpenAIChatCompletionConfig,
+) -> Optional[SQLiteResponseCache]:
+    if config.response_cache_path is None:
+        return None
+    return SQLiteResponseCache(
+        path=config.response_cache_path,
+        ttl_seconds=config.response_cache_ttl_seconds,
+        max_bytes=config.response_cache_max_bytes,
+    )
+
+
+def create_chat_completion_client_session(
+    openai_client: OpenAIClient,
     is_setup_request: bool,
 ) -> ClientSessionType:
-    headers = create_openai_http_headers(config)
-    client_timeout = ClientTimeout(total=OPENAI_REQUEST_TIMEOUT_SECONDS)
-    client_session = ClientSession(
-        connector=TCPConnector(limit=MAX_NUM_CONCURRENT_REQUESTS),
-        headers=headers,
-        timeout=client_timeout,
-    )
+    """
+    wrap the shared connection pool with the retry policy for this phase of the job.
+    The returned RetryClient does not own the pool, so it must not be closed.
+    """
     # Retry error codes which do not indicate a problem with the request itself. Using jitter to avoid thundering herd.
     # The 409 code (openai.error.TryAgain) is returned when the model needs to warm up.
     # https://github.com/openai/openai-python/blob/1be14ee34a0f8e42d3f9aa5451aa4cb161f1781f/openai/api_requestor.py#L401
@@ -229,7 +499,7 @@ def create_chat_completion_client_session(
             retry_all_server_errors=False,
         )
     retry_client_session = RetryClient(
-        client_session=client_session, retry_options=retry_options
+        client_session=openai_client.session, retry_options=retry_options
     )
     return retry_client_session
 
@@ -237,100 +507,221 @@ def create_chat_completion_client_session(
 async def _chat_completion_with_ratelimit(
     client_session: ClientSessionType,
     config: OpenAIChatCompletionConfig,
-    input_row: Union[dict, "pd.Series"],
-    curried_prompt_template: Callable,
+    prompt: ChatPrompt,
     functions: Optional[List[dict]] = None,
     function_call: Optional[dict] = None,
     function_system_prompt: Optional[str] = None,
+    endpoint_router: Optional[OpenAIEndpointRouter] = None,
+    response_cache: Optional[SQLiteResponseCache] = None,
+    concurrency_limit: Optional[AdaptiveConcurrencyLimit] = None,
     num_ratelimit_retries: int = 0,
+    instrumentation: Optional[Instrumentation] = None,
+    request_dump: Optional[RequestDumpWriter] = None,
+    payload_builder: Optional[ChatCompletionPayloadBuilder] = None,
+    skip_cache_lookup: bool = False,
 ) -> OpenAIResponseData:
-    global throttle_until_time
-    response_data = await do_openai_chat_completion(
-        client_session=client_session,
-        config=config,
-        input_row=input_row,
-        curried_prompt_template=curried_prompt_template,
-        functions=functions,
-        function_call=function_call,
-        function_system_prompt=function_system_prompt,
-        log_level=logging.DEBUG,
-    )
-    if response_data.status == 429:
-        if "exceeded your current quota" in response_data.reason:
-            raise ParallelParrotError(
-                f"{response_data.status=} {response_data.reason=}"
+    if endpoint_router is None:
+        credential = None
+        response_data = await do_openai_chat_completion(
+            client_session=client_session,
+            config=config,
+            prompt=prompt,
+            functions=functions,
+            function_call=function_call,
+            function_system_prompt=function_system_prompt,
+            log_level=logging.DEBUG,
+            response_cache=response_cache,
+            concurrency_limit=concurrency_limit,
+            instrumentation=instrumentation,
+            request_dump=request_dump,
+            payload_builder=payload_builder,
+            skip_cache_lookup=skip_cache_lookup,
+        )
+    else:
+        # the endpoint is only held for the request itself, not for any ratelimit sleep
+        endpoint = await endpoint_router.acquire()
+        try:
+            credential = endpoint.credential_pool.choose()
+            response_data = await do_openai_chat_completion(
+                client_session=client_session,
+                config=config,
+                prompt=prompt,
+                functions=functions,
+                function_call=function_call,
+                function_system_prompt=function_system_prompt,
+                log_level=logging.DEBUG,
+                credential=credential,
+                response_cache=response_cache,
+                concurrency_limit=concurrency_limit,
+                url=endpoint.chat_completions_url,
+                instrumentation=instrumentation,
+                request_dump=request_dump,
+                payload_builder=payload_builder,
+                skip_cache_lookup=skip_cache_lookup,
             )
+        finally:
+            await endpoint_router.release(endpoint)
+    is_unauthorized = response_data.status == 401
+    if is_unauthorized or is_quota_exceeded(response_data):
+        if endpoint_router is not None and credential is not None:
+            endpoint.credential_pool.disable(
+                credential, f"{response_data.status=} {response_data.reason=}"
+            )
+            if endpoint_router.has_enabled_endpoints():
+                # fail over to the other credentials
+                return await _chat_completion_with_ratelimit(
+                    client_session=client_session,
+                    config=config,
+                    prompt=prompt,
+                    functions=functions,
+                    function_call=function_call,
+                    function_system_prompt=function_system_prompt,
+                    endpoint_router=endpoint_router,
+                    response_cache=response_cache,
+                    concurrency_limit=concurrency_limit,
+                    num_ratelimit_retries=num_ratelimit_retries,
+                    instrumentation=instrumentation,
+                    request_dump=request_dump,
+                    payload_builder=payload_builder,
+                    skip_cache_lookup=skip_cache_lookup,
+                )
+        if is_unauthorized:
+            return response_data
+        raise ParallelParrotError(f"Insufficient quota: {LogPreview(response_data)}")
+    if response_data.status == 429:
         if num_ratelimit_retries >= MAX_NUM_RATELIMIT_RETRIES:
             raise ParallelParrotError(
-                f"Too many ratelimit retries: {num_ratelimit_retries=} for {input_row=}"
+                f"Too many ratelimit retries: {num_ratelimit_retries=} for prompt={LogPreview(prompt)}"
+            )
+        (sleep_seconds, ratelimit_type) = parse_ratelimit_sleep_seconds(response_data)
+        if credential is not None:
+            # only throttles the requests which share this ratelimit
+            credential.rate_limiter.throttle(
+                ratelimit_type, sleep_seconds + RATELIMIT_RETRY_SLEEP_SECONDS
             )
-        sleep_seconds = None
-        headers = response_data.headers
-        if "error" in response_data.body_from_json:
-            error = response_data.body_from_json.get("error", {})
-            if error.get("code") == "rate_limit_exceeded":
-                # https://platform.openai.com/docs/guides/rate-limits/overview
-                if error.get("type") == "tokens":
-                    reset_seconds_str = headers.get("x-ratelimit-reset-tokens")
-                elif error.get("type") == "requests":
-                    reset_seconds_str = headers.get("x-ratelimit-reset-requests")
-                else:
-                    raise ParallelParrotError(f"Unexpected {error=}")
-                reset_seconds = parse_seconds_from_header(reset_seconds_str)
-                if reset_seconds is not None:
-                    sleep_seconds = float(reset_seconds)
-            elif error.get("code") == "insufficient_quota":
-                raise ParallelParrotError(f"Insufficient quota: {response_data=}")
+        if endpoint_router is not None:
+            # the throttled credential is skipped, so only sleep when every credential is throttled
+            sleep_seconds = endpoint_router.get_seconds_until_available()
+        if endpoint_router is not None and sleep_seconds <= 0:
+            logger.warning("Retrying with another credential due to ratelimit")
+            if instrumentation is not None:
+                instrumentation.on_ratelimit_sleep(ratelimit_type, 0.0)
         else:
-            retry_after = headers.get("retry-after")
-            if retry_after:
-                sleep_seconds = float(retry_after)
-        if sleep_seconds is None:
-            sleep_seconds = RATELIMIT_RETRY_SLEEP_SECONDS
-        throttle_until_time = max(
-            time.monotonic() + sleep_seconds + RATELIMIT_RETRY_SLEEP_SECONDS,
-            throttle_until_time,
-        )
-        logger.warning(
-            f"Sleeping for {sleep_seconds=} due to ratelimit "
-            f" {throttle_until_time=}"
-        )
-        await asyncio.sleep(sleep_seconds)
+            logger.warning(
+                "Sleeping for sleep_seconds=%s due to ratelimit", sleep_seconds
+            )
+            await asyncio.sleep(sleep_seconds)
+            if instrumentation is not None:
+                instrumentation.on_ratelimit_sleep(ratelimit_type, sleep_seconds)
         return await _chat_completion_with_ratelimit(
             client_session=client_session,
             config=config,
-            input_row=input_row,
-            curried_prompt_template=curried_prompt_template,
+            prompt=prompt,
             functions=functions,
             function_call=function_call,
             function_system_prompt=function_system_prompt,
+            endpoint_router=endpoint_router,
+            response_cache=response_cache,
+            concurrency_limit=concurrency_limit,
             num_ratelimit_retries=(num_ratelimit_retries + 1),
+            instrumentation=instrumentation,
+            request_dump=request_dump,
+            payload_builder=payload_builder,
+            skip_cache_lookup=skip_cache_lookup,
         )
     return response_data
 
 
+def is_quota_exceeded(response_data: OpenAIResponseData) -> bool:
+    if response_data.status != 429:
+        return False
+    if "exceeded your current quota" in response_data.reason:
+        return True
+    error = response_data.body_from_json.get("error", {})
+    return isinstance(error, dict) and error.get("code") == "insufficient_quota"
+
+
+def parse_ratelimit_sleep_seconds(
+    response_data: OpenAIResponseData,
+) -> Tuple[float, Optional[str]]:
+    """
+    returns how long to wait after a 429, and the type of the exceeded ratelimit (if known)
+    """
+    sleep_seconds = None
+    ratelimit_type = None
+    headers = response_data.headers
+    if "error" in response_data.body_from_json:
+        error = response_data.body_from_json.get("error", {})
+        if error.get("code") == "rate_limit_exceeded":
+            # https://platform.openai.com/docs/guides/rate-limits/overview
+            ratelimit_type = error.get("type")
+            if ratelimit_type == "tokens":
+                reset_seconds_str = headers.get("x-ratelimit-reset-tokens")
+            elif ratelimit_type == "requests":
+                reset_seconds_str = headers.get("x-ratelimit-reset-requests")
+            else:
+                raise ParallelParrotError(f"Unexpected {error=}")
+            reset_seconds = parse_seconds_from_header(reset_seconds_str)
+            if reset_seconds is not None:
+                sleep_seconds = float(reset_seconds)
+    else:
+        retry_after = headers.get("retry-after")
+        if retry_after:
+            sleep_seconds = float(retry_after)
+    if sleep_seconds is None:
+        sleep_seconds = RATELIMIT_RETRY_SLEEP_SECONDS
+    return (sleep_seconds, ratelimit_type)
+
+
 async def do_openai_chat_completion(
     client_session: ClientSessionType,
     config: OpenAIChatCompletionConfig,
-    input_row: Union[dict, "pd.Series"],
-    curried_prompt_template: Callable,
+    prompt: ChatPrompt,
     functions: Optional[List[dict]] = None,
     function_call: Optional[dict] = None,
     function_system_prompt: Optional[str] = None,
     log_level: int = logging.INFO,
+    credential: Optional[PooledCredential] = None,
+    response_cache: Optional[SQLiteResponseCache] = None,
+    concurrency_limit: Optional[AdaptiveConcurrencyLimit] = None,
+    url: str = OPENAI_CHAT_COMPLETIONS_URL,
+    instrumentation: Optional[Instrumentation] = None,
+    request_dump: Optional[RequestDumpWriter] = None,
+    payload_builder: Optional[ChatCompletionPayloadBuilder] = None,
+    skip_cache_lookup: bool = False,
 ) -> OpenAIResponseData:
-    prompt = curried_prompt_template(input_row)
-    payload = create_chat_completion_request_payload(
+    """
+    skip_cache_lookup sends the request even if its response is cached (the response is still cached)
+    """
+    if credential is not None:
+        headers = credential.headers
+        rate_limiter: Optional[OpenAIRateLimiter] = credential.rate_limiter
+    else:
+        headers = create_openai_http_headers(config)
+        rate_limiter = None
+    # usually built once per job, by iter_openai_chat_completion()
+    payload_builder = payload_builder or ChatCompletionPayloadBuilder(
         config=config,
-        prompt=prompt,
         functions=functions,
         function_call=function_call,
         function_system_prompt=function_system_prompt,
     )
+    payload = payload_builder.build(prompt)
+    if config.token_limit_mode == TokenLimitMode.TRUNCATE_BEFORE_REQUEST:
+        truncate_payload_before_request(payload, payload_builder)
     response_data = await _do_openai_chat_completion(
         client_session=client_session,
+        headers=headers,
         payload=payload,
         log_level=log_level,
+        rate_limiter=rate_limiter,
+        url=url,
+        response_cache=response_cache,
+        concurrency_limit=concurrency_limit,
+        skip_cache_lookup=skip_cache_lookup,
+        instrumentation=instrumentation,
+        request_dump=request_dump,
+        payload_builder=payload_builder,
     )
     response_body = response_data.body_from_json
     if isinstance(response_body, dict) and "usage" in response_body:
@@ -343,68 +734,71 @@ async def do_openai_chat_completion(
         if error.get("code") == "context_length_exceeded":
             if config.token_limit_mode == TokenLimitMode.RAISE_ERROR:
                 raise ParallelParrotError(
-                    f"Context length exceeded: {error=} {payload=}"
+                    f"Context length exceeded: {error=} payload={LogPreview(payload)}"
                 )
-            elif config.token_limit_mode == TokenLimitMode.TRUNCATE:
+            elif config.token_limit_mode in (
+                TokenLimitMode.TRUNCATE,
+                # in case the context window of the model is unknown, or the count was off
+                TokenLimitMode.TRUNCATE_BEFORE_REQUEST,
+            ):
                 (max_tokens, supplied_tokens) = parse_content_length_exceeded_error(
                     error
                 )
                 tokens_to_remove = int(supplied_tokens - (max_tokens / 2))
                 logger.warning(
-                    f"truncating prompt and re-doing request {tokens_to_remove=} {error=}",
+                    "truncating prompt and re-doing request tokens_to_remove=%s error=%s",
+                    tokens_to_remove,
+                    LogPreview(error),
                 )
-                truncated_prompt = openai_token_truncate(
+                truncated_prompt = truncate_chat_prompt(
                     prompt, config.model, tokens_to_remove
                 )
-                payload = create_chat_completion_request_payload(
-                    config=config,
-                    prompt=truncated_prompt,
-                    functions=functions,
-                    function_call=function_call,
-                    function_system_prompt=function_system_prompt,
-                )
+                payload = payload_builder.build(truncated_prompt)
                 if usage:
                     retry_usage_list.append(usage)
+                if instrumentation is not None:
+                    instrumentation.on_request_redo("truncation")
                 response_data = await _do_openai_chat_completion(
                     client_session=client_session,
+                    headers=headers,
                     payload=payload,
                     log_level=log_level,
+                    rate_limiter=rate_limiter,
+                    url=url,
+                    response_cache=response_cache,
+                    concurrency_limit=concurrency_limit,
+                    skip_cache_lookup=skip_cache_lookup,
+                    instrumentation=instrumentation,
+                    request_dump=request_dump,
+                    payload_builder=payload_builder,
                 )
             elif config.token_limit_mode == TokenLimitMode.IGNORE:
                 logger.warning(
-                    f"Ignoring context length exceeded error: {error=} {payload=}"
+                    "Ignoring context length exceeded error: error=%s payload=%s",
+                    LogPreview(error),
+                    LogPreview(payload),
                 )
                 response_data.complete = True
     elif function_call is not None:
-        choices = response_data.body_from_json.get("choices", [])
-        found_invalid_function_response = False
-        for choice in choices:
-            message = choice.get("message", {})
-            response_function_call = message.get("function_call")
-            if response_function_call is None:
-                logger.warning(
-                    f"Function not called.  Re-doing request {response_function_call=} in {choice=}"
-                )
-                found_invalid_function_response = True
-            elif response_function_call.get("name") != function_call.get("name"):
-                logger.warning(
-                    f"Mismatched function name. Re-doing request {response_function_call=} in {choice=}"
-                )
-                found_invalid_function_response = True
-            elif (
-                parse_json_arguments_from_function_call(response_function_call) is None
-            ):
-                logger.warning(
-                    f"Invalid JSON arguments. Re-doing request {response_function_call=} in {choice=}"
-                )
-                found_invalid_function_response = True
-        if found_invalid_function_response:
+        if has_invalid_function_response(response_data, function_call):
             if usage:
                 retry_usage_list.append(usage)
+            if instrumentation is not None:
+                instrumentation.on_request_redo("function_call")
             response_data = await _do_openai_chat_completion(
                 client_session=client_session,
+                headers=headers,
                 payload=payload,
                 log_level=log_level,
+                rate_limiter=rate_limiter,
+                url=url,
+                response_cache=response_cache,
+                concurrency_limit=concurrency_limit,
+                # overwrite the invalid cached response, if any
+                skip_cache_lookup=True,
+                instrumentation=instrumentation,
+                request_dump=request_dump,
+                payload_builder=payload_builder,
             )
     if len(retry_usage_list) > 0:
         last_response_body = response_data.body_from_json
@@ -421,45 +815,218 @@ async def do_openai_chat_completion(
     return response_data
 
 
+def truncate_chat_prompt(
+    prompt: ChatPrompt, model: str, tokens_to_remove: int
+) -> ChatPrompt:
+    """
+    only the last message (the rendered prompt template) of a list of messages is truncated
+    """
+    if isinstance(prompt, str):
+        return openai_token_truncate(prompt, model, tokens_to_remove)
+    last_message = prompt[-1]
+    truncated_content = openai_token_truncate(
+        last_message.get("content") or "", model, tokens_to_remove
+    )
+    return prompt[:-1] + [dict(last_message, content=truncated_content)]
+
+
+def truncate_payload_before_request(
+    payload: dict, payload_builder: Optional[ChatCompletionPayloadBuilder] = None
+) -> None:
+    """
+    payload_builder (which built the payload) avoids tokenizing the messages shared by every row
+    """
+    if payload_builder is not None:
+        tokens_to_remove = payload_builder.fit_to_context_window(payload)
+    else:
+        tokens_to_remove = fit_payload_to_context_window(payload)
+    if tokens_to_remove is None:
+        model = payload["model"]
+        if model not in _models_with_unknown_context_window:
+            _models_with_unknown_context_window.add(model)
+            logger.warning(
+                "Unknown context window for model=%r.  Truncating after a context length error instead.",
+                model,
+            )
+    elif tokens_to_remove > 0:
+        logger.warning(
+            "truncating prompt before the request tokens_to_remove=%s", tokens_to_remove
+        )
+
+
+def has_invalid_function_response(
+    response_data: OpenAIResponseData, function_call: dict
+) -> bool:
+    choices = response_data.body_from_json.get("choices", [])
+    found_invalid_function_response = False
+    for choice in choices:
+        message = choice.get("message", {})
+        response_function_call = message.get("function_call")
+        if response_function_call is None:
+            logger.warning(
+                "Function not called.  Re-doing request response_function_call=%s in choice=%s",
+                LogPreview(response_function_call),
+                LogPreview(choice),
+            )
+            found_invalid_function_response = True
+        elif response_function_call.get("name") != function_call.get("name"):
+            logger.warning(
+                "Mismatched function name. Re-doing request response_function_call=%s in choice=%s",
+                LogPreview(response_function_call),
+                LogPreview(choice),
+            )
+            found_invalid_function_response = True
+        elif parse_json_arguments_from_function_call(response_function_call) is None:
+            logger.warning(
+                "Invalid JSON arguments. Re-doing request response_function_call=%s in choice=%s",
+                LogPreview(response_function_call),
+                LogPreview(choice),
+            )
+            found_invalid_function_response = True
+    return found_invalid_function_response
+
+
 async def _do_openai_chat_completion(
     client_session: ClientSessionType,
+    headers: dict,
     payload: dict,
     log_level: int,
+    rate_limiter: Optional[OpenAIRateLimiter] = None,
+    response_cache: Optional[SQLiteResponseCache] = None,
+    skip_cache_lookup: bool = False,
+    concurrency_limit: Optional[AdaptiveConcurrencyLimit] = None,
+    url: str = OPENAI_CHAT_COMPLETIONS_URL,
+    instrumentation: Optional[Instrumentation] = None,
+    request_dump: Optional[RequestDumpWriter] = None,
+    payload_builder: Optional[ChatCompletionPayloadBuilder] = None,
 ) -> OpenAIResponseData:
-    global throttle_until_time
-    throttle_seconds = throttle_until_time - time.monotonic()
-    if throttle_seconds > 0:
-        logger.info(f"Throttling for {throttle_seconds=}")
-        await asyncio.sleep(throttle_seconds)
-    logger.log(log_level, f"POST to {OPENAI_CHAT_COMPLETIONS_URL} with {payload=}")
-    # https://docs.aiohttp.org/en/stable/client_reference.html#aiohttp.ClientResponse
-    async with client_session.post(
-        OPENAI_CHAT_COMPLETIONS_URL, json=payload
-    ) as response:
-        if response.content_type == "application/json":
-            body_from_json = await response.json()
-            if body_from_json is None:
-                body_from_json = {}
+    if response_cache is not None:
+        # the builder of the payload (if any) only serializes the messages of the row
+        if payload_builder is not None:
+            cache_key = payload_builder.make_cache_key(payload)
         else:
-            body_from_json = {
-                "text": await response.text(),
-            }
-        response_data = OpenAIResponseData(
-            status=response.status,
-            reason=str(response.reason),
-            headers=dict(response.headers),
-            body_from_json=body_from_json,
-            complete=(response.status == 200),
+            cache_key = make_payload_cache_key(payload)
+    if response_cache is not None and not skip_cache_lookup:
+        cached_body = response_cache.get_by_key(cache_key)
+        if cached_body is not None:
+            logger.log(log_level, "Cache hit for payload=%s", LogPreview(payload))
+            # cached responses are not billed again
+            cached_body["usage"] = dict(OPENAI_EMPTY_USAGE_STATS, cache_hits=1)
+            return OpenAIResponseData(
+                status=200,
+                reason="OK",
+                headers={},
+                body_from_json=cached_body,
+                complete=True,
+            )
+    if instrumentation is not None:
+        request_context = instrumentation.request_context(url)
+    else:
+        request_context = nullcontext()
+    with request_context:
+        if rate_limiter is not None:
+            if payload_builder is not None:
+                num_tokens = payload_builder.estimate_tokens(payload)
+            else:
+                num_tokens = estimate_payload_tokens(payload)
+            if instrumentation is None:
+                await rate_limiter.acquire(num_tokens)
+            else:
+                wait_start_time = time.monotonic()
+                await rate_limiter.acquire(num_tokens)
+                instrumentation.on_ratelimit_wait(time.monotonic() - wait_start_time)
+        logger.log(log_level, "POST to %s with payload=%s", url, LogPreview(payload))
+        response_data = await _post_chat_completion(
+            client_session=client_session,
+            headers=headers,
+            payload=payload,
+            concurrency_limit=concurrency_limit,
+            url=url,
+            instrumentation=instrumentation,
+            payload_builder=payload_builder,
         )
-    logger.log(log_level, f"Response {response_data=} from {payload=}")
+    if rate_limiter is not None:
+        rate_limiter.update_from_headers(response_data.headers)
+    if response_cache is not None and response_data.complete:
+        response_cache.put_by_key(cache_key, response_data.body_from_json)
+        usage = response_data.body_from_json.get("usage")
+        if isinstance(usage, dict):
+            usage["cache_misses"] = 1
+    if request_dump is not None and request_dump.should_dump():
+        request_dump.write(url, payload, response_data)
+    logger.log(
+        log_level,
+        "Response status=%s body=%s from payload=%s",
+        response_data.status,
+        LogPreview(response_data.body_from_json),
+        LogPreview(payload),
+    )
     return response_data
 
 
-def create_openai_http_headers(config: OpenAIChatCompletionConfig) -> dict:
-    headers = {
-        "Content-Type": "application/json",
-        "Authorization": f"Bearer {config.openai_api_key}",
-    }
-    if config.openai_org_id:
-        headers["OpenAI-Organization"] = config.openai_org_id
-    return headers
+async def _post_chat_completion(
+    client_session: ClientSessionType,
+    headers: dict,
+    payload: dict,
+    concurrency_limit: Optional[AdaptiveConcurrencyLimit] = None,
+    url: str = OPENAI_CHAT_COMPLETIONS_URL,
+    instrumentation: Optional[Instrumentation] = None,
+    payload_builder: Optional[ChatCompletionPayloadBuilder] = None,
+) -> OpenAIResponseData:
+    if payload_builder is not None:
+        request_body = payload_builder.encode(payload)
+    else:
+        request_body = json_dumps_bytes(payload)
+    if instrumentation is not None:
+        request_start_time = time.monotonic()
+        # None unless a response arrives
+        status: Optional[int] = None
+    if concurrency_limit is None:
+        trace_request_ctx = None
+    else:
+        start_time = concurrency_limit.on_request_start()
+        # called by the OpenAIClient for every attempt which is overloaded, including retried attempts
+        trace_request_ctx = {
+            "on_overload": lambda: concurrency_limit.on_overload(start_time)
+        }
+    is_overloaded = True
+    try:
+        # https://docs.aiohttp.org/en/stable/client_reference.html#aiohttp.ClientResponse
+        async with client_session.post(
+            url,
+            headers=headers,
+            # the headers already have "Content-Type: application/json"
+            data=request_body,
+            trace_request_ctx=trace_request_ctx,
+        ) as response:
+            if response.content_type == "application/json":
+                body_from_json = await response.json()
+                if body_from_json is None:
+                    body_from_json = {}
+            else:
+                body_from_json = {
+                    "text": await response.text(),
+                }
+            response_data = OpenAIResponseData(
+                status=response.status,
+                reason=str(response.reason),
+                headers=dict(response.headers),
+                body_from_json=body_from_json,
+                complete=(response.status == 200),
+            )
+        is_overloaded = is_overload_status(response_data.status)
+        if instrumentation is not None:
+            status = response_data.status
+    except asyncio.CancelledError:
+        is_overloaded = False
+        raise
+    finally:
+        if concurrency_limit is not None:
+            concurrency_limit.on_request_end(start_time, is_overloaded)
+        if instrumentation is not None:
+            instrumentation.on_request(
+                url=url,
+                status=status,
+                duration_seconds=(time.monotonic() - request_start_time),
+            )
+    return response_data
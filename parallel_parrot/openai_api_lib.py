@@ -1,17 +1,34 @@
+try:
+    import orjson  # type: ignore
+except ImportError:
+    orjson = None
+
 from dataclasses import dataclass
 import json
+import math
 import re
-from typing import List, Optional, Tuple, Union
+from typing import Any, List, Optional, Tuple, Union
 
 
+from .openai_util import (
+    count_payload_prefix_tokens,
+    fit_payload_to_context_window,
+    get_model_context_window_tokens,
+)
+from .response_cache import PayloadCacheKeyBuilder
 from .types import (
     ParallelParrotError,
     OpenAIChatCompletionConfig,
 )
-from .util import logger
+from .util import LogPreview, logger
 from .util_template import make_curried_prompt_template
 
 
+CHARS_PER_TOKEN_ESTIMATE = 4
+
+# a rendered prompt, or a list of messages ending with the rendered prompt (see CompiledMessagesTemplate)
+ChatPrompt = Union[str, List[dict]]
+
 OPENAI_EMPTY_USAGE_STATS = {
     "prompt_tokens": 0,
     "completion_tokens": 0,
@@ -88,7 +105,7 @@ def parse_chat_completion_message_and_usage(
     https://platform.openai.com/docs/api-reference/chat/object
     """
     if response_result.get("object") != "chat.completion":
-        logger.warning(f"Unexpected {response_result=}")
+        logger.warning("Unexpected response_result=%s", LogPreview(response_result))
         return (None, OPENAI_EMPTY_USAGE_STATS)
     choices = response_result.get("choices", [])
     usage = response_result.get("usage", OPENAI_EMPTY_USAGE_STATS)
@@ -115,7 +132,11 @@ def _parse_chat_completion_choices_text(choices: list) -> Union[None, str, list]
         message = choice.get("message", {})
         finish_reason = choice.get("finish_reason")
         if finish_reason != "stop":
-            logger.warning(f"Unexpected {finish_reason=} in {choice=}")
+            logger.warning(
+                "Unexpected finish_reason=%r in choice=%s",
+                finish_reason,
+                LogPreview(choice),
+            )
         content = message.get("content")
         return content
     else:
@@ -125,7 +146,11 @@ def _parse_chat_completion_choices_text(choices: list) -> Union[None, str, list]
             message = choice.get("message", {})
             finish_reason = choice.get("finish_reason")
             if finish_reason != "stop":
-                logger.warning(f"Unexpected {finish_reason=} in {choice=}")
+                logger.warning(
+                    "Unexpected finish_reason=%r in choice=%s",
+                    finish_reason,
+                    LogPreview(choice),
+                )
             content = message.get("content")
             if content:
                 content_set.add(content)
@@ -144,7 +169,11 @@ def _parse_chat_completion_choices_function_list_of_objects(
         message = choice.get("message", {})
         finish_reason = choice.get("finish_reason")
         if finish_reason != "stop":
-            logger.warning(f"Unexpected {finish_reason=} in {choice=}")
+            logger.warning(
+                "Unexpected finish_reason=%r in choice=%s",
+                finish_reason,
+                LogPreview(choice),
+            )
         function_call = message.get("function_call")
         if function_call and function_call.get("name") == function_name:
             parsed_arguments = parse_json_arguments_from_function_call(function_call)
@@ -158,7 +187,11 @@ def _parse_chat_completion_choices_function_list_of_objects(
             message = choice.get("message", {})
             finish_reason = choice.get("finish_reason")
             if finish_reason != "stop":
-                logger.warning(f"Unexpected {finish_reason=} in {choice=}")
+                logger.warning(
+                    "Unexpected finish_reason=%r in choice=%s",
+                    finish_reason,
+                    LogPreview(choice),
+                )
             else:
                 function_call = message.get("function_call")
                 if function_call and function_call.get("name") == function_name:
@@ -196,53 +229,214 @@ def parse_content_length_exceeded_error(error: dict):
         raise ParallelParrotError(f"Unexpected {message=}")
 
 
-def create_chat_completion_request_payload(
-    config: OpenAIChatCompletionConfig,
-    prompt: str,
-    functions: Optional[List[dict]] = None,
-    function_call: Union[None, dict, str] = None,
-    function_system_prompt: Optional[str] = None,
-) -> dict:
+class ChatCompletionPayloadBuilder:
     """
+    Builds the chat completion payloads of a job, whose rows differ only in their prompt.
+    The rest of the payload (the config, the system messages, the prefix_messages and the functions) is built once,
+    and also encoded to JSON once, so that each row only adds and encodes its own messages.
+    The messages shared by every row come first, so that they are a common prefix of all of the prompts,
+    which the provider's prompt caching can reuse.
     https://platform.openai.com/docs/api-reference/chat/create
+    https://platform.openai.com/docs/guides/prompt-caching
     """
-    payload = config.to_payload_dict()
-    payload["stream"] = False
-    messages = []
-    if config.system_message:
-        messages.append({"role": "system", "content": config.system_message})
-    if function_system_prompt is not None:
-        messages.append({"role": "system", "content": function_system_prompt})
-        payload["response_format"] = {"type": "json_object"}
-    messages.append({"role": "user", "content": prompt})
-    payload["messages"] = messages
-    if functions is not None:
-        payload["functions"] = functions
-    if function_call is not None:
-        payload["function_call"] = function_call
-    return payload
+
+    def __init__(
+        self,
+        config: OpenAIChatCompletionConfig,
+        functions: Optional[List[dict]] = None,
+        function_call: Union[None, dict, str] = None,
+        function_system_prompt: Optional[str] = None,
+    ):
+        payload = config.to_payload_dict()
+        payload["stream"] = False
+        prefix_messages = []
+        if config.system_message:
+            prefix_messages.append({"role": "system", "content": config.system_message})
+        if function_system_prompt is not None:
+            prefix_messages.append(
+                {"role": "system", "content": function_system_prompt}
+            )
+            payload["response_format"] = {"type": "json_object"}
+        if config.prefix_messages:
+            prefix_messages.extend(config.prefix_messages)
+        # a placeholder, which keeps the position of "messages" among the keys
+        payload["messages"] = prefix_messages
+        if functions is not None:
+            payload["functions"] = functions
+        if function_call is not None:
+            payload["function_call"] = function_call
+        self._payload = payload
+        self._prefix_messages = prefix_messages
+        (self._encoded_head, self._encoded_tail) = _encode_payload_around_messages(
+            payload
+        )
+        # counted on the first truncation, since most jobs never tokenize their prompts
+        self._num_prefix_tokens: Optional[int] = None
+        self._num_prefix_chars = _count_payload_chars(payload)
+        self._cache_key_builder = PayloadCacheKeyBuilder(payload, len(prefix_messages))
+
+    def build(self, prompt: ChatPrompt) -> dict:
+        """
+        prompt is the user message, or the list of messages of the row
+        """
+        payload = dict(self._payload)
+        if isinstance(prompt, str):
+            row_messages = [{"role": "user", "content": prompt}]
+        else:
+            row_messages = list(prompt)
+        payload["messages"] = self._prefix_messages + row_messages
+        return payload
+
+    def estimate_tokens(self, payload: dict) -> int:
+        """
+        estimate_payload_tokens() for a payload from build(), which only counts the messages of the row
+        """
+        row_messages = payload["messages"][len(self._prefix_messages) :]
+        num_chars = self._num_prefix_chars + _count_messages_chars(row_messages)
+        return _estimate_tokens_from_chars(payload, num_chars)
+
+    def make_cache_key(self, payload: dict) -> str:
+        """
+        make_payload_cache_key() for a payload from build(), which only serializes the messages of the row
+        """
+        return self._cache_key_builder.make_key(payload)
+
+    def get_fingerprint(self) -> str:
+        """
+        a hash of the part of the payload which is shared by every row (ignoring fields which do not change the output),
+        e.g. to tell whether a checkpoint was written by the same job
+        """
+        return self._cache_key_builder.make_key(self._payload)
+
+    def fit_to_context_window(self, payload: dict) -> Optional[int]:
+        """
+        fit_payload_to_context_window() for a payload from build(),
+        which only tokenizes the messages of the row
+        """
+        if (
+            self._num_prefix_tokens is None
+            and get_model_context_window_tokens(payload["model"]) is not None
+        ):
+            self._num_prefix_tokens = count_payload_prefix_tokens(
+                self._payload, len(self._prefix_messages)
+            )
+        return fit_payload_to_context_window(
+            payload,
+            num_prefix_messages=len(self._prefix_messages),
+            num_prefix_tokens=self._num_prefix_tokens,
+        )
+
+    def encode(self, payload: dict) -> bytes:
+        """
+        the JSON request body of a payload from build().
+        Only the messages after the system messages are encoded again,
+        so those are the only part of the payload which may be changed after build() (e.g. by truncation).
+        """
+        row_messages = payload["messages"][len(self._prefix_messages) :]
+        encoded_row_messages = json_dumps_bytes(row_messages)[1:-1]
+        if encoded_row_messages and self._prefix_messages:
+            separator = b","
+        else:
+            separator = b""
+        return b"".join(
+            (self._encoded_head, separator, encoded_row_messages, self._encoded_tail)
+        )
+
+
+def _encode_payload_around_messages(payload: dict) -> Tuple[bytes, bytes]:
+    """
+    the JSON of the payload, split within its "messages" list, after the messages already in it
+    """
+    keys = list(payload.keys())
+    messages_index = keys.index("messages")
+    encoded_before = json_dumps_bytes(
+        {key: payload[key] for key in keys[:messages_index]}
+    )[1:-1]
+    encoded_messages = json_dumps_bytes(payload["messages"])[:-1]
+    encoded_after = json_dumps_bytes(
+        {key: payload[key] for key in keys[messages_index + 1 :]}
+    )[1:-1]
+    head = (
+        b"{"
+        + encoded_before
+        + (b"," if encoded_before else b"")
+        + b'"messages":'
+        + encoded_messages
+    )
+    tail = b"]" + (b"," if encoded_after else b"") + encoded_after + b"}"
+    return (head, tail)
+
+
+def json_dumps_bytes(value: Any) -> bytes:
+    """
+    compact JSON, with orjson if it is installed, since it is several times faster than json
+    """
+    if orjson is not None:
+        return orjson.dumps(value)
+    return json.dumps(value, separators=(",", ":")).encode("utf-8")
 
 
 def parse_seconds_from_header(header_value: Optional[str]) -> Optional[float]:
     if header_value is None:
         return None
-    match = re.match(r"([0-9\.]+m)?([0-9\.]+s)?", header_value)
+    # e.g. "1m20s", "0.123s" or "20ms"
+    match = re.match(
+        r"(?:([0-9\.]+)m(?!s))?(?:([0-9\.]+)s)?(?:([0-9\.]+)ms)?", header_value
+    )
     if match:
         minutes_str = match.group(1)
         if minutes_str:
-            minutes = float(minutes_str.replace("m", ""))
+            minutes = float(minutes_str)
         else:
             minutes = 0.0
         seconds_str = match.group(2)
         if seconds_str:
-            seconds = float(seconds_str.replace("s", ""))
+            seconds = float(seconds_str)
         else:
             seconds = 0.0
-        return (minutes * 60.0) + seconds
+        milliseconds_str = match.group(3)
+        if milliseconds_str:
+            milliseconds = float(milliseconds_str)
+        else:
+            milliseconds = 0.0
+        return (minutes * 60.0) + seconds + (milliseconds / 1000.0)
     else:
         return None
 
 
+def estimate_payload_tokens(payload: dict) -> int:
+    """
+    estimate the number of tokens a request counts against the tokens-per-minute ratelimit.
+    Like OpenAI, this uses roughly 4 characters per prompt token, plus max_tokens for each of the n completions.
+    https://platform.openai.com/docs/guides/rate-limits/overview
+    """
+    return _estimate_tokens_from_chars(payload, _count_payload_chars(payload))
+
+
+def _count_payload_chars(payload: dict) -> int:
+    num_chars = _count_messages_chars(payload.get("messages", []))
+    functions = payload.get("functions")
+    if functions is not None:
+        num_chars += len(json.dumps(functions, separators=(",", ":")))
+    return num_chars
+
+
+def _count_messages_chars(messages: List[dict]) -> int:
+    num_chars = 0
+    for message in messages:
+        content = message.get("content")
+        if isinstance(content, str):
+            num_chars += len(content)
+    return num_chars
+
+
+def _estimate_tokens_from_chars(payload: dict, num_chars: int) -> int:
+    prompt_tokens = math.ceil(num_chars / CHARS_PER_TOKEN_ESTIMATE)
+    max_tokens = payload.get("max_tokens") or 0
+    n = payload.get("n") or 1
+    return prompt_tokens + (max_tokens * n)
+
+
 def parse_json_arguments_from_function_call(function_call: dict):
     arguments = function_call.get("arguments")
     if not arguments:
@@ -251,5 +445,9 @@ def parse_json_arguments_from_function_call(function_call: dict):
         parsed_arguments = json.loads(arguments)
         return parsed_arguments
     except Exception as e:
-        logger.warning(f"Could not parse arguments in {function_call=} {e=}")
+        logger.warning(
+            "Could not parse arguments in function_call=%s e=%r",
+            LogPreview(function_call),
+            e,
+        )
     return None
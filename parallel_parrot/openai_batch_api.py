@@ -0,0 +1,316 @@
+try:
+    import pandas as pd  # type: ignore
+except ImportError:
+    pd = None
+
+import asyncio
+from collections.abc import Callable
+import json
+import tempfile
+from typing import IO, AsyncIterator, Dict, List, Optional, Tuple, Union
+
+from aiohttp import ClientSession, ClientTimeout, FormData
+
+from .checkpoint import CheckpointJournal
+from .openai_api import prep_function_call_arguments, truncate_payload_before_request
+from .openai_api_lib import (
+    OPENAI_EMPTY_USAGE_STATS,
+    ChatCompletionPayloadBuilder,
+    json_dumps_bytes,
+    parse_chat_completion_message_and_usage,
+)
+from .openai_credentials import create_openai_http_headers
+from .openai_client import OpenAIClient, use_openai_client
+from .response_cache import SQLiteResponseCache
+from .types import OpenAIChatCompletionConfig, ParallelParrotError, TokenLimitMode
+from .util import LogPreview, logger
+
+
+# https://platform.openai.com/docs/guides/batch
+# relative to the config's openai_base_url, like the chat completions requests
+OPENAI_FILES_PATH = "/files"
+OPENAI_BATCHES_PATH = "/batches"
+OPENAI_BATCH_ENDPOINT = "/v1/chat/completions"
+OPENAI_BATCH_COMPLETION_WINDOW = "24h"
+MAX_NUM_BATCH_REQUESTS = 50000
+BATCH_POLL_INTERVAL_SECONDS = 30.0
+BATCH_FINAL_STATUSES = {"completed", "failed", "expired", "cancelled"}
+# uploads of up to MAX_NUM_BATCH_REQUESTS requests, and the downloads of their results,
+# take much longer than the client's timeout for a chat completion request
+BATCH_FILE_TIMEOUT_SECONDS = 3600.0
+
+
+async def batch_openai_chat_completion(
+    config: OpenAIChatCompletionConfig,
+    indexed_rows: AsyncIterator[Tuple[int, Union[dict, "pd.Series"]]],
+    curried_prompt_template: Callable,
+    function_output_key_names: Optional[List[str]],
+    response_cache: Optional[SQLiteResponseCache] = None,
+    openai_client: Optional[OpenAIClient] = None,
+    checkpoint_journal: Optional[CheckpointJournal] = None,
+) -> AsyncIterator[Tuple[int, Union[None, str, list], dict]]:
+    """
+    Run the job through the OpenAI Batch API, which costs less but may take up to 24 hours.
+    - the payloads are written to JSONL files of at most MAX_NUM_BATCH_REQUESTS requests, which are uploaded as batches
+    - the batches are polled until they finish
+    - the results are mapped back to their row_index through the custom_id
+    yields (row_index, model_output, usage) tuples as each batch finishes.
+    Rows of batches which failed or expired are not yielded.
+
+    With a checkpoint_journal, each submitted batch is journaled, and the pending_batches of an earlier run
+    are polled again, rather than submitted again.  Their rows must not be in indexed_rows.
+
+    Every batch is submitted to config.openai_base_url with config.openai_api_key,
+    so openai_endpoints and additional_openai_credentials are not supported.
+    """
+    if config.openai_endpoints or config.additional_openai_credentials:
+        raise ParallelParrotError(
+            "ExecutionMode.BATCH does not support openai_endpoints or additional_openai_credentials"
+        )
+    (
+        function_name,
+        parameter_name,
+        functions,
+        function_call,
+        function_system_prompt,
+    ) = prep_function_call_arguments(function_output_key_names)
+    payload_builder = ChatCompletionPayloadBuilder(
+        config=config,
+        functions=functions,
+        function_call=function_call,
+        function_system_prompt=function_system_prompt,
+    )
+    base_url = config.openai_base_url.rstrip("/")
+    headers = create_openai_http_headers(config)
+    # the multipart file upload sets its own Content-Type
+    del headers["Content-Type"]
+    # only needed to store the results in the response cache
+    cache_keys: Dict[str, str] = {}
+    # batch_id -> the row indexes in the batch
+    pending_batches: Dict[str, List[int]] = {}
+    if checkpoint_journal is not None:
+        pending_batches.update(checkpoint_journal.pending_batches)
+        if len(pending_batches) > 0:
+            logger.info(f"resuming {len(pending_batches)} submitted batches")
+    async with use_openai_client(openai_client) as openai_client:
+        client_session = openai_client.session
+
+        async def _submit_batch(batch_file: IO, row_indexes: List[int]) -> None:
+            batch_id = await create_openai_batch(
+                client_session, headers, batch_file, base_url=base_url
+            )
+            pending_batches[batch_id] = row_indexes
+            if checkpoint_journal is not None:
+                checkpoint_journal.append_batch(batch_id, row_indexes)
+
+        batch_file: Optional[IO] = None
+        batch_row_indexes: List[int] = []
+        try:
+            async for row_index, input_row in indexed_rows:
+                payload = payload_builder.build(curried_prompt_template(input_row))
+                if config.token_limit_mode == TokenLimitMode.TRUNCATE_BEFORE_REQUEST:
+                    # batches cannot be retried with a shorter prompt
+                    truncate_payload_before_request(payload, payload_builder)
+                custom_id = str(row_index)
+                if response_cache is not None:
+                    cache_key = payload_builder.make_cache_key(payload)
+                    cached_body = response_cache.get_by_key(cache_key)
+                    if cached_body is not None:
+                        (model_output, _) = parse_chat_completion_message_and_usage(
+                            cached_body,
+                            function_name=function_name,
+                            parameter_name=parameter_name,
+                        )
+                        usage = dict(OPENAI_EMPTY_USAGE_STATS, cache_hits=1)
+                        yield (row_index, model_output, usage)
+                        continue
+                    cache_keys[custom_id] = cache_key
+                batch_request = {
+                    "custom_id": custom_id,
+                    "method": "POST",
+                    "url": OPENAI_BATCH_ENDPOINT,
+                }
+                if batch_file is None:
+                    batch_file = tempfile.TemporaryFile("w+b")
+                # the body is spliced in from the pre-encoded payload
+                batch_file.write(json_dumps_bytes(batch_request)[:-1])
+                batch_file.write(b',"body":')
+                batch_file.write(payload_builder.encode(payload))
+                batch_file.write(b"}\n")
+                batch_row_indexes.append(row_index)
+                if len(batch_row_indexes) >= MAX_NUM_BATCH_REQUESTS:
+                    await _submit_batch(batch_file, batch_row_indexes)
+                    batch_file = None
+                    batch_row_indexes = []
+            if batch_file is not None:
+                await _submit_batch(batch_file, batch_row_indexes)
+                batch_file = None
+        finally:
+            if batch_file is not None:
+                batch_file.close()
+        async for custom_id, body_from_json in _iter_pending_batch_results(
+            client_session,
+            headers,
+            pending_batches,
+            base_url=base_url,
+            checkpoint_journal=checkpoint_journal,
+        ):
+            if response_cache is not None and custom_id in cache_keys:
+                response_cache.put_by_key(cache_keys.pop(custom_id), body_from_json)
+                usage_counters = {"cache_misses": 1}
+            else:
+                usage_counters = {}
+            (model_output, usage) = parse_chat_completion_message_and_usage(
+                body_from_json,
+                function_name=function_name,
+                parameter_name=parameter_name,
+            )
+            yield (int(custom_id), model_output, dict(usage, **usage_counters))
+
+
+async def _iter_pending_batch_results(
+    client_session: ClientSession,
+    headers: dict,
+    pending_batches: Dict[str, List[int]],
+    base_url: str,
+    checkpoint_journal: Optional[CheckpointJournal] = None,
+) -> AsyncIterator[Tuple[str, dict]]:
+    """
+    poll the pending_batches until they finish, and yield (custom_id, response body) for each of their results.
+    A batch is removed from pending_batches (and finished in the checkpoint_journal)
+    once all of its results have been consumed.
+    """
+    while len(pending_batches) > 0:
+        await asyncio.sleep(BATCH_POLL_INTERVAL_SECONDS)
+        for batch_id in list(pending_batches):
+            batch = await _get_openai_batch(
+                client_session, headers, batch_id, base_url=base_url
+            )
+            if batch is None or batch.get("status") not in BATCH_FINAL_STATUSES:
+                continue
+            async for result in _iter_openai_batch_results(
+                client_session, headers, batch, base_url=base_url
+            ):
+                yield result
+            del pending_batches[batch_id]
+            if checkpoint_journal is not None:
+                checkpoint_journal.finish_batch(batch_id)
+
+
+async def create_openai_batch(
+    client_session: ClientSession,
+    headers: dict,
+    batch_file: IO,
+    base_url: str,
+) -> str:
+    """
+    upload the JSONL batch_file, and create a batch from it.  The batch_file is closed after the upload.
+    https://platform.openai.com/docs/api-reference/batch/create
+    """
+    batch_file.seek(0)
+    form_data = FormData()
+    form_data.add_field("purpose", "batch")
+    form_data.add_field(
+        "file",
+        batch_file,
+        filename="parallel_parrot_batch.jsonl",
+        content_type="application/jsonl",
+    )
+    async with client_session.post(
+        base_url + OPENAI_FILES_PATH,
+        headers=headers,
+        data=form_data,
+        timeout=ClientTimeout(total=BATCH_FILE_TIMEOUT_SECONDS),
+    ) as response:
+        file_result = await response.json(content_type=None)
+        if response.status != 200:
+            raise ParallelParrotError(
+                f"could not upload batch file {response.status=} {file_result=}"
+            )
+    async with client_session.post(
+        base_url + OPENAI_BATCHES_PATH,
+        headers=headers,
+        json={
+            "input_file_id": file_result["id"],
+            "endpoint": OPENAI_BATCH_ENDPOINT,
+            "completion_window": OPENAI_BATCH_COMPLETION_WINDOW,
+        },
+    ) as response:
+        batch = await response.json(content_type=None)
+        if response.status != 200:
+            raise ParallelParrotError(
+                f"could not create batch {response.status=} {batch=}"
+            )
+    logger.info(f"created batch {batch['id']} from file {file_result['id']}")
+    return batch["id"]
+
+
+async def _get_openai_batch(
+    client_session: ClientSession,
+    headers: dict,
+    batch_id: str,
+    base_url: str,
+) -> Optional[dict]:
+    async with client_session.get(
+        f"{base_url}{OPENAI_BATCHES_PATH}/{batch_id}", headers=headers
+    ) as response:
+        batch = await response.json(content_type=None)
+        if response.status != 200:
+            # try again at the next poll
+            logger.warning(
+                "could not get batch %s response.status=%s batch=%s",
+                batch_id,
+                response.status,
+                LogPreview(batch),
+            )
+            return None
+    logger.info(
+        f"batch {batch_id} {batch.get('status')=} {batch.get('request_counts')=}"
+    )
+    if batch.get("status") == "failed":
+        # like an expired batch, its rows have no output, and the other batches carry on
+        logger.error(
+            "batch %s failed errors=%s", batch_id, LogPreview(batch.get("errors"))
+        )
+    return batch
+
+
+async def _iter_openai_batch_results(
+    client_session: ClientSession,
+    headers: dict,
+    batch: dict,
+    base_url: str,
+) -> AsyncIterator[Tuple[str, dict]]:
+    """
+    yield (custom_id, response body) for every request in the output file of a finished batch.
+    Requests which failed, or which did not finish before the batch expired, are logged and skipped.
+    A failed batch has no output file, so all of its requests are skipped.
+    """
+    output_file_id = batch.get("output_file_id")
+    if output_file_id is None:
+        logger.warning("no output file for batch=%s", LogPreview(batch))
+        return
+    async with client_session.get(
+        f"{base_url}{OPENAI_FILES_PATH}/{output_file_id}/content",
+        headers=headers,
+        timeout=ClientTimeout(total=BATCH_FILE_TIMEOUT_SECONDS),
+    ) as response:
+        if response.status != 200:
+            raise ParallelParrotError(
+                f"could not download batch output {response.status=} {output_file_id=}"
+            )
+        async for line in response.content:
+            if not line.strip():
+                continue
+            result = json.loads(line)
+            custom_id = result.get("custom_id")
+            result_response = result.get("response") or {}
+            if result.get("error") or result_response.get("status_code") != 200:
+                logger.warning("batch request failed result=%s", LogPreview(result))
+                continue
+            yield (custom_id, result_response.get("body", {}))
+    num_requests = batch.get("request_counts", {}).get("total")
+    if batch.get("status") != "completed":
+        logger.warning(
+            f"batch {batch['id']} finished with {batch.get('status')=}, some of the {num_requests=} may have no output"
+        )
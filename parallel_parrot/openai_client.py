@@ -0,0 +1,259 @@
+from contextlib import asynccontextmanager
+import time
+from types import SimpleNamespace
+from typing import AsyncIterator, Callable, Optional
+
+from aiohttp import (
+    ClientSession,
+    ClientTimeout,
+    TCPConnector,
+    TraceConfig,
+    TraceRequestChunkSentParams,
+    TraceRequestEndParams,
+    TraceRequestExceptionParams,
+    TraceRequestStartParams,
+    TraceResponseChunkReceivedParams,
+)
+
+from .concurrency import ConcurrencyStats
+from .instrumentation import Instrumentation
+from .openai_ratelimit import RateLimiterRegistry
+from .types import ParallelParrotError
+from .util import logger
+
+try:
+    import resource
+
+    # maximize the number of concurrent connections for this process
+    rlimit_soft, rlimit_hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    try:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (rlimit_hard, rlimit_hard))
+    except Exception as e:
+        logger.warning(f"Could not set rlimit: {e=}")
+    rlimit_soft, rlimit_hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    MAX_NUM_CONCURRENT_REQUESTS = max(120, rlimit_soft - 80)
+except ImportError:
+    MAX_NUM_CONCURRENT_REQUESTS = 120
+
+
+OPENAI_REQUEST_TIMEOUT_SECONDS = 120.0
+# keep idle connections open between jobs, rather than paying for a new TLS handshake
+CLIENT_KEEPALIVE_TIMEOUT_SECONDS = 60.0
+CLIENT_DNS_CACHE_TTL_SECONDS = 300
+
+# shared by the temporary clients of jobs which are not given a client, so that they still share ratelimits
+DEFAULT_RATE_LIMITER_REGISTRY = RateLimiterRegistry()
+
+
+class OpenAIClient:
+    """
+    A long-lived HTTP connection pool, which can be shared by many jobs in the same process.
+
+        async with pp.OpenAIClient() as client:
+            await pp.parallel_text_generation(..., client=client)
+            await pp.parallel_data_generation(..., client=client)
+
+    Connections (and their TLS sessions and DNS lookups) are reused across the setup and parallel
+    phases of each job, and across jobs.  Credentials are sent per request, so one client can be
+    used with any OpenAIChatCompletionConfig.
+
+    on_concurrency_update is called with the ConcurrencyStats of the running job
+    each time its adaptive concurrency limit is re-evaluated.
+    instrumentation (a pp.Instrumentation, e.g. pp.PrometheusInstrumentation) receives the metrics
+    of every job which uses this client.
+
+    The client also owns the ratelimit state, per API key, organization and model.
+    So a 429 only throttles the jobs which share that ratelimit.
+    """
+
+    def __init__(
+        self,
+        limit: int = MAX_NUM_CONCURRENT_REQUESTS,
+        limit_per_host: int = MAX_NUM_CONCURRENT_REQUESTS,
+        keepalive_timeout_seconds: float = CLIENT_KEEPALIVE_TIMEOUT_SECONDS,
+        dns_cache_ttl_seconds: int = CLIENT_DNS_CACHE_TTL_SECONDS,
+        on_concurrency_update: Optional[Callable[[ConcurrencyStats], None]] = None,
+        rate_limiters: Optional[RateLimiterRegistry] = None,
+        instrumentation: Optional[Instrumentation] = None,
+    ):
+        self.limit = limit
+        self.limit_per_host = limit_per_host
+        self.keepalive_timeout_seconds = keepalive_timeout_seconds
+        self.dns_cache_ttl_seconds = dns_cache_ttl_seconds
+        self.on_concurrency_update = on_concurrency_update
+        self.rate_limiters = (
+            rate_limiters if rate_limiters is not None else RateLimiterRegistry()
+        )
+        self.instrumentation = instrumentation
+        self._session: Optional[ClientSession] = None
+
+    async def __aenter__(self):
+        self.open()
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+    def open(self) -> None:
+        """
+        create the connection pool.  This must be called from inside the event loop which will use it.
+        """
+        if self._session is not None:
+            return
+        connector = TCPConnector(
+            limit=self.limit,
+            limit_per_host=self.limit_per_host,
+            keepalive_timeout=self.keepalive_timeout_seconds,
+            use_dns_cache=True,
+            ttl_dns_cache=self.dns_cache_ttl_seconds,
+        )
+        # observe every attempt, including the ones which are retried by the RetryClient
+        trace_config = TraceConfig()
+        trace_config.on_request_end.append(_on_request_attempt_end)
+        trace_config.on_request_exception.append(_on_request_attempt_exception)
+        trace_configs = [trace_config]
+        if self.instrumentation is not None:
+            trace_configs.append(
+                _create_instrumentation_trace_config(self.instrumentation)
+            )
+        self._session = ClientSession(
+            connector=connector,
+            timeout=ClientTimeout(total=OPENAI_REQUEST_TIMEOUT_SECONDS),
+            trace_configs=trace_configs,
+        )
+
+    async def close(self) -> None:
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+    @property
+    def closed(self) -> bool:
+        return self._session is None
+
+    @property
+    def session(self) -> ClientSession:
+        if self._session is None:
+            raise ParallelParrotError(
+                "OpenAIClient is not open.  Use it as `async with pp.OpenAIClient() as client:`"
+            )
+        return self._session
+
+
+@asynccontextmanager
+async def use_openai_client(
+    client: Optional[OpenAIClient],
+) -> AsyncIterator[OpenAIClient]:
+    """
+    yield the caller's client, or a temporary one which is closed on exit
+    """
+    if client is not None:
+        yield client
+        return
+    async with OpenAIClient(
+        rate_limiters=DEFAULT_RATE_LIMITER_REGISTRY
+    ) as temporary_client:
+        yield temporary_client
+
+
+def is_overload_status(status: int) -> bool:
+    return status == 429 or status >= 500
+
+
+async def _on_request_attempt_end(
+    session: ClientSession,
+    trace_config_ctx: SimpleNamespace,
+    params: TraceRequestEndParams,
+) -> None:
+    if is_overload_status(params.response.status):
+        _call_on_overload(trace_config_ctx)
+
+
+async def _on_request_attempt_exception(
+    session: ClientSession,
+    trace_config_ctx: SimpleNamespace,
+    params: TraceRequestExceptionParams,
+) -> None:
+    _call_on_overload(trace_config_ctx)
+
+
+def _call_on_overload(trace_config_ctx: SimpleNamespace) -> None:
+    # the on_overload callback is passed per request, in trace_request_ctx
+    trace_request_ctx = getattr(trace_config_ctx, "trace_request_ctx", None)
+    if isinstance(trace_request_ctx, dict):
+        on_overload = trace_request_ctx.get("on_overload")
+        if on_overload is not None:
+            on_overload()
+
+
+def _create_instrumentation_trace_config(
+    instrumentation: Instrumentation,
+) -> TraceConfig:
+    """
+    report every HTTP attempt, and the bytes of every request and response body
+    """
+
+    async def on_request_start(
+        session: ClientSession,
+        trace_config_ctx: SimpleNamespace,
+        params: TraceRequestStartParams,
+    ) -> None:
+        trace_config_ctx.start_time = time.monotonic()
+
+    async def on_request_end(
+        session: ClientSession,
+        trace_config_ctx: SimpleNamespace,
+        params: TraceRequestEndParams,
+    ) -> None:
+        _report_request_attempt(
+            instrumentation, trace_config_ctx, str(params.url), params.response.status
+        )
+
+    async def on_request_exception(
+        session: ClientSession,
+        trace_config_ctx: SimpleNamespace,
+        params: TraceRequestExceptionParams,
+    ) -> None:
+        _report_request_attempt(
+            instrumentation, trace_config_ctx, str(params.url), None
+        )
+
+    async def on_request_chunk_sent(
+        session: ClientSession,
+        trace_config_ctx: SimpleNamespace,
+        params: TraceRequestChunkSentParams,
+    ) -> None:
+        instrumentation.on_bytes_sent(len(params.chunk))
+
+    async def on_response_chunk_received(
+        session: ClientSession,
+        trace_config_ctx: SimpleNamespace,
+        params: TraceResponseChunkReceivedParams,
+    ) -> None:
+        instrumentation.on_bytes_received(len(params.chunk))
+
+    trace_config = TraceConfig()
+    trace_config.on_request_start.append(on_request_start)
+    trace_config.on_request_end.append(on_request_end)
+    trace_config.on_request_exception.append(on_request_exception)
+    trace_config.on_request_chunk_sent.append(on_request_chunk_sent)
+    trace_config.on_response_chunk_received.append(on_response_chunk_received)
+    return trace_config
+
+
+def _report_request_attempt(
+    instrumentation: Instrumentation,
+    trace_config_ctx: SimpleNamespace,
+    url: str,
+    status: Optional[int],
+) -> None:
+    duration_seconds = time.monotonic() - trace_config_ctx.start_time
+    # the RetryClient numbers its attempts in trace_request_ctx, starting at 1
+    trace_request_ctx = getattr(trace_config_ctx, "trace_request_ctx", None)
+    if isinstance(trace_request_ctx, dict):
+        attempt = trace_request_ctx.get("current_attempt", 1)
+    else:
+        attempt = 1
+    instrumentation.on_request_attempt(
+        url=url, status=status, attempt=attempt, duration_seconds=duration_seconds
+    )
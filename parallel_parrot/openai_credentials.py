@@ -0,0 +1,181 @@
+import time
+from typing import List, Optional, Union
+
+from .openai_ratelimit import (
+    OpenAIRateLimiter,
+    RateLimiterRegistry,
+    make_ratelimit_domain,
+)
+from .types import OpenAIChatCompletionConfig, OpenAICredential, ParallelParrotError
+from .util import logger
+
+
+class PooledCredential:
+    def __init__(
+        self,
+        credential: Union[OpenAICredential, OpenAIChatCompletionConfig],
+        rate_limiter: OpenAIRateLimiter,
+    ):
+        self.openai_org_id = credential.openai_org_id
+        self.headers = create_openai_http_headers(credential)
+        self.rate_limiter = rate_limiter
+        self.disabled_reason: Optional[str] = None
+        # for smooth weighted round-robin
+        self.current_weight = 0.0
+
+    def get_weight(self) -> Optional[float]:
+        """
+        the ratelimit reported by this credential's response headers, or None before the first response.
+        Tokens per minute is usually the binding limit for LLM requests, so it is preferred.
+        """
+        if self.rate_limiter.token_bucket is not None:
+            return self.rate_limiter.token_bucket.limit
+        if self.rate_limiter.request_bucket is not None:
+            return self.rate_limiter.request_bucket.limit
+        return None
+
+    def get_throttle_until_time(self) -> float:
+        return max(self.rate_limiter.throttle_until_times.values())
+
+    def __repr__(self) -> str:
+        return f"PooledCredential(openai_org_id={self.openai_org_id!r})"
+
+
+class OpenAICredentialPool:
+    """
+    Spreads requests across the API key of the config and its additional_openai_credentials,
+    using smooth weighted round-robin, weighted by the ratelimit each credential reports.
+    - a throttled credential (after a 429) is skipped until its throttle ends, so its traffic fails over to the others
+    - a credential which is rejected (401) or out of quota is disabled for the rest of the job
+    """
+
+    def __init__(
+        self,
+        config: OpenAIChatCompletionConfig,
+        rate_limiters: RateLimiterRegistry,
+        base_url: Optional[str] = None,
+        credentials: Optional[List[OpenAICredential]] = None,
+    ):
+        """
+        by default, the pool is the config's credentials for the config's openai_base_url
+        """
+        if base_url is None:
+            base_url = config.openai_base_url
+        if credentials is None:
+            credentials = [
+                OpenAICredential(
+                    openai_api_key=config.openai_api_key,
+                    openai_org_id=config.openai_org_id,
+                )
+            ]
+            credentials.extend(config.additional_openai_credentials or [])
+        self.credentials = [
+            PooledCredential(
+                credential,
+                rate_limiters.get(
+                    make_ratelimit_domain(
+                        credential.openai_api_key,
+                        credential.openai_org_id,
+                        config.model,
+                        base_url,
+                    )
+                ),
+            )
+            for credential in credentials
+        ]
+
+    def choose(self) -> PooledCredential:
+        """
+        the next credential by smooth weighted round-robin, skipping throttled credentials.
+        When every credential is throttled, the one whose throttle ends first is returned
+        (its rate limiter then waits out the throttle).
+        """
+        enabled_credentials = self._get_enabled_credentials()
+        now = time.monotonic()
+        available_credentials = [
+            credential
+            for credential in enabled_credentials
+            if credential.get_throttle_until_time() <= now
+        ]
+        if len(available_credentials) == 0:
+            return min(
+                enabled_credentials,
+                key=lambda credential: credential.get_throttle_until_time(),
+            )
+        if len(available_credentials) == 1:
+            return available_credentials[0]
+        known_weights = [
+            weight
+            for weight in (
+                credential.get_weight() for credential in available_credentials
+            )
+            if weight is not None
+        ]
+        # until a credential has reported its ratelimit, assume it is average
+        default_weight = (
+            sum(known_weights) / len(known_weights) if len(known_weights) > 0 else 1.0
+        )
+        total_weight = 0.0
+        for credential in available_credentials:
+            weight = credential.get_weight()
+            weight = weight if weight is not None else default_weight
+            credential.current_weight += weight
+            total_weight += weight
+        chosen_credential = max(
+            available_credentials, key=lambda credential: credential.current_weight
+        )
+        chosen_credential.current_weight -= total_weight
+        return chosen_credential
+
+    def _get_enabled_credentials(self) -> List[PooledCredential]:
+        enabled_credentials = [
+            credential
+            for credential in self.credentials
+            if credential.disabled_reason is None
+        ]
+        if len(enabled_credentials) == 0:
+            reasons = [credential.disabled_reason for credential in self.credentials]
+            raise ParallelParrotError(f"All credentials are disabled: {reasons=}")
+        return enabled_credentials
+
+    def get_seconds_until_available(self) -> float:
+        """
+        how long until an enabled credential is no longer throttled (0.0 if one is available now)
+        """
+        throttle_until_time = min(
+            credential.get_throttle_until_time()
+            for credential in self._get_enabled_credentials()
+        )
+        return max(throttle_until_time - time.monotonic(), 0.0)
+
+    def disable(self, credential: PooledCredential, reason: str) -> None:
+        credential.disabled_reason = reason
+        logger.error(f"Disabling {credential} for the rest of the job: {reason}")
+
+    def has_available_credentials(self) -> bool:
+        """
+        whether any credential is neither disabled nor throttled
+        """
+        now = time.monotonic()
+        return any(
+            credential.disabled_reason is None
+            and credential.get_throttle_until_time() <= now
+            for credential in self.credentials
+        )
+
+    def has_enabled_credentials(self) -> bool:
+        return any(
+            credential.disabled_reason is None for credential in self.credentials
+        )
+
+
+def create_openai_http_headers(
+    credential: Union[OpenAICredential, OpenAIChatCompletionConfig]
+) -> dict:
+    headers = {
+        "Content-Type": "application/json",
+        "Authorization": f"Bearer {credential.openai_api_key}",
+    }
+    if credential.openai_org_id:
+        headers["OpenAI-Organization"] = credential.openai_org_id
+    return headers
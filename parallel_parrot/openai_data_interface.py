@@ -5,26 +5,62 @@ except ImportError:
 else:
     pandas_installed = True
 
-from typing import List, Optional, Union
+from collections.abc import Callable
+import hashlib
+import json
+from typing import (
+    AsyncIterable,
+    AsyncIterator,
+    Container,
+    Iterable,
+    List,
+    Optional,
+    Tuple,
+    Union,
+)
 
 from .openai_api import (
-    single_setup_openai_chat_completion,
-    parallel_openai_chat_completion,
+    iter_openai_chat_completion,
+    open_response_cache,
+    open_request_dump,
+    prep_function_call_arguments,
+)
+from .openai_api_lib import OPENAI_EMPTY_USAGE_STATS, ChatCompletionPayloadBuilder
+from .openai_client import OpenAIClient, use_openai_client
+from .checkpoint import CheckpointJournal
+from .openai_batch_api import batch_openai_chat_completion
+from .types import (
+    ExecutionMode,
+    ParallelParrotError,
+    ParallelParrotOutput,
+    OpenAIChatCompletionConfig,
 )
-from .types import ParallelParrotError, ParallelParrotOutput, OpenAIChatCompletionConfig
 from .util import (
     logger,
     sum_usage_stats,
+    aiter_indexed_rows,
 )
 from .util_template import (
-    make_curried_prompt_template,
+    CompiledMessagesTemplate,
+    CompiledPromptTemplate,
+    make_row_prompt_template,
+    prerendered_prompt_template,
 )
 from .util_dictlist import (
     append_model_outputs_dictlist,
     append_one_to_many_model_outputs_dictlist,
     append_one_to_many_objlist_outputs_dictlist,
 )
+from .util_arrow import (
+    ArrowLike,
+    is_arrow_like,
+    to_arrow_table,
+    append_model_outputs_arrow,
+    append_one_to_many_model_outputs_arrow,
+    append_one_to_many_objlist_outputs_arrow,
+)
 from .util_pandas import (
+    is_pandas_dataframe,
     append_model_outputs_pandas,
     append_one_to_many_model_outputs_pandas,
     append_one_to_many_objlist_outputs_pandas,
@@ -36,12 +72,16 @@ async def parallel_openai_chat_completion_dictlist(
     input_list: List[dict],
     prompt_template: str,
     output_key: str,
+    checkpoint_path: Optional[str] = None,
+    client: Optional[OpenAIClient] = None,
 ) -> ParallelParrotOutput:
     (model_outputs, usage_stats_list) = await _parrot_openai_chat_completion(
         config=config,
         input=input_list,
         prompt_template=prompt_template,
         function_output_key_names=None,
+        checkpoint_path=checkpoint_path,
+        client=client,
     )
     if config.n is not None and config.n > 1:
         output_list = append_one_to_many_model_outputs_dictlist(
@@ -67,6 +107,9 @@ async def parallel_openai_chat_completion_pandas(
     input_df: "pd.DataFrame",
     prompt_template: str,
     output_key: str,
+    checkpoint_path: Optional[str] = None,
+    client: Optional[OpenAIClient] = None,
+    new_columns_only: bool = False,
 ) -> ParallelParrotOutput:
     if not pandas_installed:
         raise ParallelParrotError(
@@ -77,10 +120,12 @@ async def parallel_openai_chat_completion_pandas(
         input=input_df,
         prompt_template=prompt_template,
         function_output_key_names=None,
+        checkpoint_path=checkpoint_path,
+        client=client,
     )
     if config.n is not None and config.n > 1:
         output_df = append_one_to_many_model_outputs_pandas(
-            input_df, model_outputs, output_key
+            input_df, model_outputs, output_key, new_columns_only=new_columns_only
         )
         input_num_rows = len(input_df)
         output_num_rows = len(output_df)
@@ -90,16 +135,60 @@ async def parallel_openai_chat_completion_pandas(
             f" {input_num_rows=} {output_num_rows=}"
         )
     else:
-        output_df = append_model_outputs_pandas(input_df, model_outputs, output_key)
+        output_df = append_model_outputs_pandas(
+            input_df, model_outputs, output_key, new_columns_only=new_columns_only
+        )
     usage_stats_sum = sum_usage_stats(usage_stats_list)
     return ParallelParrotOutput(output=output_df, usage_stats=usage_stats_sum)
 
 
+async def parallel_openai_chat_completion_arrow(
+    config: OpenAIChatCompletionConfig,
+    input_data: ArrowLike,
+    prompt_template: str,
+    output_key: str,
+    checkpoint_path: Optional[str] = None,
+    client: Optional[OpenAIClient] = None,
+    new_columns_only: bool = False,
+) -> ParallelParrotOutput:
+    """
+    The same as parallel_openai_chat_completion_pandas(),
+    for a pyarrow Table or RecordBatch, or a polars DataFrame.  The output is of the same type.
+    """
+    (model_outputs, usage_stats_list) = await _parrot_openai_chat_completion(
+        config=config,
+        input=input_data,
+        prompt_template=prompt_template,
+        function_output_key_names=None,
+        checkpoint_path=checkpoint_path,
+        client=client,
+    )
+    if config.n is not None and config.n > 1:
+        output_data = append_one_to_many_model_outputs_arrow(
+            input_data, model_outputs, output_key, new_columns_only=new_columns_only
+        )
+        input_num_rows = len(input_data)
+        output_num_rows = len(output_data)
+        logger.info(
+            "Output may have more rows than input"
+            f" because {config.n=} is greater than 1."
+            f" {input_num_rows=} {output_num_rows=}"
+        )
+    else:
+        output_data = append_model_outputs_arrow(
+            input_data, model_outputs, output_key, new_columns_only=new_columns_only
+        )
+    usage_stats_sum = sum_usage_stats(usage_stats_list)
+    return ParallelParrotOutput(output=output_data, usage_stats=usage_stats_sum)
+
+
 async def parallel_openai_chat_completion_exploding_function_dictlist(
     config: OpenAIChatCompletionConfig,
     input_list: List[dict],
     prompt_template: str,
     output_key_names: List[str],
+    checkpoint_path: Optional[str] = None,
+    client: Optional[OpenAIClient] = None,
 ) -> ParallelParrotOutput:
     """
     Process a prompt which generates a list of objects.
@@ -110,6 +199,8 @@ async def parallel_openai_chat_completion_exploding_function_dictlist(
         input=input_list,
         prompt_template=prompt_template,
         function_output_key_names=output_key_names,
+        checkpoint_path=checkpoint_path,
+        client=client,
     )
     output_list = append_one_to_many_objlist_outputs_dictlist(
         input_list, model_outputs, output_key_names
@@ -129,6 +220,9 @@ async def parallel_openai_chat_completion_exploding_function_pandas(
     input_df: "pd.DataFrame",
     prompt_template: str,
     output_key_names: List[str],
+    checkpoint_path: Optional[str] = None,
+    client: Optional[OpenAIClient] = None,
+    new_columns_only: bool = False,
 ) -> ParallelParrotOutput:
     if not pandas_installed:
         raise ParallelParrotError(
@@ -139,9 +233,11 @@ async def parallel_openai_chat_completion_exploding_function_pandas(
         input=input_df,
         prompt_template=prompt_template,
         function_output_key_names=output_key_names,
+        checkpoint_path=checkpoint_path,
+        client=client,
     )
     output_df = append_one_to_many_objlist_outputs_pandas(
-        input_df, model_outputs, output_key_names
+        input_df, model_outputs, output_key_names, new_columns_only=new_columns_only
     )
     input_num_rows = len(input_df)
     output_num_rows = len(output_df)
@@ -153,44 +249,238 @@ async def parallel_openai_chat_completion_exploding_function_pandas(
     return ParallelParrotOutput(output=output_df, usage_stats=usage_stats_sum)
 
 
-async def _parrot_openai_chat_completion(
+async def parallel_openai_chat_completion_exploding_function_arrow(
     config: OpenAIChatCompletionConfig,
-    input: Union[List[dict], "pd.DataFrame"],
+    input_data: ArrowLike,
     prompt_template: str,
-    function_output_key_names: Optional[List[str]],
+    output_key_names: List[str],
+    checkpoint_path: Optional[str] = None,
+    client: Optional[OpenAIClient] = None,
+    new_columns_only: bool = False,
 ) -> ParallelParrotOutput:
-    curried_prompt_template = make_curried_prompt_template(prompt_template)
-    # process a single row first, both to check for errors and to get the ratelimit_limit_requests
-    if isinstance(input, list):
-        first_row = input[0]
-    elif isinstance(input, pd.DataFrame):
-        first_row = input.iloc[0]
+    (model_outputs, usage_stats_list) = await _parrot_openai_chat_completion(
+        config=config,
+        input=input_data,
+        prompt_template=prompt_template,
+        function_output_key_names=output_key_names,
+        checkpoint_path=checkpoint_path,
+        client=client,
+    )
+    output_data = append_one_to_many_objlist_outputs_arrow(
+        input_data, model_outputs, output_key_names, new_columns_only=new_columns_only
+    )
+    input_num_rows = len(input_data)
+    output_num_rows = len(output_data)
+    logger.info(
+        "Output may have more rows than input because we are asking for a list of objects."
+        f" {input_num_rows=} {output_num_rows=}"
+    )
+    usage_stats_sum = sum_usage_stats(usage_stats_list)
+    return ParallelParrotOutput(output=output_data, usage_stats=usage_stats_sum)
+
+
+async def parallel_openai_chat_completion_stream(
+    config: OpenAIChatCompletionConfig,
+    input_rows: Union[Iterable[dict], AsyncIterable[dict], "pd.DataFrame", ArrowLike],
+    prompt_template: str,
+    function_output_key_names: Optional[List[str]],
+    client: Optional[OpenAIClient] = None,
+) -> AsyncIterator[Tuple[int, Union[None, str, list], dict]]:
+    """
+    Yield (row_index, model_output, usage) as each row completes, in completion order.
+    Input rows are read lazily, so neither the inputs nor the outputs need to fit in memory.
+    """
+    compiled_prompt_template = make_row_prompt_template(
+        prompt_template, config.history_key
+    )
+    if is_pandas_dataframe(input_rows):
+        input_rows = compiled_prompt_template.render_pandas(input_rows)
+        curried_prompt_template: Callable = prerendered_prompt_template
+    elif is_arrow_like(input_rows):
+        input_rows = compiled_prompt_template.render_arrow(to_arrow_table(input_rows))
+        curried_prompt_template = prerendered_prompt_template
+    elif hasattr(input_rows, "__aiter__"):
+        curried_prompt_template = compiled_prompt_template
     else:
-        raise ParallelParrotError(f"Unexpected type {type(input)=}")
-    (
-        model_output,
-        usage_stats,
-        ratelimit_limit_requests,
-    ) = await single_setup_openai_chat_completion(
+        input_rows = compiled_prompt_template.render_many(input_rows)
+        curried_prompt_template = prerendered_prompt_template
+    async for result in _iter_parrot_openai_chat_completion(
         config=config,
-        input_row=first_row,
+        indexed_rows=aiter_indexed_rows(input_rows),
         curried_prompt_template=curried_prompt_template,
         function_output_key_names=function_output_key_names,
+        client=client,
+    ):
+        yield result
+
+
+async def _parrot_openai_chat_completion(
+    config: OpenAIChatCompletionConfig,
+    input: Union[List[dict], "pd.DataFrame", ArrowLike],
+    prompt_template: str,
+    function_output_key_names: Optional[List[str]],
+    checkpoint_path: Optional[str] = None,
+    client: Optional[OpenAIClient] = None,
+) -> ParallelParrotOutput:
+    # the prompts are rendered as the rows are read, and the request engine is sent plain strings
+    # (or lists of messages, with config.history_key)
+    compiled_prompt_template = make_row_prompt_template(
+        prompt_template, config.history_key
     )
-    model_outputs = [model_output]
-    usage_stats_list = [usage_stats]
-    if len(input) >= 2:
-        if isinstance(input, list):
-            nonfirst_rows = input[1:]
-        elif isinstance(input, pd.DataFrame):
-            nonfirst_rows = input.iloc[1:, :]
-        (_model_outputs, _usage_stats_list) = await parallel_openai_chat_completion(
+    input_rows = _render_input_rows(compiled_prompt_template, input)
+    num_rows = len(input)
+    model_outputs: list = [None] * num_rows
+    usage_stats_list: List[dict] = [OPENAI_EMPTY_USAGE_STATS] * num_rows
+    if checkpoint_path is not None:
+        (
+            _,
+            _,
+            functions,
+            function_call,
+            function_system_prompt,
+        ) = prep_function_call_arguments(function_output_key_names)
+        payload_builder = ChatCompletionPayloadBuilder(
             config=config,
-            input_table=nonfirst_rows,
-            curried_prompt_template=curried_prompt_template,
-            function_output_key_names=function_output_key_names,
-            ratelimit_limit_requests=ratelimit_limit_requests,
+            functions=functions,
+            function_call=function_call,
+            function_system_prompt=function_system_prompt,
+        )
+        job_description = {
+            "model": config.model,
+            "prompt_template": prompt_template,
+            "function_output_key_names": function_output_key_names,
+            "num_rows": num_rows,
+            # e.g. the system_message, prefix_messages and sampling parameters
+            "payload_sha256": payload_builder.get_fingerprint(),
+            "input_sha256": _make_input_fingerprint(compiled_prompt_template, input),
+        }
+        if config.history_key is not None:
+            job_description["history_key"] = config.history_key
+        checkpoint_journal: Optional[CheckpointJournal] = CheckpointJournal(
+            checkpoint_path, job_description=job_description
         )
-        model_outputs += _model_outputs
-        usage_stats_list += _usage_stats_list
+        completed_rows = checkpoint_journal.load()
+        for row_index, (model_output, usage_stats) in completed_rows.items():
+            model_outputs[row_index] = model_output
+            usage_stats_list[row_index] = usage_stats
+        skipped_rows: Container[int] = completed_rows
+        if len(checkpoint_journal.pending_batches) > 0:
+            # the rows of batches which were already submitted are polled, not sent again
+            skipped_rows = set(completed_rows).union(
+                *checkpoint_journal.pending_batches.values()
+            )
+    else:
+        checkpoint_journal = None
+        skipped_rows = set()
+    try:
+        async for (
+            row_index,
+            model_output,
+            usage_stats,
+        ) in _iter_parrot_openai_chat_completion(
+            config=config,
+            indexed_rows=_aiter_pending_indexed_rows(input_rows, skipped_rows),
+            curried_prompt_template=prerendered_prompt_template,
+            function_output_key_names=function_output_key_names,
+            client=client,
+            checkpoint_journal=checkpoint_journal,
+        ):
+            model_outputs[row_index] = model_output
+            usage_stats_list[row_index] = usage_stats
+            if checkpoint_journal is not None:
+                checkpoint_journal.append(row_index, model_output, usage_stats)
+    finally:
+        if checkpoint_journal is not None:
+            checkpoint_journal.close()
     return ParallelParrotOutput(output=model_outputs, usage_stats=usage_stats_list)
+
+
+def _render_input_rows(
+    compiled_prompt_template: Union[CompiledPromptTemplate, CompiledMessagesTemplate],
+    input: Union[List[dict], "pd.DataFrame", ArrowLike],
+) -> Iterable:
+    if isinstance(input, list):
+        return compiled_prompt_template.render_many(input)
+    elif is_pandas_dataframe(input):
+        return compiled_prompt_template.render_pandas(input)
+    elif is_arrow_like(input):
+        return compiled_prompt_template.render_arrow(to_arrow_table(input))
+    raise ParallelParrotError(f"Unexpected type {type(input)=}")
+
+
+def _make_input_fingerprint(
+    compiled_prompt_template: Union[CompiledPromptTemplate, CompiledMessagesTemplate],
+    input: Union[List[dict], "pd.DataFrame", ArrowLike],
+) -> str:
+    """
+    a hash of the prompts of the first and last rows, which is cheap even for large inputs,
+    but still tells most different inputs with the same number of rows apart
+    """
+    num_rows = len(input)
+    if num_rows == 0:
+        sample_rows = input
+    elif isinstance(input, list):
+        sample_rows = [input[0], input[-1]]
+    elif is_pandas_dataframe(input):
+        sample_rows = input.iloc[[0, num_rows - 1]]
+    else:
+        sample_rows = to_arrow_table(input).take([0, num_rows - 1])
+    sample_prompts = list(_render_input_rows(compiled_prompt_template, sample_rows))
+    serialized_prompts = json.dumps(sample_prompts, sort_keys=True)
+    return hashlib.sha256(serialized_prompts.encode("utf-8")).hexdigest()
+
+
+async def _iter_parrot_openai_chat_completion(
+    config: OpenAIChatCompletionConfig,
+    indexed_rows: AsyncIterator[Tuple[int, Union[dict, "pd.Series"]]],
+    curried_prompt_template: Callable,
+    function_output_key_names: Optional[List[str]],
+    client: Optional[OpenAIClient] = None,
+    checkpoint_journal: Optional[CheckpointJournal] = None,
+) -> AsyncIterator[Tuple[int, Union[None, str, list], dict]]:
+    # the setup request and the parallel requests share one connection pool
+    async with use_openai_client(client) as openai_client:
+        if config.execution_mode == ExecutionMode.BATCH:
+            response_cache = open_response_cache(config)
+            try:
+                async for result in batch_openai_chat_completion(
+                    config=config,
+                    indexed_rows=indexed_rows,
+                    curried_prompt_template=curried_prompt_template,
+                    function_output_key_names=function_output_key_names,
+                    response_cache=response_cache,
+                    openai_client=openai_client,
+                    checkpoint_journal=checkpoint_journal,
+                ):
+                    yield result
+            finally:
+                if response_cache is not None:
+                    response_cache.close()
+            return
+        response_cache = open_response_cache(config)
+        request_dump = open_request_dump(config)
+        try:
+            async for result in iter_openai_chat_completion(
+                config=config,
+                indexed_rows=indexed_rows,
+                curried_prompt_template=curried_prompt_template,
+                function_output_key_names=function_output_key_names,
+                response_cache=response_cache,
+                openai_client=openai_client,
+                request_dump=request_dump,
+            ):
+                yield result
+        finally:
+            if response_cache is not None:
+                response_cache.close()
+            if request_dump is not None:
+                request_dump.close()
+
+
+async def _aiter_pending_indexed_rows(
+    input_rows: Iterable, skipped_rows: Container[int]
+) -> AsyncIterator[Tuple[int, Union[dict, str]]]:
+    for row_index, input_row in enumerate(input_rows):
+        if row_index in skipped_rows:
+            continue
+        yield (row_index, input_row)
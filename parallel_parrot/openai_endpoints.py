@@ -0,0 +1,136 @@
+import asyncio
+from typing import List, Optional
+
+from .openai_credentials import OpenAICredentialPool
+from .openai_ratelimit import RateLimiterRegistry
+from .types import (
+    OpenAIChatCompletionConfig,
+    OpenAICredential,
+    OpenAIEndpoint,
+    ParallelParrotError,
+)
+
+
+CHAT_COMPLETIONS_PATH = "/chat/completions"
+
+
+class EndpointState:
+    def __init__(
+        self,
+        endpoint: OpenAIEndpoint,
+        credential_pool: OpenAICredentialPool,
+    ):
+        self.base_url = endpoint.base_url.rstrip("/")
+        self.chat_completions_url = self.base_url + CHAT_COMPLETIONS_PATH
+        self.weight = max(endpoint.weight, 1)
+        self.max_concurrent_requests = endpoint.max_concurrent_requests
+        self.credential_pool = credential_pool
+        self.num_in_flight = 0
+
+    def has_capacity(self) -> bool:
+        return (
+            self.max_concurrent_requests is None
+            or self.num_in_flight < self.max_concurrent_requests
+        )
+
+    def __repr__(self) -> str:
+        return f"EndpointState(base_url={self.base_url!r})"
+
+
+class OpenAIEndpointRouter:
+    """
+    Routes each request to the endpoint with the fewest in-flight requests (relative to its weight),
+    among the endpoints which are below their max_concurrent_requests.
+    Endpoints whose credentials are all throttled (after a 429) are skipped while any other endpoint is not.
+    Without openai_endpoints in the config, there is a single endpoint at openai_base_url.
+    Each endpoint has its own credential pool, so its ratelimits and failures do not affect the others.
+    """
+
+    def __init__(
+        self,
+        config: OpenAIChatCompletionConfig,
+        rate_limiters: RateLimiterRegistry,
+    ):
+        endpoints = config.openai_endpoints or [
+            OpenAIEndpoint(base_url=config.openai_base_url)
+        ]
+        self.endpoints: List[EndpointState] = []
+        for endpoint in endpoints:
+            if endpoint.openai_api_key is not None:
+                credentials: Optional[List[OpenAICredential]] = [
+                    OpenAICredential(openai_api_key=endpoint.openai_api_key)
+                ]
+            else:
+                credentials = None
+            credential_pool = OpenAICredentialPool(
+                config,
+                rate_limiters,
+                base_url=endpoint.base_url.rstrip("/"),
+                credentials=credentials,
+            )
+            self.endpoints.append(EndpointState(endpoint, credential_pool))
+        self._capacity_released: Optional[asyncio.Condition] = None
+
+    async def acquire(self) -> EndpointState:
+        """
+        wait until an endpoint has capacity, and reserve a request slot on it
+        """
+        while True:
+            enabled_endpoints = [
+                endpoint
+                for endpoint in self.endpoints
+                if endpoint.credential_pool.has_enabled_credentials()
+            ]
+            if len(enabled_endpoints) == 0:
+                raise ParallelParrotError(
+                    f"No endpoints with enabled credentials: {self.endpoints=}"
+                )
+            # endpoints whose credentials are all throttled are only used when every endpoint is,
+            # so waiting for capacity on an unthrottled endpoint is preferred over waiting out a throttle
+            candidate_endpoints = [
+                endpoint
+                for endpoint in enabled_endpoints
+                if endpoint.credential_pool.has_available_credentials()
+            ] or enabled_endpoints
+            available_endpoints = [
+                endpoint for endpoint in candidate_endpoints if endpoint.has_capacity()
+            ]
+            if len(available_endpoints) > 0:
+                endpoint = min(
+                    available_endpoints,
+                    key=lambda endpoint: (endpoint.num_in_flight + 1) / endpoint.weight,
+                )
+                endpoint.num_in_flight += 1
+                return endpoint
+            if self._capacity_released is None:
+                self._capacity_released = asyncio.Condition()
+            async with self._capacity_released:
+                await self._capacity_released.wait()
+
+    async def release(self, endpoint: EndpointState) -> None:
+        endpoint.num_in_flight -= 1
+        if self._capacity_released is not None:
+            async with self._capacity_released:
+                self._capacity_released.notify()
+
+    def has_enabled_endpoints(self) -> bool:
+        return any(
+            endpoint.credential_pool.has_enabled_credentials()
+            for endpoint in self.endpoints
+        )
+
+    def has_available_credentials(self) -> bool:
+        return any(
+            endpoint.credential_pool.has_available_credentials()
+            for endpoint in self.endpoints
+        )
+
+    def get_seconds_until_available(self) -> float:
+        """
+        how long until any endpoint has a credential which is no longer throttled
+        """
+        return min(
+            endpoint.credential_pool.get_seconds_until_available()
+            for endpoint in self.endpoints
+            if endpoint.credential_pool.has_enabled_credentials()
+        )
@@ -0,0 +1,224 @@
+import asyncio
+import hashlib
+import time
+from typing import Dict, NamedTuple, Optional
+
+from .openai_api_lib import parse_seconds_from_header
+from .util import logger
+
+
+SECONDS_PER_MINUTE = 60.0
+MIN_ACQUIRE_SLEEP_SECONDS = 0.01
+# the "type" of a rate_limit_exceeded error, and the suffix of the matching x-ratelimit-* headers
+RATELIMIT_TYPES = ("requests", "tokens")
+
+
+class RateLimitDomain(NamedTuple):
+    """
+    OpenAI ratelimits are tracked separately per organization and model.
+    The key is included (as a hash), because different keys may belong to different organizations.
+    The base_url is included, because other OpenAI-compatible servers have their own ratelimits.
+    """
+
+    api_key_hash: str
+    org_id: Optional[str]
+    model: str
+    base_url: str
+
+
+def make_ratelimit_domain(
+    openai_api_key: str, openai_org_id: Optional[str], model: str, base_url: str
+) -> RateLimitDomain:
+    api_key_hash = hashlib.sha256(openai_api_key.encode("utf-8")).hexdigest()
+    return RateLimitDomain(
+        api_key_hash=api_key_hash[:16],
+        org_id=openai_org_id,
+        model=model,
+        base_url=base_url,
+    )
+
+
+class TokenBucket:
+    """
+    A bucket which refills continuously up to its limit.
+    The refill rate defaults to the full limit per minute, which is how OpenAI ratelimits are defined.
+    https://platform.openai.com/docs/guides/rate-limits/overview
+    """
+
+    def __init__(self, limit: float):
+        self.limit = float(limit)
+        self.remaining = float(limit)
+        self.refill_per_second = self.limit / SECONDS_PER_MINUTE
+        self.updated_time = time.monotonic()
+
+    def refill(self, now: float) -> None:
+        elapsed_seconds = max(now - self.updated_time, 0.0)
+        self.remaining = min(
+            self.limit, self.remaining + (elapsed_seconds * self.refill_per_second)
+        )
+        self.updated_time = now
+
+    def seconds_until_available(self, amount: float) -> float:
+        # a single request larger than the whole bucket only waits for a full bucket
+        amount = min(amount, self.limit)
+        deficit = amount - self.remaining
+        if deficit <= 0:
+            return 0.0
+        return deficit / self.refill_per_second
+
+    def update(
+        self,
+        limit: Optional[float],
+        remaining: Optional[float],
+        reset_seconds: Optional[float],
+        now: float,
+    ) -> None:
+        self.refill(now)
+        if limit is not None and limit > 0:
+            self.limit = limit
+            self.refill_per_second = self.limit / SECONDS_PER_MINUTE
+        if remaining is not None:
+            # the server does not know about our in-flight requests yet, so only ever lower our estimate
+            self.remaining = min(self.remaining, remaining)
+            if reset_seconds is not None and reset_seconds > 0:
+                # the reset header is the time until the bucket is full again
+                self.refill_per_second = max(
+                    (self.limit - remaining) / reset_seconds,
+                    self.limit / SECONDS_PER_MINUTE,
+                )
+
+
+class OpenAIRateLimiter:
+    """
+    Client-side ratelimiter which tracks both the requests-per-minute and the tokens-per-minute budgets,
+    and keeps its state in sync with the x-ratelimit-* response headers.
+    After a 429, requests are also throttled until the reset time of the exceeded ratelimit type.
+    https://platform.openai.com/docs/guides/rate-limits/rate-limits-in-headers
+    """
+
+    def __init__(
+        self,
+        limit_requests: Optional[int] = None,
+        limit_tokens: Optional[int] = None,
+    ):
+        self.request_bucket = (
+            TokenBucket(limit_requests) if limit_requests is not None else None
+        )
+        self.token_bucket = (
+            TokenBucket(limit_tokens) if limit_tokens is not None else None
+        )
+        self.throttle_until_times: Dict[str, float] = {
+            ratelimit_type: 0.0 for ratelimit_type in RATELIMIT_TYPES
+        }
+
+    @classmethod
+    def from_headers(cls, headers: dict) -> "OpenAIRateLimiter":
+        rate_limiter = cls(
+            limit_requests=_parse_int_header(headers, "x-ratelimit-limit-requests"),
+            limit_tokens=_parse_int_header(headers, "x-ratelimit-limit-tokens"),
+        )
+        rate_limiter.update_from_headers(headers)
+        return rate_limiter
+
+    def throttle(self, ratelimit_type: Optional[str], seconds: float) -> None:
+        """
+        pause requests for seconds.  If the type of the exceeded ratelimit is unknown, both types are throttled.
+        """
+        throttle_until_time = time.monotonic() + seconds
+        for throttle_type in RATELIMIT_TYPES:
+            if ratelimit_type is None or ratelimit_type == throttle_type:
+                self.throttle_until_times[throttle_type] = max(
+                    self.throttle_until_times[throttle_type], throttle_until_time
+                )
+        logger.warning(
+            "Throttling ratelimit_type=%r for seconds=%s throttle_until_times=%s",
+            ratelimit_type,
+            seconds,
+            self.throttle_until_times,
+        )
+
+    async def acquire(self, num_tokens: int) -> None:
+        """
+        wait until there is budget for one request using num_tokens, then reserve it
+        """
+        while True:
+            now = time.monotonic()
+            wait_seconds = max(
+                throttle_until_time - now
+                for throttle_until_time in self.throttle_until_times.values()
+            )
+            if self.request_bucket is not None:
+                self.request_bucket.refill(now)
+                wait_seconds = max(
+                    wait_seconds, self.request_bucket.seconds_until_available(1)
+                )
+            if self.token_bucket is not None:
+                self.token_bucket.refill(now)
+                wait_seconds = max(
+                    wait_seconds, self.token_bucket.seconds_until_available(num_tokens)
+                )
+            if wait_seconds <= 0:
+                if self.request_bucket is not None:
+                    self.request_bucket.remaining -= 1
+                if self.token_bucket is not None:
+                    self.token_bucket.remaining -= num_tokens
+                return
+            logger.debug(
+                "Waiting for ratelimit budget wait_seconds=%s num_tokens=%s",
+                wait_seconds,
+                num_tokens,
+            )
+            await asyncio.sleep(max(wait_seconds, MIN_ACQUIRE_SLEEP_SECONDS))
+
+    def update_from_headers(self, headers: dict) -> None:
+        now = time.monotonic()
+        limit_requests = _parse_int_header(headers, "x-ratelimit-limit-requests")
+        remaining_requests = _parse_int_header(
+            headers, "x-ratelimit-remaining-requests"
+        )
+        reset_requests = parse_seconds_from_header(
+            headers.get("x-ratelimit-reset-requests")
+        )
+        if self.request_bucket is None and limit_requests is not None:
+            self.request_bucket = TokenBucket(limit_requests)
+        if self.request_bucket is not None:
+            self.request_bucket.update(
+                limit_requests, remaining_requests, reset_requests, now
+            )
+        limit_tokens = _parse_int_header(headers, "x-ratelimit-limit-tokens")
+        remaining_tokens = _parse_int_header(headers, "x-ratelimit-remaining-tokens")
+        reset_tokens = parse_seconds_from_header(
+            headers.get("x-ratelimit-reset-tokens")
+        )
+        if self.token_bucket is None and limit_tokens is not None:
+            self.token_bucket = TokenBucket(limit_tokens)
+        if self.token_bucket is not None:
+            self.token_bucket.update(limit_tokens, remaining_tokens, reset_tokens, now)
+
+
+def _parse_int_header(headers: dict, name: str) -> Optional[int]:
+    value = headers.get(name)
+    if value is None:
+        return None
+    try:
+        return int(value)
+    except ValueError:
+        logger.warning(f"Could not parse ratelimit header {name=} {value=}")
+        return None
+
+
+class RateLimiterRegistry:
+    """
+    One OpenAIRateLimiter per RateLimitDomain, so that jobs which share a domain share its budget and throttling,
+    and jobs in other domains do not block each other.
+    """
+
+    def __init__(self):
+        self.rate_limiters: Dict[RateLimitDomain, OpenAIRateLimiter] = {}
+
+    def get(self, domain: RateLimitDomain) -> OpenAIRateLimiter:
+        rate_limiter = self.rate_limiters.get(domain)
+        if rate_limiter is None:
+            rate_limiter = OpenAIRateLimiter()
+            self.rate_limiters[domain] = rate_limiter
+        return rate_limiter
@@ -1,9 +1,156 @@
+from functools import lru_cache
+import json
+from typing import List, Optional
+
 import tiktoken
 
 
+# https://platform.openai.com/docs/models
+# matched by the longest prefix of the model name, so that dated snapshots share their family's window
+OPENAI_MODEL_CONTEXT_WINDOW_TOKENS = {
+    "gpt-4o": 128000,
+    "gpt-4-turbo": 128000,
+    "gpt-4-1106": 128000,
+    "gpt-4-0125": 128000,
+    "gpt-4-vision": 128000,
+    "gpt-4-32k": 32768,
+    "gpt-4": 8192,
+    "gpt-3.5-turbo-instruct": 4096,
+    "gpt-3.5-turbo-0301": 4096,
+    "gpt-3.5-turbo-0613": 4096,
+    "gpt-3.5-turbo-16k": 16385,
+    "gpt-3.5-turbo": 16385,
+}
+# every chat message is wrapped in a few special tokens, and the reply is primed with a few more
+# https://github.com/openai/openai-cookbook/blob/main/examples/How_to_count_tokens_with_tiktoken.ipynb
+TOKENS_PER_MESSAGE = 3
+TOKENS_PER_REPLY = 3
+# tiktoken releases the GIL while encoding, so a batch is encoded in parallel threads
+TOKENIZER_NUM_THREADS = 8
+
+
+@lru_cache(maxsize=None)
+def get_encoding_for_model(model: str) -> tiktoken.Encoding:
+    """
+    the tiktoken encoding of a model, which is loaded once per process.
+    Unknown models (e.g. fine-tuned or self-hosted ones) use cl100k_base.
+    """
+    try:
+        return tiktoken.encoding_for_model(model)
+    except KeyError:
+        return tiktoken.get_encoding("cl100k_base")
+
+
+def encode_tokens_batch(texts: List[str], model: str) -> List[List[int]]:
+    """
+    the tokens of each of the texts, encoded in parallel.
+    Special tokens (e.g. "<|endoftext|>") in the texts are encoded as ordinary text.
+    """
+    if len(texts) == 0:
+        return []
+    encoding = get_encoding_for_model(model)
+    return encoding.encode_ordinary_batch(texts, num_threads=TOKENIZER_NUM_THREADS)
+
+
+def count_tokens_batch(texts: List[str], model: str) -> List[int]:
+    """
+    the number of tokens in each of the texts, encoded in parallel
+    """
+    return [len(tokens) for tokens in encode_tokens_batch(texts, model)]
+
+
 def openai_token_truncate(input: str, model: str, tokens_to_remove: int):
-    encoding = tiktoken.encoding_for_model(model)
-    encoded_tokens = encoding.encode(input)
+    encoding = get_encoding_for_model(model)
+    encoded_tokens = encoding.encode_ordinary(input)
     max_tokens = len(encoded_tokens) - tokens_to_remove
     truncated_tokens = encoded_tokens[:max_tokens]
     return encoding.decode(truncated_tokens)
+
+
+def get_model_context_window_tokens(model: str) -> Optional[int]:
+    """
+    returns None for models which are not in OPENAI_MODEL_CONTEXT_WINDOW_TOKENS.
+    Fine-tuned models (e.g. "ft:gpt-3.5-turbo-0613:org::id") use the window of their base model.
+    """
+    if model.startswith("ft:"):
+        model = model.split(":")[1]
+    matching_prefixes = [
+        prefix
+        for prefix in OPENAI_MODEL_CONTEXT_WINDOW_TOKENS
+        if model.startswith(prefix)
+    ]
+    if len(matching_prefixes) == 0:
+        return None
+    return OPENAI_MODEL_CONTEXT_WINDOW_TOKENS[max(matching_prefixes, key=len)]
+
+
+def count_payload_prefix_tokens(payload: dict, num_prefix_messages: int) -> int:
+    """
+    the number of tokens in the first num_prefix_messages messages and the function definitions of a payload,
+    which are the same for every row of a job, so they can be counted once (see ChatCompletionPayloadBuilder)
+    """
+    encoding = get_encoding_for_model(payload["model"])
+    texts = [
+        message.get("content") or ""
+        for message in payload["messages"][:num_prefix_messages]
+    ]
+    functions = payload.get("functions")
+    if functions is not None:
+        # an approximation - the API serializes the function definitions differently
+        texts.append(json.dumps(functions, separators=(",", ":")))
+    return sum(len(encoding.encode_ordinary(text)) for text in texts)
+
+
+def fit_payload_to_context_window(
+    payload: dict,
+    num_prefix_messages: int = 0,
+    num_prefix_tokens: Optional[int] = None,
+) -> Optional[int]:
+    """
+    truncate the content of the last message in a chat completion payload (in place),
+    so that the prompt and max_tokens of completion fit in the context window of the model.
+    If num_prefix_tokens is given (from count_payload_prefix_tokens()), the first num_prefix_messages messages
+    and the functions are not tokenized again.
+    Returns the number of tokens removed, or None if the context window of the model is unknown.
+    """
+    model = payload["model"]
+    context_window_tokens = get_model_context_window_tokens(model)
+    if context_window_tokens is None:
+        return None
+    messages: List[dict] = payload["messages"]
+    if num_prefix_tokens is None or num_prefix_messages >= len(messages):
+        num_prefix_messages = 0
+        num_prefix_tokens = None
+    other_texts = [
+        message.get("content") or "" for message in messages[num_prefix_messages:-1]
+    ]
+    if num_prefix_tokens is None:
+        num_prefix_tokens = 0
+        functions = payload.get("functions")
+        if functions is not None:
+            # an approximation - the API serializes the function definitions differently
+            other_texts.append(json.dumps(functions, separators=(",", ":")))
+    prompt = messages[-1].get("content") or ""
+    max_total_tokens = (
+        context_window_tokens
+        - (payload.get("max_tokens") or 0)
+        - TOKENS_PER_REPLY
+        - TOKENS_PER_MESSAGE * len(messages)
+        - num_prefix_tokens
+    )
+    # every token is at least one byte, so most prompts fit without encoding them
+    num_bytes = sum(len(text.encode("utf-8")) for text in other_texts + [prompt])
+    if num_bytes <= max_total_tokens:
+        return 0
+    encoding = get_encoding_for_model(model)
+    max_prompt_tokens = max_total_tokens - sum(
+        len(encoding.encode_ordinary(text)) for text in other_texts
+    )
+    prompt_tokens = encoding.encode_ordinary(prompt)
+    tokens_to_remove = len(prompt_tokens) - max(max_prompt_tokens, 0)
+    if tokens_to_remove <= 0:
+        return 0
+    messages[-1] = dict(
+        messages[-1], content=encoding.decode(prompt_tokens[:-tokens_to_remove])
+    )
+    return tokens_to_remove
@@ -0,0 +1,51 @@
+import json
+from pathlib import Path
+import random
+import time
+from typing import Optional, Union
+
+from .openai_api_lib import OpenAIResponseData
+
+
+class RequestDumpWriter:
+    """
+    Appends a random sample of requests, with their full payloads and responses, to a JSONL file for debugging.
+    Each line has the time, url, payload, response status, headers, and body of one request.
+    """
+
+    def __init__(
+        self,
+        path: Union[str, Path],
+        sample_rate: float = 1.0,
+        seed: Optional[int] = None,
+    ):
+        self.path = Path(path).resolve()
+        self.sample_rate = sample_rate
+        self._random = random.Random(seed)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.filehandle = self.path.open("a")
+
+    def close(self) -> None:
+        self.filehandle.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def should_dump(self) -> bool:
+        return self._random.random() < self.sample_rate
+
+    def write(self, url: str, payload: dict, response_data: OpenAIResponseData) -> None:
+        record = {
+            "time": time.time(),
+            "url": url,
+            "payload": payload,
+            "status": response_data.status,
+            "headers": response_data.headers,
+            "body": response_data.body_from_json,
+        }
+        self.filehandle.write(json.dumps(record) + "\n")
+        # so that the dump survives a crash, which is usually when it is needed
+        self.filehandle.flush()
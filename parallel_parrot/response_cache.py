@@ -0,0 +1,224 @@
+import hashlib
+import json
+from pathlib import Path
+import sqlite3
+import time
+from typing import Any, Dict, Optional, Union
+
+from .util import logger
+
+
+# fields which do not change the model output, and so should not change the cache key
+VOLATILE_PAYLOAD_KEYS = ["user", "stream"]
+# writes (and access time updates) are committed together, once there are this many of them,
+# or after COMMIT_INTERVAL_SECONDS, rather than with a commit per request on the event loop
+COMMIT_BATCH_SIZE = 100
+COMMIT_INTERVAL_SECONDS = 1.0
+
+
+class SQLiteResponseCache:
+    """
+    A persistent cache of successful response bodies, keyed by a hash of the request payload.
+    - entries older than ttl_seconds are treated as misses
+    - the least recently used entries are evicted once the stored bodies exceed max_bytes
+    Writes are committed in batches, so the last second or so of writes is lost if the process is killed.
+    """
+
+    def __init__(
+        self,
+        path: Union[str, Path],
+        ttl_seconds: Optional[float] = None,
+        max_bytes: Optional[int] = None,
+    ):
+        self.path = Path(path).resolve()
+        self.ttl_seconds = ttl_seconds
+        self.max_bytes = max_bytes
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.connection = sqlite3.connect(str(self.path))
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.connection.execute(
+            """
+            CREATE TABLE IF NOT EXISTS responses (
+                key TEXT PRIMARY KEY,
+                body TEXT NOT NULL,
+                num_bytes INTEGER NOT NULL,
+                created_time REAL NOT NULL,
+                accessed_time REAL NOT NULL
+            )
+            """
+        )
+        self.connection.execute(
+            "CREATE INDEX IF NOT EXISTS responses_accessed_time ON responses (accessed_time)"
+        )
+        self.connection.commit()
+        (total_bytes,) = self.connection.execute(
+            "SELECT COALESCE(SUM(num_bytes), 0) FROM responses"
+        ).fetchone()
+        self.total_bytes = total_bytes
+        # key -> accessed_time, for the hits since the last commit
+        self._pending_accessed_times: Dict[str, float] = {}
+        self._num_uncommitted_writes = 0
+        self._last_commit_time = time.monotonic()
+
+    def close(self) -> None:
+        self.commit()
+        self.connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def get(self, payload: dict) -> Optional[dict]:
+        return self.get_by_key(make_payload_cache_key(payload))
+
+    def put(self, payload: dict, body_from_json: dict) -> None:
+        self.put_by_key(make_payload_cache_key(payload), body_from_json)
+
+    def get_by_key(self, key: str) -> Optional[dict]:
+        row = self.connection.execute(
+            "SELECT body, num_bytes, created_time FROM responses WHERE key = ?", (key,)
+        ).fetchone()
+        if row is None:
+            return None
+        (body, num_bytes, created_time) = row
+        now = time.time()
+        if self.ttl_seconds is not None and created_time + self.ttl_seconds < now:
+            self._delete(key, num_bytes)
+            return None
+        self._pending_accessed_times[key] = now
+        self._maybe_commit()
+        return json.loads(body)
+
+    def put_by_key(self, key: str, body_from_json: dict) -> None:
+        body = json.dumps(body_from_json, separators=(",", ":"))
+        num_bytes = len(body)
+        now = time.time()
+        existing_row = self.connection.execute(
+            "SELECT num_bytes FROM responses WHERE key = ?", (key,)
+        ).fetchone()
+        if existing_row is not None:
+            self.total_bytes -= existing_row[0]
+        self.connection.execute(
+            "INSERT OR REPLACE INTO responses (key, body, num_bytes, created_time, accessed_time)"
+            " VALUES (?, ?, ?, ?, ?)",
+            (key, body, num_bytes, now, now),
+        )
+        self._pending_accessed_times.pop(key, None)
+        self.total_bytes += num_bytes
+        self._num_uncommitted_writes += 1
+        self._evict()
+        self._maybe_commit()
+
+    def commit(self) -> None:
+        self._write_accessed_times()
+        self.connection.commit()
+        self._num_uncommitted_writes = 0
+        self._last_commit_time = time.monotonic()
+
+    def _maybe_commit(self) -> None:
+        num_pending = self._num_uncommitted_writes + len(self._pending_accessed_times)
+        if (
+            num_pending >= COMMIT_BATCH_SIZE
+            or time.monotonic() - self._last_commit_time >= COMMIT_INTERVAL_SECONDS
+        ):
+            self.commit()
+
+    def _write_accessed_times(self) -> None:
+        if len(self._pending_accessed_times) == 0:
+            return
+        self.connection.executemany(
+            "UPDATE responses SET accessed_time = ? WHERE key = ?",
+            [
+                (accessed_time, key)
+                for key, accessed_time in self._pending_accessed_times.items()
+            ],
+        )
+        self._pending_accessed_times.clear()
+
+    def _delete(self, key: str, num_bytes: int) -> None:
+        self.connection.execute("DELETE FROM responses WHERE key = ?", (key,))
+        self._pending_accessed_times.pop(key, None)
+        self.total_bytes -= num_bytes
+        self._num_uncommitted_writes += 1
+        self._maybe_commit()
+
+    def _evict(self) -> None:
+        if self.max_bytes is None or self.total_bytes <= self.max_bytes:
+            return
+        # so that the recent hits count as recently used
+        self._write_accessed_times()
+        cursor = self.connection.execute(
+            "SELECT key, num_bytes FROM responses ORDER BY accessed_time ASC"
+        )
+        evict_keys = []
+        for key, num_bytes in cursor:
+            if self.total_bytes <= self.max_bytes:
+                break
+            evict_keys.append((key,))
+            self.total_bytes -= num_bytes
+        self.connection.executemany("DELETE FROM responses WHERE key = ?", evict_keys)
+        logger.debug(f"evicted {len(evict_keys)} entries from {str(self.path)}")
+
+
+def make_payload_cache_key(payload: dict) -> str:
+    stable_payload = {
+        key: value for key, value in payload.items() if key not in VOLATILE_PAYLOAD_KEYS
+    }
+    serialized_payload = _serialize_for_cache_key(stable_payload)
+    return hashlib.sha256(serialized_payload.encode("utf-8")).hexdigest()
+
+
+class PayloadCacheKeyBuilder:
+    """
+    make_payload_cache_key() for the payloads of a job, which differ only in the messages after their shared prefix
+    (see ChatCompletionPayloadBuilder).  The rest of the payload is serialized and hashed once,
+    and the hash state is copied for each row, so a row only serializes and hashes its own messages.
+    """
+
+    def __init__(self, payload: dict, num_prefix_messages: int):
+        """
+        payload has the num_prefix_messages shared messages, and no others
+        """
+        stable_payload = {
+            key: value
+            for key, value in payload.items()
+            if key not in VOLATILE_PAYLOAD_KEYS
+        }
+        prefix_messages = payload["messages"][:num_prefix_messages]
+        # split the serialized payload after its prefix messages, within the "messages" list
+        before_messages = _serialize_for_cache_key(
+            {key: value for key, value in stable_payload.items() if key < "messages"}
+        )[1:-1]
+        after_messages = _serialize_for_cache_key(
+            {key: value for key, value in stable_payload.items() if key > "messages"}
+        )[1:-1]
+        head = (
+            "{"
+            + before_messages
+            + ("," if before_messages else "")
+            + '"messages":'
+            + _serialize_for_cache_key(prefix_messages)[:-1]
+        )
+        self._tail = "]" + ("," if after_messages else "") + after_messages + "}"
+        self._num_prefix_messages = num_prefix_messages
+        self._head_hash = hashlib.sha256(head.encode("utf-8"))
+
+    def make_key(self, payload: dict) -> str:
+        """
+        the same key as make_payload_cache_key(payload),
+        for a payload which only differs from the one given to __init__ in the messages after the prefix
+        """
+        row_messages = payload["messages"][self._num_prefix_messages :]
+        serialized_row_messages = _serialize_for_cache_key(row_messages)[1:-1]
+        if serialized_row_messages and self._num_prefix_messages > 0:
+            serialized_row_messages = "," + serialized_row_messages
+        key_hash = self._head_hash.copy()
+        key_hash.update((serialized_row_messages + self._tail).encode("utf-8"))
+        return key_hash.hexdigest()
+
+
+def _serialize_for_cache_key(value: Any) -> str:
+    return json.dumps(value, sort_keys=True, separators=(",", ":"))
@@ -21,9 +21,42 @@ ClientSessionType = Union[ClientSession, RetryClient]
 class TokenLimitMode(Enum):
     RAISE_ERROR = "RAISE_ERROR"
     TRUNCATE = "TRUNCATE"
+    TRUNCATE_BEFORE_REQUEST = "TRUNCATE_BEFORE_REQUEST"
     IGNORE = "IGNORE"
 
 
+class ExecutionMode(Enum):
+    REALTIME = "REALTIME"
+    BATCH = "BATCH"
+
+
+@dataclass()
+class OpenAICredential:
+    openai_api_key: str
+    openai_org_id: Optional[str] = None
+
+    def __post_init__(self):
+        check_type(self)
+
+
+@dataclass()
+class OpenAIEndpoint:
+    """
+    An OpenAI-compatible server, e.g. a self-hosted inference replica.
+    - weight: the share of requests to route to this endpoint, relative to the other endpoints
+    - max_concurrent_requests: a cap on the in-flight requests to this endpoint
+    - openai_api_key: sent instead of the config's credentials, if set
+    """
+
+    base_url: str
+    weight: int = 1
+    max_concurrent_requests: Optional[int] = None
+    openai_api_key: Optional[str] = None
+
+    def __post_init__(self):
+        check_type(self)
+
+
 @dataclass()
 class LLMConfig(ABC):
     def __post_init__(self):
@@ -64,6 +97,18 @@ class OpenAIChatCompletionConfig(LLMConfig):
     logit_bias: Optional[Dict[str, float]] = None
     user: Optional[str] = None
     token_limit_mode: TokenLimitMode = TokenLimitMode.RAISE_ERROR
+    response_cache_path: Optional[str] = None
+    response_cache_ttl_seconds: Optional[int] = None
+    response_cache_max_bytes: Optional[int] = None
+    deduplicate_prompts: Optional[bool] = None
+    execution_mode: ExecutionMode = ExecutionMode.REALTIME
+    additional_openai_credentials: Optional[List[OpenAICredential]] = None
+    openai_base_url: str = "https://api.openai.com/v1"
+    openai_endpoints: Optional[List[OpenAIEndpoint]] = None
+    request_dump_path: Optional[str] = None
+    request_dump_sample_rate: float = 1.0
+    prefix_messages: Optional[List[dict]] = None
+    history_key: Optional[str] = None
 
     def get_nonpassthrough_names(self) -> List[str]:
         return [
@@ -71,4 +116,16 @@ class OpenAIChatCompletionConfig(LLMConfig):
             "openai_org_id",
             "system_message",
             "token_limit_mode",
+            "response_cache_path",
+            "response_cache_ttl_seconds",
+            "response_cache_max_bytes",
+            "deduplicate_prompts",
+            "execution_mode",
+            "additional_openai_credentials",
+            "openai_base_url",
+            "openai_endpoints",
+            "request_dump_path",
+            "request_dump_sample_rate",
+            "prefix_messages",
+            "history_key",
         ] + super().get_nonpassthrough_names()
@@ -1,14 +1,64 @@
 from functools import reduce
 import logging
-from typing import List
+import reprlib
+from typing import Any, AsyncIterable, AsyncIterator, Iterable, List, Tuple, Union
 
 
 logger = logging.getLogger(__name__.split(".")[0])
 logger.addHandler(logging.NullHandler())
 
+# the most characters of a payload, response, or row which are logged
+LOG_PREVIEW_MAX_CHARS = 2000
+
+_log_preview_repr = reprlib.Repr()
+_log_preview_repr.maxlevel = 6
+_log_preview_repr.maxdict = 20
+_log_preview_repr.maxlist = 20
+_log_preview_repr.maxstring = 500
+_log_preview_repr.maxother = 500
+
+
+class LogPreview:
+    """
+    A size-capped repr() of a value, which is only built if the log record is actually emitted.
+    Use it as an argument of a %-style log message, rather than in an f-string:
+
+        logger.debug("POST to %s with payload=%s", url, LogPreview(payload))
+    """
+
+    __slots__ = ("value", "max_chars")
+
+    def __init__(self, value: Any, max_chars: int = LOG_PREVIEW_MAX_CHARS):
+        self.value = value
+        self.max_chars = max_chars
+
+    def __str__(self) -> str:
+        text = _log_preview_repr.repr(self.value)
+        if len(text) > self.max_chars:
+            return text[: self.max_chars] + "..."
+        return text
+
+    __repr__ = __str__
+
 
 def sum_usage_stats(usage_stats_list: List[dict]) -> dict:
     return reduce(
         lambda x, y: {k: x.get(k, 0) + y.get(k, 0) for k in set(x) | set(y)},
         usage_stats_list,
     )
+
+
+async def aiter_indexed_rows(
+    input_rows: Union[Iterable, AsyncIterable]
+) -> AsyncIterator[Tuple[int, object]]:
+    """
+    Enumerate either a synchronous or an asynchronous iterable of rows, one row at a time
+    """
+    if hasattr(input_rows, "__aiter__"):
+        row_index = 0
+        async for input_row in input_rows:
+            yield (row_index, input_row)
+            row_index += 1
+    else:
+        for row_index, input_row in enumerate(input_rows):
+            yield (row_index, input_row)
@@ -0,0 +1,166 @@
+try:
+    import pyarrow as pa  # type: ignore
+except ImportError:
+    pyarrow_installed = False
+else:
+    pyarrow_installed = True
+try:
+    import polars as pl  # type: ignore
+except ImportError:
+    polars_installed = False
+else:
+    polars_installed = True
+
+import json
+from typing import Any, Dict, List, Optional, Union
+
+from .types import ParallelParrotError
+from .util_pandas import explode_model_outputs, explode_objlist_outputs
+
+
+# with new_columns_only, the position of the input row of each output row
+ARROW_INPUT_ROW_INDEX_COLUMN = "input_row_index"
+
+ArrowLike = Union["pa.Table", "pa.RecordBatch", "pl.DataFrame"]
+
+
+def is_arrow_table(data) -> bool:
+    """
+    a pyarrow Table or RecordBatch
+    """
+    if not pyarrow_installed:
+        return False
+    return isinstance(data, (pa.Table, pa.RecordBatch))
+
+
+def is_polars_dataframe(data) -> bool:
+    if not polars_installed:
+        return False
+    return isinstance(data, pl.DataFrame)
+
+
+def is_arrow_like(data) -> bool:
+    return is_arrow_table(data) or is_polars_dataframe(data)
+
+
+def to_arrow_table(data: ArrowLike) -> "pa.Table":
+    """
+    These conversions share the underlying column buffers, rather than copying them
+    """
+    if not pyarrow_installed:
+        raise ParallelParrotError(
+            "pyarrow is not installed. Please install pyarrow to use this function."
+        )
+    if is_polars_dataframe(data):
+        return data.to_arrow()
+    if isinstance(data, pa.RecordBatch):
+        return pa.Table.from_batches([data])
+    return data
+
+
+def append_model_outputs_arrow(
+    input_data: ArrowLike,
+    model_outputs: List[Optional[str]],
+    output_key: str,
+    new_columns_only: bool = False,
+) -> ArrowLike:
+    return _build_output_table(
+        input_data,
+        row_positions=None,
+        new_columns={output_key: model_outputs},
+        new_columns_only=new_columns_only,
+    )
+
+
+def append_one_to_many_model_outputs_arrow(
+    input_data: ArrowLike,
+    model_outputs: List[List[Optional[str]]],
+    output_key: str,
+    new_columns_only: bool = False,
+) -> ArrowLike:
+    (row_positions, output_values) = explode_model_outputs(
+        model_outputs, missing_value=None
+    )
+    return _build_output_table(
+        input_data,
+        row_positions=row_positions,
+        new_columns={output_key: output_values},
+        new_columns_only=new_columns_only,
+    )
+
+
+def append_one_to_many_objlist_outputs_arrow(
+    input_data: ArrowLike,
+    objlist_outputs: List[List[dict]],
+    output_key_names: List[str],
+    new_columns_only: bool = False,
+) -> ArrowLike:
+    (row_positions, output_columns) = explode_objlist_outputs(
+        objlist_outputs, output_key_names, missing_value=None
+    )
+    return _build_output_table(
+        input_data,
+        row_positions=row_positions,
+        new_columns=output_columns,
+        new_columns_only=new_columns_only,
+    )
+
+
+def _build_output_table(
+    input_data: ArrowLike,
+    row_positions: Optional[List[int]],
+    new_columns: Dict[str, list],
+    new_columns_only: bool,
+) -> ArrowLike:
+    """
+    returns the same type as the input_data.  The input columns are gathered with a single take()
+    if rows were repeated, and are otherwise shared with the output.
+    With new_columns_only, the output has the new columns and ARROW_INPUT_ROW_INDEX_COLUMN.
+    """
+    input_table = to_arrow_table(input_data)
+    if new_columns_only:
+        if row_positions is None:
+            row_positions = list(range(input_table.num_rows))
+        output_table = pa.table(
+            {ARROW_INPUT_ROW_INDEX_COLUMN: pa.array(row_positions, type=pa.int64())}
+        )
+    elif row_positions is None:
+        output_table = input_table
+    else:
+        output_table = input_table.take(pa.array(row_positions, type=pa.int64()))
+    for key, values in new_columns.items():
+        array = _to_arrow_array(values)
+        if key in output_table.column_names:
+            output_table = output_table.set_column(
+                output_table.column_names.index(key), key, array
+            )
+        else:
+            output_table = output_table.append_column(key, array)
+    return _from_arrow_table(output_table, like=input_data)
+
+
+def _to_arrow_array(values: list) -> "pa.Array":
+    try:
+        return pa.array(values)
+    except (pa.ArrowInvalid, pa.ArrowTypeError):
+        # e.g. a function output key with a mix of strings and numbers
+        return pa.array(
+            [_to_json_string(value) for value in values], type=pa.large_string()
+        )
+
+
+def _to_json_string(value: Any) -> Optional[str]:
+    if value is None or isinstance(value, str):
+        return value
+    return json.dumps(value)
+
+
+def _from_arrow_table(table: "pa.Table", like: ArrowLike) -> ArrowLike:
+    if is_polars_dataframe(like):
+        return pl.from_arrow(table)
+    if isinstance(like, pa.RecordBatch):
+        batches = table.combine_chunks().to_batches()
+        if len(batches) == 0:
+            return pa.RecordBatch.from_pylist([], schema=table.schema)
+        return batches[0]
+    return table
@@ -6,7 +6,7 @@ else:
     pandas_installed = True
 
 import math
-from typing import List, Optional
+from typing import Any, Dict, List, Optional, Tuple
 
 from .types import ParallelParrotError
 
@@ -15,53 +15,144 @@ def append_model_outputs_pandas(
     input_df: "pd.DataFrame",
     model_outputs: List[Optional[str]],
     output_key: str,
+    new_columns_only: bool = False,
 ) -> "pd.DataFrame":
     if not pandas_installed:
         raise ParallelParrotError(
             "pandas is not installed. Please install pandas to use this function."
         )
-    output_df = input_df.copy()
-    output_df[output_key] = model_outputs
-    return output_df
+    return _build_output_df(
+        input_df,
+        row_positions=None,
+        new_columns={output_key: model_outputs},
+        new_columns_only=new_columns_only,
+    )
 
 
 def append_one_to_many_model_outputs_pandas(
     input_df: "pd.DataFrame",
     model_outputs: List[List[Optional[str]]],
     output_key: str,
+    new_columns_only: bool = False,
 ) -> "pd.DataFrame":
     if not pandas_installed:
         raise ParallelParrotError(
             "pandas is not installed. Please install pandas to use this function."
         )
-    output_df = input_df.copy()
-    output_df[output_key] = model_outputs
-    output_df = output_df.explode(output_key)
-    output_df.reset_index(drop=True, inplace=True)
-    return output_df
+    (row_positions, output_values) = explode_model_outputs(
+        model_outputs, missing_value=math.nan
+    )
+    return _build_output_df(
+        input_df,
+        row_positions=row_positions,
+        new_columns={output_key: output_values},
+        new_columns_only=new_columns_only,
+    )
 
 
 def append_one_to_many_objlist_outputs_pandas(
     input_df: "pd.DataFrame",
     objlist_outputs: List[List[dict]],
     output_key_names: List[str],
+    new_columns_only: bool = False,
 ) -> "pd.DataFrame":
     if not pandas_installed:
         raise ParallelParrotError(
             "pandas is not installed. Please install pandas to use this function."
         )
-    output_df = input_df.copy()
-    extract_dict_colname = "_tmp_dict_"
-    while extract_dict_colname in output_df.columns:
-        extract_dict_colname += "_"
-    output_df[extract_dict_colname] = objlist_outputs
-    output_df = output_df.explode(extract_dict_colname)
-    for output_key_name in output_key_names:
-        output_df[output_key_name] = output_df[extract_dict_colname].apply(
-            lambda x: x.get(output_key_name) if isinstance(x, dict) else math.nan
-        )
-    output_df = output_df.drop(columns=[extract_dict_colname])
-    output_df.reset_index(drop=True, inplace=True)
+    (row_positions, output_columns) = explode_objlist_outputs(
+        objlist_outputs, output_key_names, missing_value=math.nan
+    )
+    return _build_output_df(
+        input_df,
+        row_positions=row_positions,
+        new_columns=output_columns,
+        new_columns_only=new_columns_only,
+    )
+
+
+def explode_model_outputs(
+    model_outputs: List[List[Optional[str]]], missing_value: Any
+) -> Tuple[List[int], list]:
+    """
+    returns the input row position and the output value of each output row.
+    These are the same rows as df.explode(): an empty list becomes missing_value, and any other value is kept.
+    """
+    row_positions = []
+    output_values = []
+    for row_position, model_output in enumerate(model_outputs):
+        if isinstance(model_output, list):
+            if len(model_output) > 0:
+                row_positions.extend([row_position] * len(model_output))
+                output_values.extend(model_output)
+            else:
+                row_positions.append(row_position)
+                output_values.append(missing_value)
+        else:
+            row_positions.append(row_position)
+            output_values.append(model_output)
+    return (row_positions, output_values)
+
+
+def explode_objlist_outputs(
+    objlist_outputs: List[List[dict]], output_key_names: List[str], missing_value: Any
+) -> Tuple[List[int], Dict[str, list]]:
+    """
+    returns the input row position of each output row, and a list of output values per key
+    """
+    row_positions = []
+    output_columns: Dict[str, list] = {
+        output_key_name: [] for output_key_name in output_key_names
+    }
+    for row_position, objlist_output in enumerate(objlist_outputs):
+        if isinstance(objlist_output, list) and len(objlist_output) > 0:
+            for obj in objlist_output:
+                row_positions.append(row_position)
+                for output_key_name, output_column in output_columns.items():
+                    output_column.append(
+                        obj.get(output_key_name)
+                        if isinstance(obj, dict)
+                        else missing_value
+                    )
+        else:
+            row_positions.append(row_position)
+            for output_column in output_columns.values():
+                output_column.append(missing_value)
+    return (row_positions, output_columns)
+
+
+def _build_output_df(
+    input_df: "pd.DataFrame",
+    row_positions: Optional[List[int]],
+    new_columns: Dict[str, list],
+    new_columns_only: bool,
+) -> "pd.DataFrame":
+    """
+    row_positions are the positions of the input rows to repeat for each output row, or None for one output row per input row.
+    - with new_columns_only, only the new columns are returned, indexed by the index of their input rows,
+      so that the input is not copied at all
+    - otherwise, the input columns are gathered with a single take(), and the index is reset if rows were repeated
+    """
+    if row_positions is None:
+        index = input_df.index
+    else:
+        index = input_df.index.take(row_positions)
+    if new_columns_only:
+        return pd.DataFrame(new_columns, index=index)
+    if row_positions is None:
+        # shares the data of the input columns, rather than copying them
+        output_df = input_df.copy(deep=False)
+    else:
+        output_df = input_df.take(row_positions)
+        output_df.reset_index(drop=True, inplace=True)
+    for key, values in new_columns.items():
+        if key in output_df.columns:
+            # replace the column, rather than writing into data which may be shared with the input
+            column_position = output_df.columns.get_loc(key)
+            output_df = output_df.drop(columns=[key])
+            output_df.insert(column_position, key, values)
+        else:
+            output_df[key] = values
     return output_df
 
 
@@ -71,6 +162,13 @@ def is_pandas_dataframe(df):
     return isinstance(df, pd.DataFrame)
 
 
-def pandas_row_reader(df: "pd.DataFrame"):
-    for i in range(len(df)):
-        yield df.iloc[i]
+def pandas_row_reader(df: "pd.DataFrame", columns: Optional[List[str]] = None):
+    """
+    yield each row as a dict, optionally of only some of the columns.
+    This is much faster than building a pd.Series per row with df.iloc[i]
+    """
+    if columns is not None:
+        df = df[columns]
+    column_names = list(df.columns)
+    for values in df.itertuples(index=False, name=None):
+        yield dict(zip(column_names, values))
@@ -2,64 +2,276 @@ try:
     import pandas as pd  # type: ignore
 except ImportError:
     pd = None
+try:
+    import pyarrow as pa  # type: ignore
+    import pyarrow.compute as pc  # type: ignore
+except ImportError:
+    pa = None
 
-from collections.abc import Callable
+import json
+import math
 from string import Template
-import sys
+from typing import Any, Iterable, Iterator, List, Mapping, Optional, Tuple, Union
 
 from .types import ParallelParrotError
 
 
-def make_curried_prompt_template(prompt_template: str) -> Callable:
-    prompt_template = prompt_template.strip()
-    t = Template(prompt_template)
-    if sys.version_info >= (3, 11):
-        if not t.is_valid():
-            raise ParallelParrotError(f"Invalid template {prompt_template=}")
-        identifiers_set = set(t.get_identifiers())
-    else:
-        identifiers_set = None
-
-    if identifiers_set is not None:
-        if pd is not None:
-
-            def _sub_with_pandas_and_colcheck(input_row):
-                if isinstance(input_row, pd.Series):
-                    input_dict = input_row.to_dict()
-                else:
-                    input_dict = input_row
-                if identifiers_set and identifiers_set > set(input_dict.keys()):
-                    raise ParallelParrotError(
-                        f"Template identifiers not in {input_row=} {prompt_template=}"
-                    )
-                return t.substitute(input_dict)
-
-            f = _sub_with_pandas_and_colcheck
-        else:
+# the number of rows of an Arrow table which are rendered at once
+ARROW_RENDER_BATCH_SIZE = 65536
 
-            def _sub_with_colcheck(input_dict):
-                if identifiers_set and identifiers_set > set(input_dict.keys()):
-                    raise ParallelParrotError(
-                        f"Template identifiers not in {input_dict=} {prompt_template=}"
-                    )
-                return t.substitute(input_dict)
 
-            f = _sub_with_colcheck
-    else:
-        if pd is not None:
+class CompiledPromptTemplate:
+    """
+    A string.Template (e.g. "Q: ${question}\nA:") which is parsed once, into a str.format() string
+    with a positional field for each of its identifiers.
+    - calling it renders one row (a dict or a pd.Series) by looking up only the identifiers
+    - render_many() renders an iterable of dicts, checking the columns once, against the first row
+    - render_pandas() renders a dataframe column-wise, checking the columns once
+    - render_arrow() renders a pyarrow Table with vectorized string kernels, checking the columns once
+    """
+
+    def __init__(self, prompt_template: str):
+        self.prompt_template = prompt_template.strip()
+        t = Template(self.prompt_template)
+        # a list of (literal text, identifier), where the identifier is None for the final literal
+        self.segments = _parse_template_segments(t)
+        self.identifiers: List[str] = []
+        for _, identifier in self.segments:
+            if identifier is not None and identifier not in self.identifiers:
+                self.identifiers.append(identifier)
+        self.format_string = _segments_to_format_string(self.segments, self.identifiers)
+
+    def __call__(self, input_row: Union[Mapping, "pd.Series"]) -> str:
+        try:
+            values = [input_row[identifier] for identifier in self.identifiers]
+        except KeyError:
+            self.validate_columns(input_row.keys())
+            raise
+        return self.format_string.format(*values)
+
+    def render_many(self, input_rows: Iterable[Mapping]) -> Iterator[str]:
+        is_first_row = True
+        for input_row in input_rows:
+            if is_first_row:
+                self.validate_columns(input_row.keys())
+                is_first_row = False
+            yield self(input_row)
+
+    def render_pandas(self, input_df: "pd.DataFrame") -> Iterator[str]:
+        """
+        Only the columns which appear in the template are read, and each is converted to a list once,
+        rather than building a pd.Series per row.
+        """
+        self.validate_columns(input_df.columns)
+        if len(self.identifiers) == 0:
+            for _ in range(len(input_df)):
+                yield self.format_string.format()
+            return
+        columns = [input_df[identifier].tolist() for identifier in self.identifiers]
+        for values in zip(*columns):
+            yield self.format_string.format(*values)
+
+    def render_arrow(self, input_table: "pa.Table") -> Iterator[str]:
+        """
+        The prompts are assembled by Arrow, straight from the buffers of the string columns,
+        one batch of rows at a time.
+        Integer columns are cast to strings by Arrow, other columns are formatted with str(), and nulls become "None".
+        """
+        self.validate_columns(input_table.column_names)
+        if len(self.identifiers) == 0:
+            for _ in range(input_table.num_rows):
+                yield self.format_string.format()
+            return
+        for batch in input_table.select(self.identifiers).to_batches(
+            max_chunksize=ARROW_RENDER_BATCH_SIZE
+        ):
+            yield from self._render_arrow_batch(pa.Table.from_batches([batch]))
+
+    def _render_arrow_batch(self, batch_table: "pa.Table") -> List[str]:
+        string_columns = {
+            identifier: _arrow_column_to_strings(batch_table.column(identifier))
+            for identifier in self.identifiers
+        }
+        parts = []
+        for literal, identifier in self.segments:
+            if literal:
+                parts.append(pa.scalar(literal, type=pa.large_string()))
+            if identifier is not None:
+                parts.append(string_columns[identifier])
+        separator = pa.scalar("", type=pa.large_string())
+        if len(parts) == 1:
+            # binary_join_element_wise needs at least one value besides the separator
+            parts.append(separator)
+        return pc.binary_join_element_wise(*parts, separator).to_pylist()
+
+    def validate_columns(self, column_names: Iterable[Any]) -> None:
+        column_names_set = set(column_names)
+        missing_identifiers = [
+            identifier
+            for identifier in self.identifiers
+            if identifier not in column_names_set
+        ]
+        if missing_identifiers:
+            raise ParallelParrotError(
+                f"Template identifiers {missing_identifiers=} not in {column_names_set=} {self.prompt_template=}"
+            )
+
+
+class CompiledMessagesTemplate:
+    """
+    Renders each row into a list of chat messages, rather than a single prompt:
+    the prior turns of the row (from its history_key column), followed by the prompt template as the user message.
+    The prior turns of a row are a list of messages (e.g. {"role": "assistant", "content": "..."}),
+    or that list as a JSON string.  A missing value means no prior turns.
+    It renders rows the same ways as a CompiledPromptTemplate, and checks for the history_key column
+    along with the template identifiers.
+    """
+
+    def __init__(self, prompt_template: str, history_key: str):
+        self.prompt_template = CompiledPromptTemplate(prompt_template)
+        self.history_key = history_key
+
+    def __call__(self, input_row: Union[Mapping, "pd.Series"]) -> List[dict]:
+        return make_row_messages(
+            input_row.get(self.history_key), self.prompt_template(input_row)
+        )
 
-            def _sub_with_pandas(input_row):
-                if isinstance(input_row, pd.Series):
-                    input_dict = input_row.to_dict()
-                else:
-                    input_dict = input_row
-                return t.substitute(input_dict)
+    def render_many(self, input_rows: Iterable[Mapping]) -> Iterator[List[dict]]:
+        is_first_row = True
+        for input_row in input_rows:
+            if is_first_row:
+                self.validate_columns(input_row.keys())
+                is_first_row = False
+            yield self(input_row)
 
-            f = _sub_with_pandas
+    def render_pandas(self, input_df: "pd.DataFrame") -> Iterator[List[dict]]:
+        self.validate_columns(input_df.columns)
+        histories = input_df[self.history_key].tolist()
+        prompts = self.prompt_template.render_pandas(input_df)
+        for history, prompt in zip(histories, prompts):
+            yield make_row_messages(history, prompt)
+
+    def render_arrow(self, input_table: "pa.Table") -> Iterator[List[dict]]:
+        """
+        A list<struct> history column is read as a list of dicts, and a string column as JSON.
+        """
+        self.validate_columns(input_table.column_names)
+        prompts = self.prompt_template.render_arrow(input_table)
+        for batch in input_table.select([self.history_key]).to_batches(
+            max_chunksize=ARROW_RENDER_BATCH_SIZE
+        ):
+            for history in batch.column(0).to_pylist():
+                yield make_row_messages(history, next(prompts))
+
+    def validate_columns(self, column_names: Iterable[Any]) -> None:
+        column_names = list(column_names)
+        self.prompt_template.validate_columns(column_names)
+        if self.history_key not in column_names:
+            raise ParallelParrotError(f"{self.history_key=} not in {column_names=}")
+
+
+def make_row_messages(history: Any, prompt: str) -> List[dict]:
+    """
+    the prior turns of a row, followed by its prompt as the user message
+    """
+    if history is None or (isinstance(history, float) and math.isnan(history)):
+        history = []
+    elif isinstance(history, str):
+        try:
+            history = json.loads(history)
+        except ValueError as e:
+            raise ParallelParrotError(f"Invalid JSON in {history=}: {e}")
+    messages = []
+    for message in history:
+        if not isinstance(message, Mapping) or "role" not in message:
+            raise ParallelParrotError(f"Invalid {message=} in {history=}")
+        # structs in Arrow columns have a null for each field which another struct has
+        messages.append(
+            {key: value for key, value in message.items() if value is not None}
+        )
+    messages.append({"role": "user", "content": prompt})
+    return messages
+
+
+def make_curried_prompt_template(prompt_template: str) -> CompiledPromptTemplate:
+    return CompiledPromptTemplate(prompt_template)
+
+
+def make_row_prompt_template(
+    prompt_template: str, history_key: Optional[str] = None
+) -> Union[CompiledPromptTemplate, CompiledMessagesTemplate]:
+    """
+    the template which renders each input row into the prompt of its request
+    """
+    if history_key is None:
+        return CompiledPromptTemplate(prompt_template)
+    return CompiledMessagesTemplate(prompt_template, history_key)
+
+
+def prerendered_prompt_template(
+    prompt: Union[str, List[dict]]
+) -> Union[str, List[dict]]:
+    """
+    the curried prompt template for rows which are already rendered prompts (or lists of messages)
+    """
+    return prompt
+
+
+def _parse_template_segments(t: Template) -> List[Tuple[str, Optional[str]]]:
+    """
+    like Template.get_identifiers() (python 3.11+), but keeping the literal text between them,
+    and raising for invalid templates
+    """
+    segments: List[Tuple[str, Optional[str]]] = []
+    literal = ""
+    position = 0
+    for match in t.pattern.finditer(t.template):
+        literal += t.template[position : match.start()]
+        position = match.end()
+        identifier = match.group("named") or match.group("braced")
+        if identifier is not None:
+            segments.append((literal, identifier))
+            literal = ""
+        elif match.group("escaped") is not None:
+            literal += t.delimiter
         else:
+            raise ParallelParrotError(f"Invalid template {t.template=}")
+    literal += t.template[position:]
+    segments.append((literal, None))
+    return segments
 
-            def _sub(input_dict):
-                return t.substitute(input_dict)
 
-            f = _sub
-    return f
+def _segments_to_format_string(
+    segments: List[Tuple[str, Optional[str]]], identifiers: List[str]
+) -> str:
+    """
+    an equivalent str.format() string with positional fields, numbered in the order of the identifiers
+    """
+    parts = []
+    for literal, identifier in segments:
+        parts.append(literal.replace("{", "{{").replace("}", "}}"))
+        if identifier is not None:
+            # !s matches Template.substitute(), which calls str() on each value
+            parts.append(f"{{{identifiers.index(identifier)}!s}}")
+    return "".join(parts)
+
+
+def _arrow_column_to_strings(column: "pa.ChunkedArray") -> "pa.ChunkedArray":
+    if (
+        pa.types.is_string(column.type)
+        or pa.types.is_large_string(column.type)
+        # Arrow formats integers the same as str()
+        or pa.types.is_integer(column.type)
+    ):
+        strings = pc.cast(column, pa.large_string())
+    else:
+        strings = pa.chunked_array(
+            [
+                pa.array(
+                    [str(value) for value in column.to_pylist()],
+                    type=pa.large_string(),
+                )
+            ],
+            type=pa.large_string(),
+        )
+    return pc.fill_null(strings, "None")
@@ -0,0 +1,62 @@
+from benchmarks.mock_openai_server import (
+    MockOpenAIServer,
+    MockOpenAIServerConfig,
+    format_reset_seconds,
+)
+from benchmarks.run_benchmarks import BenchmarkScenario, run_client, summarize
+
+import parallel_parrot as pp
+from parallel_parrot.openai_api_lib import parse_seconds_from_header
+
+
+def test_format_reset_seconds():
+    for seconds in [0.02, 0.5, 6.5, 80.0, 125.25]:
+        assert parse_seconds_from_header(format_reset_seconds(seconds)) == seconds
+
+
+def test_mock_openai_server_ratelimits():
+    server = MockOpenAIServer(
+        MockOpenAIServerConfig(limit_requests=2, limit_tokens=1000)
+    )
+    (ratelimit_type, headers) = server._consume_ratelimits("key", 100, now=0.0)
+    assert ratelimit_type is None
+    assert headers["x-ratelimit-remaining-requests"] == "1"
+    assert headers["x-ratelimit-remaining-tokens"] == "900"
+    assert parse_seconds_from_header(headers["x-ratelimit-reset-requests"]) == 30.0
+    (ratelimit_type, headers) = server._consume_ratelimits("key", 950, now=0.0)
+    assert ratelimit_type == "tokens"
+    assert headers["retry-after"] == "3"
+    server._consume_ratelimits("key", 100, now=0.0)
+    (ratelimit_type, headers) = server._consume_ratelimits("key", 100, now=0.0)
+    assert ratelimit_type == "requests"
+    assert headers["x-ratelimit-remaining-requests"] == "0"
+    # other API keys have their own ratelimits
+    (ratelimit_type, _) = server._consume_ratelimits("other key", 100, now=0.0)
+    assert ratelimit_type is None
+
+
+def test_benchmark_scenarios_against_mock_openai_server():
+    async def run(scenario):
+        async with MockOpenAIServer(scenario.server_config) as server:
+            client_result = await run_client(scenario, server.base_url)
+            return summarize(scenario, client_result, server.stats.to_dict())
+
+    server_config = MockOpenAIServerConfig(
+        latency_mean_seconds=0.001, num_function_items=2
+    )
+    text_result = pp.run_async(
+        run(BenchmarkScenario("text", num_rows=20, server_config=server_config))
+    )
+    assert text_result["num_output_rows"] == 20
+    assert text_result["server_stats"]["num_completions"] == 20
+    assert text_result["latency_p50_seconds"] <= text_result["latency_p99_seconds"]
+    assert text_result["requests_ratelimit_utilization"] > 0
+    function_result = pp.run_async(
+        run(
+            BenchmarkScenario(
+                "function", num_rows=20, mode="function", server_config=server_config
+            )
+        )
+    )
+    # each row is exploded into num_function_items rows
+    assert function_result["num_output_rows"] == 40
@@ -0,0 +1,98 @@
+from aiohttp import web
+
+import parallel_parrot as pp
+from parallel_parrot.concurrency import AdaptiveConcurrencyLimit
+from parallel_parrot.openai_api import (
+    INITIAL_NUM_CONCURRENT_REQUESTS,
+    get_max_num_concurrent_requests,
+    get_num_concurrent_requests,
+)
+from parallel_parrot.openai_client import MAX_NUM_CONCURRENT_REQUESTS
+
+
+def test_adaptive_concurrency_limit():
+    stats_list = []
+    concurrency_limit = AdaptiveConcurrencyLimit(
+        4, max_limit=200, on_update=stats_list.append
+    )
+    # additive increase after a window of `limit` successful requests
+    start_times = [concurrency_limit.on_request_start() for _ in range(4)]
+    assert concurrency_limit.num_in_flight == 4
+    for start_time in start_times:
+        concurrency_limit.on_request_end(start_time, is_overloaded=False)
+    assert concurrency_limit.limit == 5
+    assert len(stats_list) == 1
+    assert stats_list[0].limit == 5
+    assert stats_list[0].num_in_flight == 0
+    assert stats_list[0].p50_latency_seconds is not None
+    assert stats_list[0].p99_latency_seconds >= stats_list[0].p50_latency_seconds
+    # multiplicative decrease, only once for requests which were already in flight
+    start_times = [concurrency_limit.on_request_start() for _ in range(2)]
+    for start_time in start_times:
+        concurrency_limit.on_request_end(start_time, is_overloaded=True)
+    assert concurrency_limit.limit == 2
+    start_time = concurrency_limit.on_request_start()
+    concurrency_limit.on_overload(start_time)
+    concurrency_limit.on_request_end(start_time, is_overloaded=True)
+    assert concurrency_limit.limit == 1
+    assert concurrency_limit.num_in_flight == 0
+    # never above max_limit
+    concurrency_limit.set_max_limit(2)
+    for _ in range(10):
+        start_time = concurrency_limit.on_request_start()
+        concurrency_limit.on_request_end(start_time, is_overloaded=False)
+    assert concurrency_limit.limit == 2
+
+
+def test_adaptive_concurrency_limit_grows_slowly():
+    # a server without ratelimit headers, so the cap is the filehandle limit
+    concurrency_limit = AdaptiveConcurrencyLimit(
+        get_num_concurrent_requests(None),
+        max_limit=get_max_num_concurrent_requests(None),
+    )
+    assert concurrency_limit.limit == INITIAL_NUM_CONCURRENT_REQUESTS
+    assert concurrency_limit.max_limit == MAX_NUM_CONCURRENT_REQUESTS
+    for _ in range(8):
+        start_time = concurrency_limit.on_request_start()
+        concurrency_limit.on_request_end(start_time, is_overloaded=False)
+    assert concurrency_limit.limit == INITIAL_NUM_CONCURRENT_REQUESTS + 1
+    # one more per window of `limit` successful requests
+    for _ in range(9 + 10 + 11):
+        start_time = concurrency_limit.on_request_start()
+        concurrency_limit.on_request_end(start_time, is_overloaded=False)
+    assert concurrency_limit.limit == INITIAL_NUM_CONCURRENT_REQUESTS + 4
+
+
+def test_openai_client_reports_retried_overloads():
+    num_requests = 0
+
+    async def flaky_handler(request):
+        nonlocal num_requests
+        num_requests += 1
+        if num_requests == 1:
+            return web.Response(status=503)
+        return web.json_response({})
+
+    overloads = []
+
+    async def run():
+        app = web.Application()
+        app.router.add_post("/", flaky_handler)
+        runner = web.AppRunner(app)
+        await runner.setup()
+        site = web.TCPSite(runner, "127.0.0.1", 0)
+        await site.start()
+        port = runner.addresses[0][1]
+        try:
+            async with pp.OpenAIClient() as client:
+                for _ in range(2):
+                    async with client.session.post(
+                        f"http://127.0.0.1:{port}/",
+                        trace_request_ctx={"on_overload": lambda: overloads.append(1)},
+                    ) as response:
+                        await response.read()
+        finally:
+            await runner.cleanup()
+
+    pp.run_async(run())
+    assert overloads == [1]
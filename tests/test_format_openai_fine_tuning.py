@@ -0,0 +1,62 @@
+import json
+
+import parallel_parrot as pp
+from parallel_parrot.format_openai_fine_tuning import _JsonlShardWriter
+
+
+def test_jsonl_shard_writer(tmp_path):
+    shard_writer = _JsonlShardWriter(
+        tmp_path / "shards",
+        max_bytes_per_file=20,
+        max_examples_per_file=3,
+        max_tokens_per_file=None,
+    )
+    shard_writer.write_lines([("aaaaa\n", 1)] * 4)
+    # a line which is larger than max_bytes_per_file gets a file of its own
+    shard_writer.write_lines([("b" * 29 + "\n", 1), ("ccccc\n", 1)])
+    shard_writer.close()
+    assert [path.name for path in shard_writer.output_file_paths] == [
+        "shards.000001.jsonl",
+        "shards.000002.jsonl",
+        "shards.000003.jsonl",
+        "shards.000004.jsonl",
+    ]
+    assert [path.read_text() for path in shard_writer.output_file_paths] == [
+        "aaaaa\n" * 3,
+        "aaaaa\n",
+        "b" * 29 + "\n",
+        "ccccc\n",
+    ]
+    assert shard_writer.total_billable_num_tokens == 6
+
+
+def test_write_openai_fine_tuning_jsonl(tmp_path):
+    input_data = [
+        {"question": f"What is {i} + {i}?", "answer": str(i + i)} for i in range(2500)
+    ]
+    input_data[0]["question"] = "why? " * 100
+    paths = pp.write_openai_fine_tuning_jsonl(
+        input_data=input_data,
+        prompt_key="question",
+        completion_key="answer",
+        system_message="You are good at math.",
+        model="gpt-3.5-turbo-0613",
+        output_file_prefix=tmp_path / "fine_tuning",
+        max_tokens_per_example=50,
+        max_examples_per_file=1000,
+        num_processes=2,
+    )
+    assert len(paths) == 3
+    examples = [
+        json.loads(line) for path in paths for line in open(path).read().splitlines()
+    ]
+    assert len(examples) == 2500
+    assert examples[1]["messages"] == [
+        {"role": "system", "content": "You are good at math."},
+        {"role": "user", "content": "What is 1 + 1?"},
+        {"role": "assistant", "content": "2"},
+    ]
+    # truncated to max_tokens_per_example
+    truncated_question = examples[0]["messages"][1]["content"]
+    assert truncated_question.startswith("why? why?")
+    assert len(truncated_question) < len(input_data[0]["question"])
@@ -0,0 +1,208 @@
+try:
+    import prometheus_client  # type: ignore
+except ImportError:
+    prometheus_client = None
+try:
+    from opentelemetry.sdk.trace import TracerProvider  # type: ignore
+    from opentelemetry.sdk.trace.export import SimpleSpanProcessor  # type: ignore
+    from opentelemetry.sdk.trace.export.in_memory_span_exporter import (  # type: ignore
+        InMemorySpanExporter,
+    )
+except ImportError:
+    TracerProvider = None
+
+from collections import Counter
+from contextlib import contextmanager
+from contextvars import ContextVar
+import json
+
+from aiohttp import web
+import pytest
+
+import parallel_parrot as pp
+
+
+class RecordingInstrumentation(pp.Instrumentation):
+    def __init__(self):
+        self.events = []
+        self.current_request_url: ContextVar = ContextVar("current_request_url")
+        self.events_outside_of_request_context = []
+
+    @contextmanager
+    def request_context(self, url):
+        token = self.current_request_url.set(url)
+        try:
+            yield
+        finally:
+            self.current_request_url.reset(token)
+
+    def _record_request_event(self, event):
+        self.events.append(event)
+        if self.current_request_url.get(None) is None:
+            self.events_outside_of_request_context.append(event)
+
+    def on_queue_wait(self, wait_seconds):
+        self.events.append(("queue_wait",))
+
+    def on_ratelimit_wait(self, wait_seconds):
+        self._record_request_event(("ratelimit_wait",))
+
+    def on_request(self, url, status, duration_seconds):
+        self._record_request_event(("request", status))
+
+    def on_request_attempt(self, url, status, attempt, duration_seconds):
+        self._record_request_event(("request_attempt", status, attempt))
+
+    def on_bytes_sent(self, num_bytes):
+        self._record_request_event(("bytes_sent", num_bytes))
+
+    def on_bytes_received(self, num_bytes):
+        self._record_request_event(("bytes_received", num_bytes))
+
+    def on_request_redo(self, reason):
+        self.events.append(("request_redo", reason))
+
+
+def run_data_generation_against_stub_server(instrumentation):
+    num_requests_by_prompt: Counter = Counter()
+
+    async def handler(request):
+        payload = await request.json()
+        prompt = payload["messages"][-1]["content"]
+        num_requests_by_prompt[prompt] += 1
+        if prompt == "a" and num_requests_by_prompt[prompt] == 1:
+            # a transient error, which is retried by the RetryClient
+            return web.json_response({"error": {"message": "oops"}}, status=500)
+        if prompt == "b" and num_requests_by_prompt[prompt] == 1:
+            # the function was not called, so the request is redone
+            message = {"role": "assistant", "content": "no"}
+        else:
+            arguments = {"p": [{"output": prompt.upper()}]}
+            message = {
+                "role": "assistant",
+                "content": None,
+                "function_call": {"name": "f", "arguments": json.dumps(arguments)},
+            }
+        return web.json_response(
+            {
+                "object": "chat.completion",
+                "choices": [{"index": 0, "message": message}],
+                "usage": {
+                    "prompt_tokens": 10,
+                    "completion_tokens": 1,
+                    "total_tokens": 11,
+                },
+            },
+            headers={
+                "x-ratelimit-limit-requests": "3500",
+                "x-ratelimit-remaining-requests": "3499",
+                "x-ratelimit-reset-requests": "17ms",
+            },
+        )
+
+    async def run():
+        app = web.Application()
+        app.router.add_post("/v1/chat/completions", handler)
+        runner = web.AppRunner(app)
+        await runner.setup()
+        site = web.TCPSite(runner, "127.0.0.1", 0)
+        await site.start()
+        config = pp.OpenAIChatCompletionConfig(
+            openai_api_key="*suupersekret*",
+            model="gpt-3.5-turbo-0613",
+            openai_base_url=f"http://127.0.0.1:{runner.addresses[0][1]}/v1",
+        )
+        try:
+            async with pp.OpenAIClient(instrumentation=instrumentation) as client:
+                return await pp.parallel_data_generation(
+                    config=config,
+                    input_data=[{"input": "a"}, {"input": "b"}, {"input": "c"}],
+                    prompt_template="${input}",
+                    output_key_names=["output"],
+                    client=client,
+                )
+        finally:
+            await runner.cleanup()
+
+    return pp.run_async(run())
+
+
+def test_instrumentation():
+    instrumentation = RecordingInstrumentation()
+    (output_list, usage_stats_sum) = run_data_generation_against_stub_server(
+        instrumentation
+    )
+    assert [row["output"] for row in output_list] == ["A", "B", "C"]
+    events = Counter(event[0] for event in instrumentation.events)
+    assert events["queue_wait"] == 3
+    # a, b, c, and the redo of b
+    assert events["request"] == 4
+    assert events["ratelimit_wait"] == 4
+    assert ("request_redo", "function_call") in instrumentation.events
+    # the retry of a
+    assert events["request_attempt"] == 5
+    assert ("request_attempt", 500, 1) in instrumentation.events
+    assert ("request_attempt", 200, 2) in instrumentation.events
+    assert all(
+        event == ("request", 200)
+        for event in instrumentation.events
+        if event[0] == "request"
+    )
+    assert sum(
+        event[1] for event in instrumentation.events if event[0] == "bytes_sent"
+    ) > sum(
+        event[1] for event in instrumentation.events if event[0] == "bytes_received"
+    )
+    # so that tracing can parent them to the span of their request
+    assert instrumentation.events_outside_of_request_context == []
+
+
+@pytest.mark.skipif(prometheus_client is None, reason="requires prometheus_client")
+def test_prometheus_instrumentation():
+    registry = prometheus_client.CollectorRegistry()
+    run_data_generation_against_stub_server(
+        pp.PrometheusInstrumentation(registry=registry)
+    )
+    assert (
+        registry.get_sample_value("parallel_parrot_requests_total", {"status": "200"})
+        == 4.0
+    )
+    assert registry.get_sample_value("parallel_parrot_request_retries_total") == 1.0
+    assert (
+        registry.get_sample_value(
+            "parallel_parrot_request_redos_total", {"reason": "function_call"}
+        )
+        == 1.0
+    )
+    assert registry.get_sample_value("parallel_parrot_queue_wait_seconds_count") == 3.0
+    assert registry.get_sample_value("parallel_parrot_sent_bytes_total") > 0
+
+
+@pytest.mark.skipif(TracerProvider is None, reason="requires opentelemetry-sdk")
+def test_opentelemetry_instrumentation():
+    exporter = InMemorySpanExporter()
+    tracer_provider = TracerProvider()
+    tracer_provider.add_span_processor(SimpleSpanProcessor(exporter))
+    run_data_generation_against_stub_server(
+        pp.OpenTelemetryInstrumentation(tracer=tracer_provider.get_tracer(__name__))
+    )
+    spans = exporter.get_finished_spans()
+    span_names = Counter(span.name for span in spans)
+    assert span_names["parallel_parrot.request"] == 4
+    assert span_names["parallel_parrot.request_attempt"] == 5
+    request_span_ids = {
+        span.context.span_id for span in spans if span.name == "parallel_parrot.request"
+    }
+    assert all(
+        span.parent is not None and span.parent.span_id in request_span_ids
+        for span in spans
+        if span.name
+        in ["parallel_parrot.request_attempt", "parallel_parrot.ratelimit_wait"]
+    )
+    assert all(
+        span.attributes["http.response.status_code"] == 200
+        for span in spans
+        if span.name == "parallel_parrot.request"
+    )
+    assert span_names["parallel_parrot.request_redo"] == 1
+    assert all(span.end_time >= span.start_time for span in spans)
@@ -1,9 +1,22 @@
+import asyncio
+from collections import OrderedDict
 import dataclasses
+import json
 
-from aioresponses import aioresponses
+from aioresponses import CallbackResult, aioresponses
 import pytest
 
 import parallel_parrot as pp
+from parallel_parrot.concurrency import ConcurrencyLimit
+from parallel_parrot import openai_api
+from parallel_parrot.openai_api import (
+    complete_prompt_deduplicated,
+    gather_workers,
+    iter_worker_pool,
+    truncate_payload_before_request,
+)
+from parallel_parrot.types import ParallelParrotError
+from parallel_parrot.util import aiter_indexed_rows
 from parallel_parrot.openai_data_interface import (
     parallel_openai_chat_completion_dictlist,
     parallel_openai_chat_completion_pandas,
@@ -473,3 +486,674 @@ document: ${input}
         "total_tokens": 1348,
         "prompt_tokens": 499,
     }
+
+
+def test_gather_workers_cancels_on_error():
+    finished = []
+
+    async def slow_worker():
+        await asyncio.sleep(10)
+        finished.append(True)
+
+    async def failing_worker():
+        raise ParallelParrotError("failed")
+
+    async def run():
+        workers = [
+            asyncio.create_task(slow_worker()),
+            asyncio.create_task(failing_worker()),
+        ]
+        await gather_workers(workers)
+
+    with pytest.raises(ParallelParrotError):
+        pp.run_async(run())
+    assert finished == []
+
+
+def test_iter_worker_pool_adjusts_concurrency():
+    concurrency_limit = ConcurrencyLimit(1)
+    num_in_flight = 0
+    max_in_flight_list = []
+
+    async def process_row(row_index, input_row):
+        nonlocal num_in_flight
+        num_in_flight += 1
+        max_in_flight_list.append(num_in_flight)
+        await asyncio.sleep(0.01)
+        num_in_flight -= 1
+        if row_index == 0:
+            concurrency_limit.set_limit(4)
+        return input_row * 2
+
+    async def run():
+        return [
+            result
+            async for result in iter_worker_pool(
+                indexed_rows=aiter_indexed_rows(range(20)),
+                process_row=process_row,
+                concurrency_limit=concurrency_limit,
+            )
+        ]
+
+    results = pp.run_async(run())
+    assert sorted(results) == [(i, i * 2) for i in range(20)]
+    assert max_in_flight_list[0] == 1
+    assert max(max_in_flight_list) == 4
+
+
+def test_iter_worker_pool_waits_for_cancelled_workers():
+    started = []
+    cleaned_up = []
+
+    async def process_row(row_index, input_row):
+        started.append(row_index)
+        try:
+            if row_index > 0:
+                await asyncio.sleep(10)
+            return input_row
+        finally:
+            # like releasing a connection, the cleanup of a cancelled row takes a while
+            await asyncio.sleep(0.01)
+            cleaned_up.append(row_index)
+
+    async def run():
+        results = iter_worker_pool(
+            indexed_rows=aiter_indexed_rows(range(20)),
+            process_row=process_row,
+            concurrency_limit=ConcurrencyLimit(4),
+        )
+        # the consumer stops after the first result
+        first_result = await results.__anext__()
+        await asyncio.sleep(0.01)
+        await results.aclose()
+        # the in-flight rows were cleaned up before aclose() returned
+        assert sorted(cleaned_up) == sorted(started)
+        return first_result
+
+    assert pp.run_async(run()) == (0, 0)
+
+
+def test_parallel_text_generation_stream_setup_error(
+    mock_aioresponse, openai_chat_completion_config
+):
+    mock_aioresponse.post(
+        "https://api.openai.com/v1/chat/completions",
+        status=401,
+        payload={"error": {"code": "invalid_api_key"}},
+    )
+    mock_aioresponse.post(
+        "https://api.openai.com/v1/chat/completions",
+        payload={
+            "object": "chat.completion",
+            "choices": [
+                {
+                    "index": 0,
+                    "message": {"role": "assistant", "content": "4"},
+                    "finish_reason": "stop",
+                }
+            ],
+            "usage": {"prompt_tokens": 37, "completion_tokens": 1, "total_tokens": 38},
+        },
+        repeat=True,
+    )
+    results = []
+
+    async def collect():
+        async for result in pp.parallel_text_generation_stream(
+            config=openai_chat_completion_config,
+            input_data=[{"input": "what is 1+1?"}, {"input": "what is 2+2?"}],
+            prompt_template="Q: ${input}\nA:",
+        ):
+            results.append(result)
+
+    with pytest.raises(ParallelParrotError):
+        pp.run_async(collect())
+    # the result of the second row is not yielded, because the setup request failed
+    assert results == []
+
+
+def test_parallel_text_generation_stream(
+    mock_aioresponse, openai_chat_completion_config
+):
+    for content in ["2", "4", "6"]:
+        mock_aioresponse.post(
+            "https://api.openai.com/v1/chat/completions",
+            headers={
+                "x-ratelimit-limit-requests": "3500",
+            },
+            payload={
+                "object": "chat.completion",
+                "choices": [
+                    {
+                        "index": 0,
+                        "message": {"role": "assistant", "content": content},
+                        "finish_reason": "stop",
+                    }
+                ],
+                "usage": {
+                    "prompt_tokens": 37,
+                    "completion_tokens": 1,
+                    "total_tokens": 38,
+                },
+            },
+        )
+
+    async def input_rows():
+        for question in ["what is 1+1?", "what is 2+2?", "what is 3+3?"]:
+            yield {"input": question}
+
+    async def collect():
+        return [
+            result
+            async for result in pp.parallel_text_generation_stream(
+                config=openai_chat_completion_config,
+                input_data=input_rows(),
+                prompt_template="Q: ${input}\nA:",
+            )
+        ]
+
+    results = pp.run_async(collect())
+    assert sorted(row_index for (row_index, _, _) in results) == [0, 1, 2]
+    assert sorted(output for (_, output, _) in results) == ["2", "4", "6"]
+    assert all(usage["total_tokens"] == 38 for (_, _, usage) in results)
+
+
+def test_parallel_openai_chat_completion_response_cache(
+    mock_aioresponse, openai_chat_completion_config, tmp_path
+):
+    config = dataclasses.replace(
+        openai_chat_completion_config,
+        response_cache_path=str(tmp_path / "cache.sqlite3"),
+        response_cache_ttl_seconds=3600,
+    )
+    # the first row is sent again by the second run
+    for content in ["2", "4", "2"]:
+        mock_aioresponse.post(
+            "https://api.openai.com/v1/chat/completions",
+            headers={
+                "x-ratelimit-limit-requests": "3500",
+            },
+            payload={
+                "object": "chat.completion",
+                "choices": [
+                    {
+                        "index": 0,
+                        "message": {"role": "assistant", "content": content},
+                        "finish_reason": "stop",
+                    }
+                ],
+                "usage": {
+                    "prompt_tokens": 37,
+                    "completion_tokens": 1,
+                    "total_tokens": 38,
+                },
+            },
+        )
+    input_list = [{"input": "what is 1+1?"}, {"input": "what is 2+2?"}]
+    (output_list, usage_stats_sum) = pp.run_async(
+        parallel_openai_chat_completion_dictlist(
+            config=config,
+            input_list=input_list,
+            prompt_template="Q: ${input}\nA:",
+            output_key="output",
+        )
+    )
+    assert usage_stats_sum["cache_misses"] == 2
+    # the second run is served from the cache, except for the setup request of the first row,
+    # whose ratelimit headers set the concurrency
+    (cached_output_list, cached_usage_stats_sum) = pp.run_async(
+        parallel_openai_chat_completion_dictlist(
+            config=config,
+            input_list=input_list,
+            prompt_template="Q: ${input}\nA:",
+            output_key="output",
+        )
+    )
+    assert cached_output_list == output_list
+    assert cached_usage_stats_sum == {
+        "cache_hits": 1,
+        "cache_misses": 1,
+        "completion_tokens": 1,
+        "prompt_tokens": 37,
+        "total_tokens": 38,
+    }
+    request_calls = list(mock_aioresponse.requests.values())[0]
+    assert len(request_calls) == 3
+
+
+def test_parallel_openai_chat_completion_request_dump(
+    mock_aioresponse, openai_chat_completion_config, tmp_path
+):
+    request_dump_path = tmp_path / "dump" / "requests.jsonl"
+    config = dataclasses.replace(
+        openai_chat_completion_config, request_dump_path=str(request_dump_path)
+    )
+    # the first row is sent again by the second run
+    for content in ["2", "4", "2"]:
+        mock_aioresponse.post(
+            "https://api.openai.com/v1/chat/completions",
+            headers={
+                "x-ratelimit-limit-requests": "3500",
+            },
+            payload={
+                "object": "chat.completion",
+                "choices": [
+                    {
+                        "index": 0,
+                        "message": {"role": "assistant", "content": content},
+                        "finish_reason": "stop",
+                    }
+                ],
+                "usage": {
+                    "prompt_tokens": 37,
+                    "completion_tokens": 1,
+                    "total_tokens": 38,
+                },
+            },
+        )
+    pp.run_async(
+        parallel_openai_chat_completion_dictlist(
+            config=config,
+            input_list=[{"input": "what is 1+1?"}, {"input": "what is 2+2?"}],
+            prompt_template="Q: ${input}\nA:",
+            output_key="output",
+        )
+    )
+    with request_dump_path.open() as f:
+        records = [json.loads(line) for line in f]
+    assert sorted(
+        record["payload"]["messages"][-1]["content"] for record in records
+    ) == ["Q: what is 1+1?\nA:", "Q: what is 2+2?\nA:"]
+    assert all(record["status"] == 200 for record in records)
+    assert sorted(
+        record["body"]["choices"][0]["message"]["content"] for record in records
+    ) == ["2", "4"]
+
+
+def test_parallel_text_generation_history_key(
+    mock_aioresponse, openai_chat_completion_config
+):
+    prefix_messages = [
+        {"role": "user", "content": "Q: what is 1+1?\nA:"},
+        {"role": "assistant", "content": "2"},
+    ]
+    config = dataclasses.replace(
+        openai_chat_completion_config,
+        prefix_messages=prefix_messages,
+        history_key="history",
+    )
+    sent_messages = []
+
+    def chat_completion_callback(url, **kwargs):
+        messages = json.loads(kwargs["data"])["messages"]
+        sent_messages.append(messages)
+        return CallbackResult(
+            payload={
+                "object": "chat.completion",
+                "choices": [
+                    {
+                        "index": 0,
+                        "message": {"role": "assistant", "content": str(len(messages))},
+                        "finish_reason": "stop",
+                    }
+                ],
+                "usage": {
+                    "prompt_tokens": 37,
+                    "completion_tokens": 1,
+                    "total_tokens": 38,
+                },
+            },
+        )
+
+    mock_aioresponse.post(
+        "https://api.openai.com/v1/chat/completions",
+        callback=chat_completion_callback,
+        repeat=True,
+    )
+    history = [
+        {"role": "user", "content": "Q: what is 2+2?\nA:"},
+        {"role": "assistant", "content": "4"},
+    ]
+    input_list = [
+        {"input": "what is 3+3?", "history": history},
+        {"input": "what is 4+4?", "history": None},
+    ]
+    (output_list, usage_stats_sum) = pp.run_async(
+        pp.parallel_text_generation(
+            config=config,
+            input_data=input_list,
+            prompt_template="Q: ${input}\nA:",
+            output_key="output",
+        )
+    )
+    assert [row["output"] for row in output_list] == ["5", "3"]
+    assert sorted(sent_messages, key=len) == [
+        prefix_messages + [{"role": "user", "content": "Q: what is 4+4?\nA:"}],
+        prefix_messages
+        + history
+        + [{"role": "user", "content": "Q: what is 3+3?\nA:"}],
+    ]
+
+
+def test_parallel_text_generation_checkpoint(
+    mock_aioresponse, openai_chat_completion_config, tmp_path
+):
+    def mock_completion(content):
+        mock_aioresponse.post(
+            "https://api.openai.com/v1/chat/completions",
+            headers={
+                "x-ratelimit-limit-requests": "3500",
+            },
+            payload={
+                "object": "chat.completion",
+                "choices": [
+                    {
+                        "index": 0,
+                        "message": {"role": "assistant", "content": content},
+                        "finish_reason": "stop",
+                    }
+                ],
+                "usage": {
+                    "prompt_tokens": 37,
+                    "completion_tokens": 1,
+                    "total_tokens": 38,
+                },
+            },
+        )
+
+    checkpoint_path = str(tmp_path / "checkpoint.jsonl")
+    input_list = [{"input": "what is 1+1?"}, {"input": "what is 2+2?"}]
+    mock_completion("2")
+    mock_aioresponse.post(
+        "https://api.openai.com/v1/chat/completions",
+        status=429,
+        reason="You exceeded your current quota",
+    )
+    with pytest.raises(ParallelParrotError):
+        pp.run_async(
+            pp.parallel_text_generation(
+                config=openai_chat_completion_config,
+                input_data=input_list,
+                prompt_template="Q: ${input}\nA:",
+                output_key="output",
+                checkpoint_path=checkpoint_path,
+            )
+        )
+    # only the row which did not complete is sent again
+    mock_completion("4")
+    (output_list, usage_stats_sum) = pp.run_async(
+        pp.parallel_text_generation(
+            config=openai_chat_completion_config,
+            input_data=input_list,
+            prompt_template="Q: ${input}\nA:",
+            output_key="output",
+            checkpoint_path=checkpoint_path,
+        )
+    )
+    assert output_list == [
+        {"input": "what is 1+1?", "output": "2"},
+        {"input": "what is 2+2?", "output": "4"},
+    ]
+    assert usage_stats_sum["total_tokens"] == 76
+    # a journal from a different job is rejected
+    with pytest.raises(ParallelParrotError):
+        pp.run_async(
+            pp.parallel_text_generation(
+                config=openai_chat_completion_config,
+                input_data=input_list,
+                prompt_template="Question: ${input}\nAnswer:",
+                output_key="output",
+                checkpoint_path=checkpoint_path,
+            )
+        )
+    # including a different system_message, or different rows of the same number
+    for config, other_input_list in [
+        (
+            dataclasses.replace(
+                openai_chat_completion_config, system_message="Answer in French"
+            ),
+            input_list,
+        ),
+        (openai_chat_completion_config, input_list[::-1]),
+    ]:
+        with pytest.raises(ParallelParrotError, match="different job"):
+            pp.run_async(
+                pp.parallel_text_generation(
+                    config=config,
+                    input_data=other_input_list,
+                    prompt_template="Q: ${input}\nA:",
+                    output_key="output",
+                    checkpoint_path=checkpoint_path,
+                )
+            )
+
+
+def test_parallel_openai_chat_completion_deduplicate_prompts(
+    mock_aioresponse, openai_chat_completion_config
+):
+    config = dataclasses.replace(openai_chat_completion_config, temperature=0.0)
+    # the first row is sent again by the second run
+    for content in ["2", "4", "2"]:
+        mock_aioresponse.post(
+            "https://api.openai.com/v1/chat/completions",
+            headers={
+                "x-ratelimit-limit-requests": "3500",
+            },
+            payload={
+                "object": "chat.completion",
+                "choices": [
+                    {
+                        "index": 0,
+                        "message": {"role": "assistant", "content": content},
+                        "finish_reason": "stop",
+                    }
+                ],
+                "usage": {
+                    "prompt_tokens": 37,
+                    "completion_tokens": 1,
+                    "total_tokens": 38,
+                },
+            },
+        )
+    (output_list, usage_stats_sum) = pp.run_async(
+        parallel_openai_chat_completion_dictlist(
+            config=config,
+            input_list=[
+                {"input": "what is 1+1?"},
+                {"input": "what is 2+2?", "source": "a"},
+                {"input": "what is 2+2?", "source": "b"},
+            ],
+            prompt_template="Q: ${input}\nA:",
+            output_key="output",
+        )
+    )
+    assert output_list == [
+        {"input": "what is 1+1?", "output": "2"},
+        {"input": "what is 2+2?", "source": "a", "output": "4"},
+        {"input": "what is 2+2?", "source": "b", "output": "4"},
+    ]
+    assert usage_stats_sum == {
+        "completion_tokens": 2,
+        "prompt_tokens": 74,
+        "total_tokens": 76,
+        "deduplicated_rows": 1,
+    }
+
+
+def test_complete_prompt_deduplicated(monkeypatch):
+    monkeypatch.setattr(openai_api, "MAX_NUM_RECENT_DEDUPLICATED_OUTPUTS", 2)
+    num_calls_by_prompt: dict = {}
+
+    async def complete_prompt(prompt):
+        num_calls_by_prompt[prompt] = num_calls_by_prompt.get(prompt, 0) + 1
+        await asyncio.sleep(0.01)
+        return (prompt.upper(), {"total_tokens": 1})
+
+    async def run():
+        shared_results: dict = {}
+        recent_outputs: OrderedDict = OrderedDict()
+        results = await asyncio.gather(
+            *[
+                complete_prompt_deduplicated(
+                    prompt, shared_results, complete_prompt, recent_outputs
+                )
+                for prompt in ["a", "a", "b", "c", "d"]
+            ]
+        )
+        # only the requests in flight are held
+        assert shared_results == {}
+        assert len(recent_outputs) == 2
+        # a recently completed prompt is reused, an older one is requested again
+        results.append(
+            await complete_prompt_deduplicated(
+                "d", shared_results, complete_prompt, recent_outputs
+            )
+        )
+        results.append(
+            await complete_prompt_deduplicated(
+                "a", shared_results, complete_prompt, recent_outputs
+            )
+        )
+        return results
+
+    results = pp.run_async(run())
+    assert [model_output for (model_output, _) in results] == [
+        "A",
+        "A",
+        "B",
+        "C",
+        "D",
+        "D",
+        "A",
+    ]
+    assert results[1][1]["deduplicated_rows"] == 1
+    assert results[5][1]["deduplicated_rows"] == 1
+    assert num_calls_by_prompt == {"a": 2, "b": 1, "c": 1, "d": 1}
+
+
+def test_parallel_text_generation_shared_client(
+    mock_aioresponse, openai_chat_completion_config
+):
+    mock_aioresponse.post(
+        "https://api.openai.com/v1/chat/completions",
+        headers={
+            "x-ratelimit-limit-requests": "3500",
+        },
+        payload={
+            "object": "chat.completion",
+            "choices": [
+                {
+                    "index": 0,
+                    "message": {"role": "assistant", "content": "2"},
+                    "finish_reason": "stop",
+                }
+            ],
+            "usage": {"prompt_tokens": 37, "completion_tokens": 1, "total_tokens": 38},
+        },
+        repeat=True,
+    )
+    other_config = dataclasses.replace(
+        openai_chat_completion_config,
+        openai_api_key="*othersekret*",
+        openai_org_id="org-other",
+    )
+
+    async def run():
+        async with pp.OpenAIClient() as client:
+            results = []
+            for config in [openai_chat_completion_config, other_config]:
+                results.append(
+                    await pp.parallel_text_generation(
+                        config=config,
+                        input_data=[{"input": "what is 1+1?"}] * 2,
+                        prompt_template="Q: ${input}\nA:",
+                        output_key="output",
+                        client=client,
+                    )
+                )
+                assert not client.closed
+        assert client.closed
+        return results
+
+    results = pp.run_async(run())
+    for output_list, usage_stats_sum in results:
+        assert output_list == [{"input": "what is 1+1?", "output": "2"}] * 2
+    request_calls = list(mock_aioresponse.requests.values())[0]
+    request_headers = [call.kwargs["headers"] for call in request_calls]
+    assert [headers["Authorization"] for headers in request_headers] == [
+        "Bearer *suupersekret*"
+    ] * 2 + ["Bearer *othersekret*"] * 2
+    assert [headers.get("OpenAI-Organization") for headers in request_headers] == [
+        None
+    ] * 2 + ["org-other"] * 2
+    with pytest.raises(ParallelParrotError):
+        pp.OpenAIClient().session
+
+
+def test_parallel_text_generation_credential_failover(
+    mock_aioresponse, openai_chat_completion_config
+):
+    config = dataclasses.replace(
+        openai_chat_completion_config,
+        openai_api_key="*out-of-quota*",
+        additional_openai_credentials=[
+            pp.OpenAICredential(openai_api_key="*suupersekret*"),
+        ],
+    )
+    authorizations = []
+
+    def chat_completion_callback(url, **kwargs):
+        authorization = kwargs["headers"]["Authorization"]
+        authorizations.append(authorization)
+        if authorization == "Bearer *out-of-quota*":
+            return CallbackResult(
+                status=429,
+                payload={"error": {"code": "insufficient_quota"}},
+            )
+        return CallbackResult(
+            payload={
+                "object": "chat.completion",
+                "choices": [
+                    {
+                        "index": 0,
+                        "message": {"role": "assistant", "content": "2"},
+                        "finish_reason": "stop",
+                    }
+                ],
+                "usage": {
+                    "prompt_tokens": 37,
+                    "completion_tokens": 1,
+                    "total_tokens": 38,
+                },
+            },
+        )
+
+    mock_aioresponse.post(
+        "https://api.openai.com/v1/chat/completions",
+        callback=chat_completion_callback,
+        repeat=True,
+    )
+    (output_list, usage_stats_sum) = pp.run_async(
+        pp.parallel_text_generation(
+            config=config,
+            input_data=[{"input": "what is 1+1?"}] * 4,
+            prompt_template="Q: ${input}\nA:",
+            output_key="output",
+        )
+    )
+    assert output_list == [{"input": "what is 1+1?", "output": "2"}] * 4
+    # the out-of-quota key is disabled after its first response (other rows may already be in flight)
+    assert 1 <= authorizations.count("Bearer *out-of-quota*") <= 2
+    assert authorizations.count("Bearer *suupersekret*") == 4
+
+
+def test_truncate_payload_before_request_unknown_model(caplog):
+    payload = {
+        "model": "my-local-model-for-truncation",
+        "messages": [{"role": "user", "content": "short prompt"}],
+    }
+    for _ in range(3):
+        truncate_payload_before_request(payload)
+    # warned about once per model, rather than once per row
+    assert caplog.text.count("Unknown context window") == 1
+    assert payload["messages"] == [{"role": "user", "content": "short prompt"}]
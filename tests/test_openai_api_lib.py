@@ -1,12 +1,18 @@
+import json
+
 import pytest
 
-from parallel_parrot.types import ParallelParrotError
+from parallel_parrot import openai_api_lib
+from parallel_parrot.response_cache import make_payload_cache_key
+from parallel_parrot.types import OpenAIChatCompletionConfig, ParallelParrotError
 from parallel_parrot.openai_api_lib import (
     OPENAI_EMPTY_USAGE_STATS,
+    ChatCompletionPayloadBuilder,
     prep_openai_function_list_of_objects,
     parse_chat_completion_message_and_usage,
     parse_content_length_exceeded_error,
     parse_seconds_from_header,
+    estimate_payload_tokens,
 )
 
 
@@ -255,3 +261,143 @@ def test_parse_seconds_from_header():
     assert parse_seconds_from_header("0.123s") == 0.123
     assert parse_seconds_from_header("1m20s") == 80.0
     assert parse_seconds_from_header("1m") == 60.0
+    assert parse_seconds_from_header("20ms") == 0.02
+    assert parse_seconds_from_header("6m0s") == 360.0
+
+
+def test_estimate_payload_tokens():
+    payload = {
+        "messages": [
+            {"role": "system", "content": "abcd"},
+            {"role": "user", "content": "abcdefgh"},
+        ],
+        "max_tokens": 10,
+        "n": 2,
+    }
+    assert estimate_payload_tokens(payload) == 3 + 20
+
+
+@pytest.mark.parametrize("use_orjson", [True, False])
+def test_chat_completion_payload_builder(monkeypatch, use_orjson):
+    if not use_orjson:
+        monkeypatch.setattr(openai_api_lib, "orjson", None)
+    config = OpenAIChatCompletionConfig(
+        openai_api_key="*suupersekret*",
+        model="gpt-3.5-turbo-0613",
+        system_message="You are a helpful assistant",
+        temperature=0.5,
+    )
+    (
+        functions,
+        function_call,
+        function_system_prompt,
+    ) = prep_openai_function_list_of_objects("f", "p", ["output"])
+    payload_builder = ChatCompletionPayloadBuilder(
+        config=config,
+        functions=functions,
+        function_call=function_call,
+        function_system_prompt=function_system_prompt,
+    )
+    payload = payload_builder.build('a "quoted" prompt, \u00e9t\u00e9')
+    assert payload == {
+        "model": "gpt-3.5-turbo-0613",
+        "temperature": 0.5,
+        "stream": False,
+        "response_format": {"type": "json_object"},
+        "messages": [
+            {"role": "system", "content": "You are a helpful assistant"},
+            {"role": "system", "content": function_system_prompt},
+            {"role": "user", "content": 'a "quoted" prompt, \u00e9t\u00e9'},
+        ],
+        "functions": functions,
+        "function_call": function_call,
+    }
+    encoded_payload = payload_builder.encode(payload)
+    assert json.loads(encoded_payload) == payload
+    assert list(json.loads(encoded_payload).keys()) == list(payload.keys())
+    # e.g. truncation
+    payload["messages"][-1] = {"role": "user", "content": "a"}
+    assert json.loads(payload_builder.encode(payload)) == payload
+    # the constant parts are unchanged by changes to earlier payloads
+    assert payload_builder.build("b")["messages"][-1]["content"] == "b"
+    assert len(payload_builder.build("c")["messages"]) == 3
+
+    payload_builder = ChatCompletionPayloadBuilder(
+        config=OpenAIChatCompletionConfig(openai_api_key="*suupersekret*")
+    )
+    payload = payload_builder.build("d")
+    assert payload["messages"] == [{"role": "user", "content": "d"}]
+    assert json.loads(payload_builder.encode(payload)) == payload
+
+
+def test_chat_completion_payload_builder_messages():
+    prefix_messages = [
+        {"role": "user", "content": "is 2 prime?"},
+        {"role": "assistant", "content": "yes"},
+    ]
+    config = OpenAIChatCompletionConfig(
+        openai_api_key="*suupersekret*",
+        system_message="You are a helpful assistant",
+        prefix_messages=prefix_messages,
+    )
+    payload_builder = ChatCompletionPayloadBuilder(config=config)
+    row_messages = [
+        {"role": "user", "content": "is 3 prime?"},
+        {"role": "assistant", "content": "yes"},
+        {"role": "user", "content": "is 4 prime?"},
+    ]
+    payload = payload_builder.build(row_messages)
+    assert payload["messages"] == (
+        [{"role": "system", "content": "You are a helpful assistant"}]
+        + prefix_messages
+        + row_messages
+    )
+    assert "prefix_messages" not in payload
+    encoded_payload = payload_builder.encode(payload)
+    assert json.loads(encoded_payload) == payload
+    # every request starts with the same bytes, up to its own messages
+    other_encoded_payload = payload_builder.encode(payload_builder.build("is 5 prime?"))
+    encoded_prefix = json.dumps(prefix_messages, separators=(",", ":"))[1:-1].encode()
+    shared_length = encoded_payload.index(encoded_prefix) + len(encoded_prefix)
+    assert encoded_payload[:shared_length] == other_encoded_payload[:shared_length]
+
+
+@pytest.mark.parametrize("prompt", ["a prompt", [], [{"role": "user", "content": "a"}]])
+@pytest.mark.parametrize("system_message", [None, "You are a helpful assistant"])
+def test_chat_completion_payload_builder_precomputed(prompt, system_message):
+    config = OpenAIChatCompletionConfig(
+        openai_api_key="*suupersekret*",
+        system_message=system_message,
+        max_tokens=10,
+        user="someone",
+    )
+    (
+        functions,
+        function_call,
+        function_system_prompt,
+    ) = prep_openai_function_list_of_objects("f", "p", ["output"])
+    for payload_builder in [
+        ChatCompletionPayloadBuilder(config=config),
+        ChatCompletionPayloadBuilder(
+            config=config,
+            functions=functions,
+            function_call=function_call,
+            function_system_prompt=function_system_prompt,
+        ),
+    ]:
+        payload = payload_builder.build(prompt)
+        # the same as from the whole payload, without serializing the shared part of it again
+        assert payload_builder.estimate_tokens(payload) == estimate_payload_tokens(
+            payload
+        )
+        assert payload_builder.make_cache_key(payload) == make_payload_cache_key(
+            payload
+        )
+        # the messages of the row may change after build()
+        payload["messages"].append({"role": "user", "content": "\u00e9t\u00e9"})
+        assert payload_builder.make_cache_key(payload) == make_payload_cache_key(
+            payload
+        )
+        assert payload_builder.make_cache_key(payload) != make_payload_cache_key(
+            payload_builder.build("b")
+        )
@@ -0,0 +1,207 @@
+import asyncio
+import json
+from typing import Optional
+
+from aiohttp import web
+import pytest
+
+import parallel_parrot as pp
+from parallel_parrot import openai_batch_api
+from parallel_parrot.types import ParallelParrotError
+
+
+def make_stub_batch_app(stub_state: Optional[dict] = None) -> web.Application:
+    """
+    a local stub of the OpenAI files and batches endpoints, which "runs" every batch immediately.
+    stub_state["batch_statuses"] overrides the "completed" status of a batch_id (without an output file).
+    Apps with the same stub_state share their files and batches.
+    """
+    if stub_state is None:
+        stub_state = make_stub_state()
+    files = stub_state["files"]
+    batches = stub_state["batches"]
+
+    async def create_file(request):
+        form = await request.post()
+        assert form["purpose"] == "batch"
+        file_id = f"file-{len(files)}"
+        files[file_id] = form["file"].file.read().decode("utf-8")
+        return web.json_response({"id": file_id, "object": "file"})
+
+    async def create_batch(request):
+        body = await request.json()
+        assert body["endpoint"] == "/v1/chat/completions"
+        output_lines = []
+        for line in files[body["input_file_id"]].splitlines():
+            batch_request = json.loads(line)
+            prompt = batch_request["body"]["messages"][-1]["content"]
+            output_lines.append(
+                json.dumps(
+                    {
+                        "custom_id": batch_request["custom_id"],
+                        "response": {
+                            "status_code": 200,
+                            "body": {
+                                "object": "chat.completion",
+                                "choices": [
+                                    {
+                                        "index": 0,
+                                        "message": {
+                                            "role": "assistant",
+                                            "content": prompt.upper(),
+                                        },
+                                        "finish_reason": "stop",
+                                    }
+                                ],
+                                "usage": {
+                                    "prompt_tokens": 10,
+                                    "completion_tokens": 2,
+                                    "total_tokens": 12,
+                                },
+                            },
+                        },
+                        "error": None,
+                    }
+                )
+            )
+        output_file_id = f"file-{len(files)}"
+        files[output_file_id] = "\n".join(output_lines) + "\n"
+        batch_id = f"batch_{len(batches)}"
+        batches[batch_id] = {
+            "id": batch_id,
+            "status": "completed",
+            "output_file_id": output_file_id,
+            "request_counts": {"total": len(output_lines)},
+        }
+        return web.json_response({"id": batch_id, "status": "validating"})
+
+    async def get_batch(request):
+        batch_id = request.match_info["batch_id"]
+        status = stub_state["batch_statuses"].get(batch_id, "completed")
+        if status == "completed":
+            return web.json_response(batches[batch_id])
+        return web.json_response(
+            dict(batches[batch_id], status=status, output_file_id=None)
+        )
+
+    async def get_file_content(request):
+        return web.Response(text=files[request.match_info["file_id"]])
+
+    app = web.Application()
+    app.router.add_post("/v1/files", create_file)
+    app.router.add_post("/v1/batches", create_batch)
+    app.router.add_get("/v1/batches/{batch_id}", get_batch)
+    app.router.add_get("/v1/files/{file_id}/content", get_file_content)
+    return app
+
+
+def make_stub_state() -> dict:
+    return {"files": {}, "batches": {}, "batch_statuses": {}}
+
+
+async def run_batch_text_generation(app: web.Application, **kwargs):
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    await site.start()
+    config = pp.OpenAIChatCompletionConfig(
+        openai_api_key="*suupersekret*",
+        execution_mode=pp.ExecutionMode.BATCH,
+        openai_base_url=f"http://127.0.0.1:{runner.addresses[0][1]}/v1/",
+    )
+    try:
+        return await pp.parallel_text_generation(
+            config=config,
+            input_data=[{"input": "a"}, {"input": "b"}, {"input": "c"}],
+            prompt_template="${input}",
+            output_key="output",
+            **kwargs,
+        )
+    finally:
+        await runner.cleanup()
+
+
+@pytest.fixture
+def fast_batches(monkeypatch):
+    monkeypatch.setattr(openai_batch_api, "BATCH_POLL_INTERVAL_SECONDS", 0.0)
+    monkeypatch.setattr(openai_batch_api, "MAX_NUM_BATCH_REQUESTS", 2)
+
+
+def test_parallel_text_generation_batch(fast_batches):
+    (output_list, usage_stats_sum) = pp.run_async(
+        run_batch_text_generation(make_stub_batch_app())
+    )
+    assert output_list == [
+        {"input": "a", "output": "A"},
+        {"input": "b", "output": "B"},
+        {"input": "c", "output": "C"},
+    ]
+    assert usage_stats_sum == {
+        "prompt_tokens": 30,
+        "completion_tokens": 6,
+        "total_tokens": 36,
+    }
+
+
+def test_parallel_text_generation_batch_rejects_endpoints():
+    config = pp.OpenAIChatCompletionConfig(
+        openai_api_key="*suupersekret*",
+        execution_mode=pp.ExecutionMode.BATCH,
+        openai_endpoints=[pp.OpenAIEndpoint(base_url="http://replica-a/v1")],
+    )
+    with pytest.raises(ParallelParrotError, match="BATCH does not support"):
+        pp.run_async(
+            pp.parallel_text_generation(
+                config=config,
+                input_data=[{"input": "a"}],
+                prompt_template="${input}",
+                output_key="output",
+            )
+        )
+
+
+def test_parallel_text_generation_batch_failed(fast_batches):
+    stub_state = make_stub_state()
+    stub_state["batch_statuses"]["batch_0"] = "failed"
+    (output_list, usage_stats_sum) = pp.run_async(
+        run_batch_text_generation(make_stub_batch_app(stub_state))
+    )
+    # the rows of the failed batch have no output, and the other batch is kept
+    assert output_list == [
+        {"input": "a", "output": None},
+        {"input": "b", "output": None},
+        {"input": "c", "output": "C"},
+    ]
+
+
+def test_parallel_text_generation_batch_resume(fast_batches, tmp_path):
+    checkpoint_path = str(tmp_path / "checkpoint.jsonl")
+    stub_state = make_stub_state()
+    stub_state["batch_statuses"]["batch_0"] = "in_progress"
+    stub_state["batch_statuses"]["batch_1"] = "in_progress"
+
+    async def run_until_submitted():
+        # the process stops while polling
+        with pytest.raises(asyncio.TimeoutError):
+            await asyncio.wait_for(
+                run_batch_text_generation(
+                    make_stub_batch_app(stub_state), checkpoint_path=checkpoint_path
+                ),
+                timeout=0.5,
+            )
+
+    pp.run_async(run_until_submitted())
+    assert list(stub_state["batches"]) == ["batch_0", "batch_1"]
+    stub_state["batch_statuses"].clear()
+    (output_list, usage_stats_sum) = pp.run_async(
+        run_batch_text_generation(
+            make_stub_batch_app(stub_state), checkpoint_path=checkpoint_path
+        )
+    )
+    assert output_list == [
+        {"input": "a", "output": "A"},
+        {"input": "b", "output": "B"},
+        {"input": "c", "output": "C"},
+    ]
+    # the submitted batches were polled again, rather than submitted again
+    assert list(stub_state["batches"]) == ["batch_0", "batch_1"]
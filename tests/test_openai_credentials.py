@@ -0,0 +1,64 @@
+from collections import Counter
+
+import pytest
+
+import parallel_parrot as pp
+from parallel_parrot.openai_credentials import OpenAICredentialPool
+from parallel_parrot.openai_ratelimit import RateLimiterRegistry
+from parallel_parrot.types import ParallelParrotError
+
+
+def test_openai_credential_pool():
+    config = pp.OpenAIChatCompletionConfig(
+        openai_api_key="*key-a*",
+        additional_openai_credentials=[
+            pp.OpenAICredential(openai_api_key="*key-b*", openai_org_id="org-b"),
+        ],
+    )
+    credential_pool = OpenAICredentialPool(config, RateLimiterRegistry())
+    (credential_a, credential_b) = credential_pool.credentials
+    assert credential_a.headers["Authorization"] == "Bearer *key-a*"
+    assert credential_b.headers["OpenAI-Organization"] == "org-b"
+    # before any ratelimit headers, the credentials are used equally
+    counts = Counter(credential_pool.choose() for _ in range(10))
+    assert counts == {credential_a: 5, credential_b: 5}
+    # then in proportion to the ratelimits they report
+    credential_a.rate_limiter.update_from_headers({"x-ratelimit-limit-tokens": "300"})
+    credential_b.rate_limiter.update_from_headers({"x-ratelimit-limit-tokens": "100"})
+    counts = Counter(credential_pool.choose() for _ in range(40))
+    assert counts == {credential_a: 30, credential_b: 10}
+    # a throttled credential fails over to the other
+    credential_a.rate_limiter.throttle("tokens", 60.0)
+    assert credential_pool.has_available_credentials()
+    assert {credential_pool.choose() for _ in range(10)} == {credential_b}
+    credential_pool.disable(credential_b, "insufficient_quota")
+    assert not credential_pool.has_available_credentials()
+    assert credential_pool.choose() is credential_a
+    credential_pool.disable(credential_a, "401")
+    with pytest.raises(ParallelParrotError):
+        credential_pool.choose()
+
+
+def test_openai_credential_pool_throttled():
+    config = pp.OpenAIChatCompletionConfig(
+        openai_api_key="*key-a*",
+        additional_openai_credentials=[
+            pp.OpenAICredential(openai_api_key="*key-b*"),
+            pp.OpenAICredential(openai_api_key="*key-c*"),
+        ],
+    )
+    credential_pool = OpenAICredentialPool(config, RateLimiterRegistry())
+    (credential_a, credential_b, credential_c) = credential_pool.credentials
+    assert credential_pool.get_seconds_until_available() == 0.0
+    # a throttled credential is never chosen while another one is available
+    credential_a.rate_limiter.throttle("requests", 60.0)
+    credential_b.rate_limiter.throttle(None, 30.0)
+    assert {credential_pool.choose() for _ in range(10)} == {credential_c}
+    assert credential_pool.get_seconds_until_available() == 0.0
+    # when all are throttled, the one which is available first is chosen
+    credential_c.rate_limiter.throttle("tokens", 45.0)
+    assert credential_pool.choose() is credential_b
+    assert 29.0 < credential_pool.get_seconds_until_available() <= 30.0
+    credential_pool.disable(credential_b, "401")
+    assert credential_pool.choose() is credential_c
+    assert 44.0 < credential_pool.get_seconds_until_available() <= 45.0
@@ -0,0 +1,143 @@
+import asyncio
+from collections import Counter
+
+from aiohttp import web
+
+import parallel_parrot as pp
+from parallel_parrot.openai_endpoints import OpenAIEndpointRouter
+from parallel_parrot.openai_ratelimit import RateLimiterRegistry
+
+
+def test_openai_endpoint_router():
+    config = pp.OpenAIChatCompletionConfig(
+        openai_api_key="*suupersekret*",
+        model="gpt-3.5-turbo-0613",
+        openai_endpoints=[
+            pp.OpenAIEndpoint(base_url="http://replica-a/v1/", weight=3),
+            pp.OpenAIEndpoint(
+                base_url="http://replica-b/v1",
+                max_concurrent_requests=1,
+                openai_api_key="*replica-b-key*",
+            ),
+        ],
+    )
+    endpoint_router = OpenAIEndpointRouter(config, RateLimiterRegistry())
+    (endpoint_a, endpoint_b) = endpoint_router.endpoints
+    assert endpoint_a.chat_completions_url == "http://replica-a/v1/chat/completions"
+    assert endpoint_b.credential_pool.choose().headers["Authorization"] == (
+        "Bearer *replica-b-key*"
+    )
+
+    async def run():
+        # least in-flight requests relative to weight, up to max_concurrent_requests
+        acquired = [await endpoint_router.acquire() for _ in range(5)]
+        assert Counter(acquired) == {endpoint_a: 4, endpoint_b: 1}
+        # a capped endpoint gets the next request once it has capacity again
+        endpoint_a.max_concurrent_requests = 4
+        waiter = asyncio.ensure_future(endpoint_router.acquire())
+        await asyncio.sleep(0)
+        assert not waiter.done()
+        await endpoint_router.release(endpoint_b)
+        assert await waiter is endpoint_b
+
+    pp.run_async(run())
+
+
+def test_parallel_text_generation_endpoints():
+    num_requests_by_name: Counter = Counter()
+
+    def create_handler(name):
+        async def handler(request):
+            num_requests_by_name[name] += 1
+            await asyncio.sleep(0.01)
+            return web.json_response(
+                {
+                    "object": "chat.completion",
+                    "choices": [
+                        {
+                            "index": 0,
+                            "message": {"role": "assistant", "content": name},
+                            "finish_reason": "stop",
+                        }
+                    ],
+                    "usage": {
+                        "prompt_tokens": 10,
+                        "completion_tokens": 1,
+                        "total_tokens": 11,
+                    },
+                }
+            )
+
+        return handler
+
+    async def run():
+        runners = []
+        base_urls = []
+        for name in ["a", "b"]:
+            app = web.Application()
+            app.router.add_post("/v1/chat/completions", create_handler(name))
+            runner = web.AppRunner(app)
+            await runner.setup()
+            site = web.TCPSite(runner, "127.0.0.1", 0)
+            await site.start()
+            runners.append(runner)
+            base_urls.append(f"http://127.0.0.1:{runner.addresses[0][1]}/v1")
+        config = pp.OpenAIChatCompletionConfig(
+            openai_api_key="*suupersekret*",
+            model="gpt-3.5-turbo-0613",
+            openai_endpoints=[
+                pp.OpenAIEndpoint(base_url=base_urls[0]),
+                pp.OpenAIEndpoint(base_url=base_urls[1], max_concurrent_requests=2),
+            ],
+        )
+        try:
+            return await pp.parallel_text_generation(
+                config=config,
+                input_data=[{"input": str(i)} for i in range(20)],
+                prompt_template="${input}",
+                output_key="output",
+            )
+        finally:
+            for runner in runners:
+                await runner.cleanup()
+
+    (output_list, usage_stats_sum) = pp.run_async(run())
+    assert len(output_list) == 20
+    assert {row["output"] for row in output_list} == {"a", "b"}
+    assert num_requests_by_name["a"] + num_requests_by_name["b"] == 20
+    assert num_requests_by_name["a"] > num_requests_by_name["b"]
+
+
+def test_openai_endpoint_router_throttled():
+    config = pp.OpenAIChatCompletionConfig(
+        openai_api_key="*suupersekret*",
+        openai_endpoints=[
+            pp.OpenAIEndpoint(base_url="http://replica-a/v1", weight=3),
+            pp.OpenAIEndpoint(
+                base_url="http://replica-b/v1",
+                max_concurrent_requests=1,
+                openai_api_key="*replica-b-key*",
+            ),
+        ],
+    )
+    endpoint_router = OpenAIEndpointRouter(config, RateLimiterRegistry())
+    (endpoint_a, endpoint_b) = endpoint_router.endpoints
+    (credential_a,) = endpoint_a.credential_pool.credentials
+
+    async def run():
+        # an endpoint whose credentials are all throttled is skipped
+        credential_a.rate_limiter.throttle(None, 60.0)
+        assert await endpoint_router.acquire() is endpoint_b
+        # and waiting for capacity on another endpoint is preferred
+        waiter = asyncio.ensure_future(endpoint_router.acquire())
+        await asyncio.sleep(0)
+        assert not waiter.done()
+        await endpoint_router.release(endpoint_b)
+        assert await waiter is endpoint_b
+        # unless every endpoint is throttled
+        (credential_b,) = endpoint_b.credential_pool.credentials
+        credential_b.rate_limiter.throttle(None, 30.0)
+        assert await endpoint_router.acquire() is endpoint_a
+        assert 29.0 < endpoint_router.get_seconds_until_available() <= 30.0
+
+    pp.run_async(run())
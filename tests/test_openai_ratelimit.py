@@ -0,0 +1,100 @@
+import asyncio
+import time
+
+import pytest
+
+import parallel_parrot as pp
+from parallel_parrot.openai_ratelimit import (
+    OpenAIRateLimiter,
+    RateLimiterRegistry,
+    make_ratelimit_domain,
+)
+
+
+def test_rate_limiter_from_headers():
+    rate_limiter = OpenAIRateLimiter.from_headers(
+        {
+            "x-ratelimit-limit-requests": "3500",
+            "x-ratelimit-limit-tokens": "90000",
+            "x-ratelimit-remaining-requests": "3499",
+            "x-ratelimit-remaining-tokens": "89000",
+            "x-ratelimit-reset-requests": "17ms",
+            "x-ratelimit-reset-tokens": "666ms",
+        }
+    )
+    assert rate_limiter.request_bucket.limit == 3500
+    assert rate_limiter.request_bucket.remaining == 3499
+    assert rate_limiter.token_bucket.limit == 90000
+    assert rate_limiter.token_bucket.remaining == 89000
+
+
+def test_rate_limiter_acquire():
+    rate_limiter = OpenAIRateLimiter(limit_requests=3500, limit_tokens=90000)
+    pp.run_async(rate_limiter.acquire(1000))
+    assert rate_limiter.request_bucket.remaining < 3500
+    assert rate_limiter.token_bucket.remaining < 89001
+    # the server reports fewer remaining tokens than we estimated
+    rate_limiter.update_from_headers({"x-ratelimit-remaining-tokens": "100"})
+    assert rate_limiter.token_bucket.remaining < 101
+    assert rate_limiter.token_bucket.seconds_until_available(1000) > 0
+
+
+def test_rate_limiter_registry_scopes_throttling():
+    config = pp.OpenAIChatCompletionConfig(openai_api_key="*suupersekret*")
+    other_org_config = pp.OpenAIChatCompletionConfig(
+        openai_api_key="*suupersekret*", openai_org_id="org-other"
+    )
+    rate_limiters = RateLimiterRegistry()
+    rate_limiter = rate_limiters.get(
+        make_ratelimit_domain(
+            config.openai_api_key,
+            config.openai_org_id,
+            config.model,
+            config.openai_base_url,
+        )
+    )
+    assert (
+        rate_limiters.get(
+            make_ratelimit_domain(
+                config.openai_api_key,
+                config.openai_org_id,
+                config.model,
+                config.openai_base_url,
+            )
+        )
+        is rate_limiter
+    )
+    other_rate_limiter = rate_limiters.get(
+        make_ratelimit_domain(
+            other_org_config.openai_api_key,
+            other_org_config.openai_org_id,
+            other_org_config.model,
+            other_org_config.openai_base_url,
+        )
+    )
+    assert other_rate_limiter is not rate_limiter
+    assert "*suupersekret*" not in str(
+        make_ratelimit_domain(
+            config.openai_api_key,
+            config.openai_org_id,
+            config.model,
+            config.openai_base_url,
+        )
+    )
+
+    rate_limiter.throttle("tokens", 60.0)
+    assert rate_limiter.throttle_until_times["requests"] == 0.0
+
+    async def acquire_other():
+        start_time = time.monotonic()
+        await other_rate_limiter.acquire(1000)
+        return time.monotonic() - start_time
+
+    # a 429 in one domain does not block the others
+    assert pp.run_async(acquire_other()) < 1.0
+
+    async def acquire_throttled():
+        await asyncio.wait_for(rate_limiter.acquire(1000), timeout=0.1)
+
+    with pytest.raises(asyncio.TimeoutError):
+        pp.run_async(acquire_throttled())
@@ -1,4 +1,12 @@
-from parallel_parrot.openai_util import openai_token_truncate
+import parallel_parrot as pp
+from parallel_parrot.openai_api_lib import ChatCompletionPayloadBuilder
+from parallel_parrot.openai_util import (
+    count_tokens_batch,
+    fit_payload_to_context_window,
+    get_encoding_for_model,
+    get_model_context_window_tokens,
+    openai_token_truncate,
+)
 
 
 def test_openai_token_truncate():
@@ -7,3 +15,68 @@ def test_openai_token_truncate():
     tokens_to_remove = 12
     truncated = openai_token_truncate(input, model, tokens_to_remove)
     assert truncated == "This is a test.  It is"
+
+
+def test_get_model_context_window_tokens():
+    assert get_model_context_window_tokens("gpt-4") == 8192
+    assert get_model_context_window_tokens("gpt-4-0613") == 8192
+    assert get_model_context_window_tokens("gpt-4-32k-0613") == 32768
+    assert get_model_context_window_tokens("gpt-4-1106-preview") == 128000
+    assert get_model_context_window_tokens("gpt-3.5-turbo-0613") == 4096
+    assert get_model_context_window_tokens("ft:gpt-3.5-turbo-0613:org::id") == 4096
+    assert get_model_context_window_tokens("my-local-model") is None
+
+
+def test_fit_payload_to_context_window():
+    payload = {
+        "model": "gpt-4",
+        "max_tokens": 1000,
+        "messages": [
+            {"role": "system", "content": "You are a helpful assistant."},
+            {"role": "user", "content": "short prompt"},
+        ],
+    }
+    assert fit_payload_to_context_window(payload) == 0
+    assert payload["messages"][-1]["content"] == "short prompt"
+    payload["messages"][-1]["content"] = "word " * 10000
+    tokens_to_remove = fit_payload_to_context_window(payload)
+    assert tokens_to_remove > 0
+    assert payload["messages"][-1]["content"].startswith("word word")
+    assert fit_payload_to_context_window(payload) == 0
+    payload["model"] = "my-local-model"
+    assert fit_payload_to_context_window(payload) is None
+
+
+def test_fit_payload_to_context_window_prefix():
+    config = pp.OpenAIChatCompletionConfig(
+        openai_api_key="*suupersekret*",
+        model="gpt-4",
+        max_tokens=1000,
+        system_message="You are a helpful assistant.",
+        prefix_messages=[
+            {"role": "user", "content": "word " * 100},
+            {"role": "assistant", "content": "word"},
+        ],
+    )
+    payload_builder = ChatCompletionPayloadBuilder(config=config)
+    payload = payload_builder.build("short prompt")
+    assert payload_builder.fit_to_context_window(payload) == 0
+    # the shared messages are counted once, with the same result as counting them per row
+    payload = payload_builder.build("word " * 10000)
+    other_payload = payload_builder.build("word " * 10000)
+    tokens_to_remove = payload_builder.fit_to_context_window(payload)
+    assert tokens_to_remove == fit_payload_to_context_window(other_payload) > 0
+    assert payload["messages"] == other_payload["messages"]
+
+
+def test_count_tokens_batch():
+    assert get_encoding_for_model("gpt-3.5-turbo") is get_encoding_for_model(
+        "gpt-3.5-turbo"
+    )
+    assert count_tokens_batch([], "gpt-3.5-turbo") == []
+    texts = ["This is a test.", "", "<|endoftext|>"] * 100
+    num_tokens = count_tokens_batch(texts, "gpt-3.5-turbo")
+    assert num_tokens[:2] == [5, 0]
+    # special tokens are counted as ordinary text, rather than raising an error
+    assert num_tokens[2] > 1
+    assert num_tokens == num_tokens[:3] * 100
@@ -0,0 +1,58 @@
+from parallel_parrot.response_cache import (
+    SQLiteResponseCache,
+    make_payload_cache_key,
+)
+
+
+def test_make_payload_cache_key():
+    payload = {"model": "gpt-3.5-turbo", "messages": [{"role": "user", "content": "a"}]}
+    key = make_payload_cache_key(payload)
+    assert key == make_payload_cache_key(dict(reversed(list(payload.items()))))
+    assert key == make_payload_cache_key(dict(payload, user="someone"))
+    assert key != make_payload_cache_key(dict(payload, temperature=0.5))
+
+
+def test_sqlite_response_cache(tmp_path):
+    payload = {"model": "gpt-3.5-turbo", "messages": [{"role": "user", "content": "a"}]}
+    body = {"object": "chat.completion", "choices": []}
+    with SQLiteResponseCache(tmp_path / "cache.sqlite3") as response_cache:
+        assert response_cache.get(payload) is None
+        response_cache.put(payload, body)
+        assert response_cache.get(payload) == body
+    # the cache persists across instances
+    with SQLiteResponseCache(
+        tmp_path / "cache.sqlite3", ttl_seconds=0
+    ) as response_cache:
+        assert response_cache.total_bytes > 0
+        assert response_cache.get(payload) is None
+        assert response_cache.total_bytes == 0
+
+
+def test_sqlite_response_cache_eviction(tmp_path):
+    body = {"object": "chat.completion", "choices": []}
+    with SQLiteResponseCache(
+        tmp_path / "cache.sqlite3", max_bytes=100
+    ) as response_cache:
+        for i in range(10):
+            response_cache.put({"messages": [{"content": str(i)}]}, body)
+        assert response_cache.total_bytes <= 100
+        assert response_cache.get({"messages": [{"content": "0"}]}) is None
+        assert response_cache.get({"messages": [{"content": "9"}]}) == body
+
+
+def test_sqlite_response_cache_batched_commits(tmp_path):
+    body = {"object": "chat.completion", "choices": []}
+    with SQLiteResponseCache(
+        tmp_path / "cache.sqlite3", max_bytes=100
+    ) as response_cache:
+        response_cache.put({"messages": [{"content": "0"}]}, body)
+        response_cache.put({"messages": [{"content": "1"}]}, body)
+        # a hit which is not committed yet still counts for eviction
+        assert response_cache.get({"messages": [{"content": "0"}]}) == body
+        # room for only two bodies
+        response_cache.put({"messages": [{"content": "2"}]}, body)
+        assert response_cache.get({"messages": [{"content": "1"}]}) is None
+        assert response_cache.get({"messages": [{"content": "0"}]}) == body
+    # uncommitted writes are committed by close()
+    with SQLiteResponseCache(tmp_path / "cache.sqlite3") as response_cache:
+        assert response_cache.get({"messages": [{"content": "2"}]}) == body
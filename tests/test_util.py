@@ -1,4 +1,5 @@
 from parallel_parrot.util import (
+    LogPreview,
     sum_usage_stats,
 )
 
@@ -22,3 +23,11 @@ def test_sum_usage_stats():
         "prompt_tokens": 90,
         "completion_tokens": 210,
     }
+
+
+def test_log_preview():
+    payload = {"messages": [{"content": "x" * 10000}], "n": list(range(1000))}
+    preview = str(LogPreview(payload, max_chars=800))
+    assert len(preview) <= 803
+    assert preview.startswith("{'messages': [{'content': 'xxx")
+    assert str(LogPreview({"model": "gpt-4"})) == "{'model': 'gpt-4'}"
@@ -0,0 +1,99 @@
+try:
+    import pyarrow as pa  # type: ignore
+except ImportError:
+    pa = None
+try:
+    import polars as pl  # type: ignore
+except ImportError:
+    pl = None
+
+import pytest
+
+from parallel_parrot.util_arrow import (
+    append_model_outputs_arrow,
+    append_one_to_many_model_outputs_arrow,
+    append_one_to_many_objlist_outputs_arrow,
+)
+from parallel_parrot.util_template import CompiledPromptTemplate
+
+pytestmark = pytest.mark.skipif(pa is None, reason="requires pyarrow")
+
+
+def test_compiled_prompt_template_render_arrow():
+    input_table = pa.table(
+        {"a": ["alpha", None], "b": [1, 2], "c": [1.5, 2.0], "unused": [True, False]}
+    )
+    compiled_prompt_template = CompiledPromptTemplate("{$a} $b, $c $$")
+    assert list(compiled_prompt_template.render_arrow(input_table)) == [
+        "{alpha} 1, 1.5 $",
+        "{None} 2, 2.0 $",
+    ]
+    assert list(CompiledPromptTemplate("$a").render_arrow(input_table)) == [
+        "alpha",
+        "None",
+    ]
+
+
+def test_append_model_outputs_arrow():
+    input_table = pa.table({"col1": [1, 2, 3], "col2": ["a", "b", "c"]})
+    output_table = append_model_outputs_arrow(
+        input_table, ["alpha", None, "gamma"], "output_col"
+    )
+    assert output_table.to_pydict() == {
+        "col1": [1, 2, 3],
+        "col2": ["a", "b", "c"],
+        "output_col": ["alpha", None, "gamma"],
+    }
+    output_batch = append_one_to_many_model_outputs_arrow(
+        input_table.to_batches()[0],
+        [[], ["beta1", "beta2"], None],
+        "col2",
+    )
+    assert isinstance(output_batch, pa.RecordBatch)
+    assert output_batch.to_pydict() == {
+        "col1": [1, 2, 2, 3],
+        "col2": [None, "beta1", "beta2", None],
+    }
+
+
+def test_append_one_to_many_objlist_outputs_arrow():
+    input_table = pa.table({"col1": [1, 2, 3]})
+    objlist_outputs = [
+        [],
+        [{"k1": "beta1", "k2": 1}, {"k1": "beta2", "k2": "two"}],
+        [{"k1": "gamma1"}],
+    ]
+    output_table = append_one_to_many_objlist_outputs_arrow(
+        input_table, objlist_outputs, ["k1", "k2"]
+    )
+    assert output_table.to_pydict() == {
+        "col1": [1, 2, 2, 3],
+        "k1": [None, "beta1", "beta2", "gamma1"],
+        # mixed types are stored as JSON strings
+        "k2": [None, "1", "two", None],
+    }
+    output_table = append_one_to_many_objlist_outputs_arrow(
+        input_table, objlist_outputs, ["k1"], new_columns_only=True
+    )
+    assert output_table.to_pydict() == {
+        "input_row_index": [0, 1, 1, 2],
+        "k1": [None, "beta1", "beta2", "gamma1"],
+    }
+
+
+@pytest.mark.skipif(pl is None, reason="requires polars")
+def test_append_model_outputs_polars():
+    input_df = pl.DataFrame({"col1": [1, 2], "col2": ["a", "b"]})
+    assert list(
+        CompiledPromptTemplate("$col2$col1").render_arrow(input_df.to_arrow())
+    ) == [
+        "a1",
+        "b2",
+    ]
+    output_df = append_model_outputs_arrow(input_df, ["alpha", "beta"], "output_col")
+    assert isinstance(output_df, pl.DataFrame)
+    assert output_df.to_dict(as_series=False) == {
+        "col1": [1, 2],
+        "col2": ["a", "b"],
+        "output_col": ["alpha", "beta"],
+    }
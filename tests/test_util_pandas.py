@@ -64,3 +64,39 @@ def test_append_one_to_many_objlist_outputs_pandas():
         },
     )
     pd.testing.assert_frame_equal(output_df, expected_output_df)
+
+
+def test_append_outputs_pandas_new_columns_only():
+    input_df = pd.DataFrame(
+        {"col1": [1, 2, 3], "col2": ["a", "b", "c"]}, index=["x", "y", "z"]
+    )
+    output_df = append_one_to_many_model_outputs_pandas(
+        input_df, [None, ["beta1", "beta2"], []], "output_col", new_columns_only=True
+    )
+    expected_output_df = pd.DataFrame(
+        {"output_col": [None, "beta1", "beta2", math.nan]},
+        index=["x", "y", "y", "z"],
+    )
+    pd.testing.assert_frame_equal(output_df, expected_output_df)
+    objlist_outputs = [None, [{"k1": "b1", "k2": "b2"}, {"k1": "b3"}], []]
+    output_df = append_one_to_many_objlist_outputs_pandas(
+        input_df, objlist_outputs, ["k1", "k2"], new_columns_only=True
+    )
+    expected_output_df = pd.DataFrame(
+        {
+            "k1": [math.nan, "b1", "b3", math.nan],
+            "k2": [math.nan, "b2", None, math.nan],
+        },
+        index=["x", "y", "y", "z"],
+    )
+    pd.testing.assert_frame_equal(output_df, expected_output_df)
+    joined_df = input_df.join(output_df)
+    assert list(joined_df["col1"]) == [1, 2, 2, 3]
+
+
+def test_append_model_outputs_pandas_does_not_modify_input():
+    input_df = pd.DataFrame({"col1": [1, 2, 3], "col2": ["a", "b", "c"]})
+    output_df = append_model_outputs_pandas(input_df, ["d", "e", "f"], "col2")
+    assert list(output_df.columns) == ["col1", "col2"]
+    assert list(output_df["col2"]) == ["d", "e", "f"]
+    assert list(input_df["col2"]) == ["a", "b", "c"]
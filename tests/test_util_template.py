@@ -1,4 +1,16 @@
+try:
+    import pandas as pd  # type: ignore
+except ImportError:
+    pd = None
+
+import json
+
+import pytest
+
+from parallel_parrot.types import ParallelParrotError
 from parallel_parrot.util_template import (
+    CompiledMessagesTemplate,
+    CompiledPromptTemplate,
     make_curried_prompt_template,
 )
 
@@ -7,3 +19,88 @@ def test_make_curried_prompt_template():
     prompt_template = "${a}--${b}"
     curried_prompt_template = make_curried_prompt_template(prompt_template)
     assert curried_prompt_template({"a": "alpha", "b": "beta"}) == "alpha--beta"
+
+
+def test_compiled_prompt_template():
+    compiled_prompt_template = CompiledPromptTemplate("${a} and $a, not $${b}")
+    assert compiled_prompt_template.identifiers == ["a"]
+    rows = [{"a": 1, "unused": "x"}, {"a": "{b}"}]
+    assert list(compiled_prompt_template.render_many(rows)) == [
+        "1 and 1, not ${b}",
+        "{b} and {b}, not ${b}",
+    ]
+    with pytest.raises(ParallelParrotError):
+        list(compiled_prompt_template.render_many([{"b": 1}]))
+    with pytest.raises(ParallelParrotError):
+        compiled_prompt_template({"b": 1})
+    with pytest.raises(ParallelParrotError):
+        CompiledPromptTemplate("${a} $")
+
+
+@pytest.mark.skipif(pd is None, reason="requires pandas")
+def test_compiled_prompt_template_render_pandas():
+    input_df = pd.DataFrame(
+        {
+            "a": ["alpha", "gamma"],
+            "b": [1, 2.5],
+            "unused": [None, None],
+        }
+    )
+    prompt_template = " {json: $a} costs $$${b} ($a) "
+    curried_prompt_template = make_curried_prompt_template(prompt_template)
+    prompts = list(CompiledPromptTemplate(prompt_template).render_pandas(input_df))
+    assert prompts == [
+        curried_prompt_template(input_df.iloc[i]) for i in range(len(input_df))
+    ]
+    assert prompts == [
+        "{json: alpha} costs $1.0 (alpha)",
+        "{json: gamma} costs $2.5 (gamma)",
+    ]
+    assert (
+        list(CompiledPromptTemplate("no identifiers").render_pandas(input_df))
+        == ["no identifiers"] * 2
+    )
+    with pytest.raises(ParallelParrotError):
+        list(CompiledPromptTemplate("${a} ${missing}").render_pandas(input_df))
+
+
+def test_compiled_messages_template():
+    history = [
+        {"role": "user", "content": "is 2 prime?"},
+        {"role": "assistant", "content": "yes"},
+    ]
+    input_rows = [
+        {"q": "is 4 prime?", "history": history},
+        {"q": "is 5 prime?", "history": json.dumps(history)},
+        {"q": "is 6 prime?", "history": None},
+        {"q": "is 7 prime?"},
+    ]
+    messages_template = CompiledMessagesTemplate("${q}", "history")
+    rendered_messages = list(messages_template.render_many(input_rows))
+    assert rendered_messages == [messages_template(row) for row in input_rows]
+    assert rendered_messages[0] == history + [
+        {"role": "user", "content": "is 4 prime?"}
+    ]
+    assert rendered_messages[1] == history + [
+        {"role": "user", "content": "is 5 prime?"}
+    ]
+    assert rendered_messages[2] == [{"role": "user", "content": "is 6 prime?"}]
+    assert rendered_messages[3] == [{"role": "user", "content": "is 7 prime?"}]
+    with pytest.raises(ParallelParrotError):
+        list(CompiledMessagesTemplate("${q}", "missing").render_many(input_rows))
+    with pytest.raises(ParallelParrotError):
+        messages_template({"q": "?", "history": "not JSON"})
+    with pytest.raises(ParallelParrotError):
+        messages_template({"q": "?", "history": ["not a message"]})
+
+
+@pytest.mark.skipif(pd is None, reason="requires pandas")
+def test_compiled_messages_template_render_pandas():
+    history = [{"role": "assistant", "content": "hi"}]
+    input_df = pd.DataFrame({"q": ["a", "b"], "history": [history, None]})
+    assert list(
+        CompiledMessagesTemplate("${q}", "history").render_pandas(input_df)
+    ) == [
+        history + [{"role": "user", "content": "a"}],
+        [{"role": "user", "content": "b"}],
+    ]